@@ -1,16 +1,10 @@
-from django.conf import settings
 from django.contrib.auth.models import User
-from google.oauth2 import id_token
-from google.auth.transport import requests
+from .tokens import verify_google_id_token
 
 class GoogleAuthBackend:
     def authenticate(self, request, token=None):
         try:
-            idinfo = id_token.verify_oauth2_token(
-                token, 
-                requests.Request(), 
-                settings.GOOGLE_CLIENT_ID
-            )
+            idinfo = verify_google_id_token(token)
 
             email = idinfo['email']
             name = idinfo.get('name', '')
@@ -0,0 +1,161 @@
+"""Per-user Google OAuth credentials, shared and kept fresh.
+
+Tokens are stored in the database (``GoogleCredentials``), so a refresh
+made by one request, worker thread or process is picked up by the others
+instead of each of them refreshing again. Within a process every user has
+one ``StoredCredentials`` object. Refreshing it is single-flight: threads
+that ask while a refresh is running wait for it and reuse its token. The
+new token is written back to the database.
+
+A token that expires within ``REFRESH_AHEAD`` is refreshed on a background
+thread, so requests rarely wait for Google's token endpoint.
+"""
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from django.db import connection
+from google.auth.transport.requests import Request as GoogleAuthRequest
+from google.oauth2.credentials import Credentials
+
+from .models import GoogleCredentials
+
+logger = logging.getLogger(__name__)
+
+# How long before expiry a token is refreshed in the background
+REFRESH_AHEAD = timedelta(minutes=10)
+
+# Users whose credentials each process keeps in memory
+CACHE_SIZE = 1024
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_refreshing = set()
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='google-token-refresh')
+
+# One pooled HTTP session for every token refresh
+_http = GoogleAuthRequest()
+
+
+def _utcnow():
+    # google-auth compares naive UTC datetimes
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class StoredCredentials(Credentials):
+    """Credentials that refresh once for all their users and save the result"""
+
+    def __init__(self, *args, user_id, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.user_id = user_id
+        self._refresh_lock = threading.Lock()
+
+    def expires_soon(self):
+        return self.expiry is not None and self.expiry - _utcnow() < REFRESH_AHEAD
+
+    def refresh(self, request):
+        stale_token = self.token
+        with self._refresh_lock:
+            if self.token != stale_token and self.valid:
+                return  # Refreshed by another thread while this one waited
+            if self._adopt_stored_token():
+                return
+            super().refresh(request)
+            _save(self.user_id, self)
+            logger.info("Refreshed Google token for user %s", self.user_id)
+
+    def _adopt_stored_token(self):
+        """Take a newer token another process saved, if it isn't about to expire too"""
+        stored = GoogleCredentials.objects.filter(user_id=self.user_id).first()
+        if stored is None or stored.token == self.token or stored.expiry is None:
+            return False
+        expiry = stored.expiry.astimezone(timezone.utc).replace(tzinfo=None)
+        if expiry - _utcnow() < REFRESH_AHEAD:
+            return False
+        self.token, self.expiry = stored.token, expiry
+        return True
+
+
+def _from_model(stored):
+    return StoredCredentials(
+        token=stored.token,
+        refresh_token=stored.refresh_token,
+        token_uri=stored.token_uri,
+        client_id=stored.client_id,
+        client_secret=stored.client_secret,
+        scopes=stored.scopes,
+        expiry=stored.expiry.astimezone(timezone.utc).replace(tzinfo=None) if stored.expiry else None,
+        user_id=stored.user_id,
+    )
+
+
+def _save(user_id, credentials):
+    fields = {
+        'token': credentials.token,
+        'token_uri': credentials.token_uri,
+        'client_id': credentials.client_id,
+        'client_secret': credentials.client_secret,
+        'scopes': list(credentials.scopes or []),
+        'expiry': credentials.expiry.replace(tzinfo=timezone.utc) if credentials.expiry else None,
+    }
+    # Google only sends a refresh token the first time the user consents; keep the one we have
+    if credentials.refresh_token:
+        fields['refresh_token'] = credentials.refresh_token
+    GoogleCredentials.objects.update_or_create(user_id=user_id, defaults=fields)
+
+
+def save_credentials(user, credentials):
+    """Store the credentials a user just granted, replacing any they had
+    except for a refresh token they came without"""
+    _save(user.pk, credentials)
+    with _cache_lock:
+        _cache.pop(user.pk, None)
+
+
+def get_credentials(user_id):
+    """The user's shared credentials, or None if they haven't connected Google"""
+    with _cache_lock:
+        credentials = _cache.get(user_id)
+        if credentials is not None:
+            _cache.move_to_end(user_id)
+
+    if credentials is None:
+        stored = GoogleCredentials.objects.filter(user_id=user_id).first()
+        if stored is None:
+            return None
+        with _cache_lock:
+            credentials = _cache.setdefault(user_id, _from_model(stored))
+            while len(_cache) > CACHE_SIZE:
+                _cache.popitem(last=False)
+
+    # Expired tokens are refreshed by whoever uses them next; these are still good for now
+    if credentials.valid and credentials.expires_soon():
+        refresh_in_background(credentials)
+    return credentials
+
+
+def refresh_in_background(credentials):
+    """Refresh on the background pool unless that is already underway; returns the future or None"""
+    with _cache_lock:
+        if credentials.user_id in _refreshing:
+            return None
+        _refreshing.add(credentials.user_id)
+    return _executor.submit(_background_refresh, credentials)
+
+
+def _background_refresh(credentials):
+    try:
+        credentials.refresh(_http)
+    except Exception as e:
+        logger.warning("Background refresh of Google token for user %s failed: %s", credentials.user_id, e)
+    finally:
+        with _cache_lock:
+            _refreshing.discard(credentials.user_id)
+        connection.close()
+
+
+def reset_credentials_cache():
+    with _cache_lock:
+        _cache.clear()
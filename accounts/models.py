@@ -1,3 +1,22 @@
 from django.db import models
+from django.contrib.auth.models import User
 
-# Create your models here.
+
+class GoogleCredentials(models.Model):
+    """A user's Google OAuth tokens, shared by every request and worker (see credentials.py)"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='google_credentials')
+    token = models.TextField()
+    refresh_token = models.TextField(null=True)
+    token_uri = models.CharField(max_length=255)
+    client_id = models.CharField(max_length=255)
+    client_secret = models.CharField(max_length=255)
+    scopes = models.JSONField(default=list)
+    # When ``token`` stops working; null if Google didn't say
+    expiry = models.DateTimeField(null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = 'Google credentials'
+
+    def __str__(self):
+        return f"Google credentials for {self.user}"
@@ -1,3 +1,322 @@
-from django.test import TestCase
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from unittest import mock
 
-# Create your tests here.
+import requests
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import NameOID
+from django.contrib.auth import authenticate
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.cached_db import SessionStore
+from django.core.cache import caches
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+from google.auth import crypt, jwt
+from google.oauth2.credentials import Credentials
+
+from . import credentials as credential_store
+from .models import GoogleCredentials
+from .tokens import CertificateCache, IdTokenVerifier, MIN_REFRESH_INTERVAL, STALE_GRACE, _max_age
+
+CLIENT_ID = 'client.apps.googleusercontent.com'
+
+
+def make_signing_key(key_id):
+    """A locally generated RSA key: its signer and a self-signed certificate in PEM"""
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, key_id)])
+    now = datetime.now(timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name).issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - timedelta(days=1)).not_valid_after(now + timedelta(days=1))
+        .sign(key, hashes.SHA256())
+    )
+    private_pem = key.private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+    )
+    return crypt.RSASigner.from_string(private_pem, key_id), cert.public_bytes(serialization.Encoding.PEM).decode()
+
+
+class FakeCertsResponse:
+    def __init__(self, certs, headers):
+        self.certs = certs
+        self.headers = headers
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return dict(self.certs)
+
+
+class FakeCertsSession:
+    """Stands in for the pooled ``requests.Session``, serving ``certs``"""
+
+    def __init__(self, certs, cache_control='public, max-age=3600'):
+        self.certs = certs
+        self.headers = {'Cache-Control': cache_control}
+        self.fetches = 0
+        self.delay = 0
+        self.error = None
+
+    def get(self, url, timeout=None):
+        self.fetches += 1
+        time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return FakeCertsResponse(self.certs, self.headers)
+
+
+class IdTokenVerifierTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.signer, cls.cert = make_signing_key('key-1')
+        cls.new_signer, cls.new_cert = make_signing_key('key-2')
+
+    def setUp(self):
+        self.session = FakeCertsSession({'key-1': self.cert})
+        self.verifier = IdTokenVerifier(CertificateCache(session=self.session))
+
+    def token(self, signer=None, **claims):
+        now = int(time.time())
+        payload = {
+            'iss': 'https://accounts.google.com', 'aud': CLIENT_ID, 'iat': now, 'exp': now + 3600,
+            'email': 'alice@example.com', 'name': 'Alice Example',
+        }
+        payload.update(claims)
+        return jwt.encode(signer or self.signer, payload)
+
+    def test_certificates_fetched_once_until_they_expire(self):
+        for _ in range(3):
+            self.assertEqual(self.verifier.verify(self.token(), CLIENT_ID)['email'], 'alice@example.com')
+        self.assertEqual(self.session.fetches, 1)
+
+        later = time.monotonic() + 3601
+        with mock.patch('accounts.tokens.time.monotonic', return_value=later):
+            self.verifier.verify(self.token(), CLIENT_ID)
+        self.assertEqual(self.session.fetches, 2)
+
+    def test_rotated_key_refetched_once(self):
+        self.verifier.verify(self.token(), CLIENT_ID)
+        self.session.certs = {'key-1': self.cert, 'key-2': self.new_cert}
+
+        later = time.monotonic() + MIN_REFRESH_INTERVAL
+        with mock.patch('accounts.tokens.time.monotonic', return_value=later):
+            self.verifier.verify(self.token(self.new_signer), CLIENT_ID)
+        self.assertEqual(self.session.fetches, 2)
+
+    def test_unknown_key_refetches_rate_limited(self):
+        self.verifier.verify(self.token(), CLIENT_ID)
+        for _ in range(3):
+            with self.assertRaises(ValueError):
+                self.verifier.verify(self.token(self.new_signer), CLIENT_ID)
+        self.assertEqual(self.session.fetches, 1)
+
+    def test_concurrent_fetches_single_flighted(self):
+        self.session.delay = 0.05
+        cache = self.verifier.certs
+        threads = [threading.Thread(target=cache.get) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.session.fetches, 1)
+
+    def test_previous_certificates_used_while_refetch_fails(self):
+        start = time.monotonic()
+        self.verifier.verify(self.token(), CLIENT_ID)
+        self.session.error = requests.ConnectionError('unreachable')
+
+        with mock.patch('accounts.tokens.time.monotonic', return_value=start + 3601):
+            self.verifier.verify(self.token(), CLIENT_ID)
+        self.assertEqual(self.session.fetches, 2)
+
+        # Not retried again straight away
+        with mock.patch('accounts.tokens.time.monotonic', return_value=start + 3602):
+            self.verifier.verify(self.token(), CLIENT_ID)
+        self.assertEqual(self.session.fetches, 2)
+
+        with mock.patch('accounts.tokens.time.monotonic', return_value=start + 3601 + STALE_GRACE):
+            with self.assertRaises(requests.ConnectionError):
+                self.verifier.verify(self.token(), CLIENT_ID)
+
+    def test_invalid_tokens_rejected(self):
+        now = int(time.time())
+        for token in (
+            self.token(aud='someone-else'),
+            self.token(iss='https://evil.example.com'),
+            self.token(iat=now - 7200, exp=now - 3600),
+            self.token()[:-4] + b'AAAA',
+        ):
+            with self.assertRaises(ValueError):
+                self.verifier.verify(token, CLIENT_ID)
+
+    def test_cache_lifetime_follows_headers(self):
+        self.assertEqual(_max_age({'Cache-Control': 'public, max-age=20000, must-revalidate'}), 20000)
+        self.assertEqual(_max_age({'Cache-Control': 'max-age=600', 'Age': '100'}), 500)
+        self.assertEqual(_max_age({'Cache-Control': 'no-cache'}), 300)
+
+
+@override_settings(GOOGLE_CLIENT_ID=CLIENT_ID)
+class GoogleAuthBackendTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.signer, cert = make_signing_key('key-1')
+        cls.verifier = IdTokenVerifier(CertificateCache(session=FakeCertsSession({'key-1': cert})))
+
+    def setUp(self):
+        patcher = mock.patch('accounts.tokens.get_id_token_verifier', return_value=self.verifier)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_user_created_from_verified_token(self):
+        now = int(time.time())
+        token = jwt.encode(self.signer, {
+            'iss': 'accounts.google.com', 'aud': CLIENT_ID, 'iat': now, 'exp': now + 3600,
+            'email': 'alice@example.com', 'name': 'Alice Example',
+        })
+        user = authenticate(None, token=token)
+        self.assertEqual((user.username, user.first_name), ('alice@example.com', 'Alice'))
+        self.assertEqual(authenticate(None, token=token), user)
+        self.assertEqual(User.objects.count(), 1)
+
+    def test_invalid_token_not_authenticated(self):
+        self.assertIsNone(authenticate(None, token=jwt.encode(self.signer, {'aud': 'someone-else'})))
+
+
+def utcnow():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class CredentialStoreTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice@example.com', email='alice@example.com')
+        self.addCleanup(credential_store.reset_credentials_cache)
+        self.refreshes = 0
+
+        def refresh(credentials, request):
+            self.refreshes += 1
+            time.sleep(0.05)
+            credentials.token = f'token-{self.refreshes}'
+            credentials.expiry = utcnow() + timedelta(hours=1)
+
+        patcher = mock.patch('google.oauth2.credentials.Credentials.refresh', refresh)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def save(self, expiry):
+        credential_store.save_credentials(self.user, Credentials(
+            token='token-0', refresh_token='refresh', token_uri='https://oauth2.googleapis.com/token',
+            client_id='client', client_secret='secret', scopes=['openid'], expiry=expiry,
+        ))
+
+    def test_one_shared_object_per_user(self):
+        self.save(utcnow() + timedelta(hours=1))
+        credentials = credential_store.get_credentials(self.user.pk)
+        self.assertEqual((credentials.token, credentials.scopes), ('token-0', ['openid']))
+        self.assertIs(credential_store.get_credentials(self.user.pk), credentials)
+        self.assertIsNone(credential_store.get_credentials(self.user.pk + 1))
+
+    def test_concurrent_refreshes_single_flighted_and_saved(self):
+        self.save(utcnow() - timedelta(minutes=1))
+        credentials = credential_store.get_credentials(self.user.pk)
+        self.assertFalse(credentials.valid)
+
+        threads = [threading.Thread(target=credentials.refresh, args=(None,)) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.refreshes, 1)
+        self.assertTrue(credentials.valid)
+        self.assertEqual(GoogleCredentials.objects.get(user=self.user).token, 'token-1')
+
+    def test_token_refreshed_in_background_before_expiry(self):
+        self.save(utcnow() + timedelta(minutes=5))
+        credentials = credential_store.get_credentials(self.user.pk)
+        self.assertEqual(credentials.token, 'token-0')  # Still usable meanwhile
+        # Already underway, so not queued again
+        self.assertIsNone(credential_store.refresh_in_background(credentials))
+
+        deadline = time.monotonic() + 5
+        while GoogleCredentials.objects.get(user=self.user).token == 'token-0' and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(credentials.token, 'token-1')
+        self.assertEqual(GoogleCredentials.objects.get(user=self.user).token, 'token-1')
+        self.assertEqual(self.refreshes, 1)
+
+    def test_token_refreshed_by_another_process_adopted(self):
+        self.save(utcnow() - timedelta(minutes=1))
+        credentials = credential_store.get_credentials(self.user.pk)
+        GoogleCredentials.objects.filter(user=self.user).update(
+            token='elsewhere', expiry=datetime.now(timezone.utc) + timedelta(hours=1)
+        )
+        credentials.refresh(None)
+        self.assertEqual(credentials.token, 'elsewhere')
+        self.assertEqual(self.refreshes, 0)
+
+
+class SessionTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice@example.com', email='alice@example.com')
+        self.addCleanup(caches['sessions'].clear)
+
+    def test_session_loaded_from_cache(self):
+        self.client.force_login(self.user)
+        with self.assertNumQueries(0):
+            self.assertEqual(SessionStore(self.client.session.session_key).load()['_auth_user_id'], str(self.user.pk))
+        # Only the user is looked up
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(reverse('dashboard')).status_code, 200)
+
+    def test_session_survives_cache_eviction(self):
+        self.client.force_login(self.user)
+        caches['sessions'].clear()
+        self.assertEqual(self.client.get(reverse('dashboard')).status_code, 200)
+
+    def test_login_page_leaves_session_alone(self):
+        self.client.get(reverse('login'))
+        self.assertNotIn('oauth_state', self.client.session)
+
+    @override_settings(GOOGLE_CONFIG={'web': {'redirect_uris': ['http://testserver/accounts/google/callback/']}})
+    def google_login(self, token='token', refresh_token='refresh'):
+        credentials = Credentials(
+            token=token, refresh_token=refresh_token, token_uri='https://oauth2.googleapis.com/token',
+            client_id='client', client_secret='secret', scopes=['openid'],
+        )
+        credentials._id_token = 'id-token'
+        flow = mock.Mock(credentials=credentials)
+        with mock.patch('accounts.views.Flow.from_client_config', return_value=flow), \
+                mock.patch('accounts.views.verify_google_id_token', return_value={'email': self.user.email}):
+            response = self.client.get(reverse('google_callback'), {'code': 'code', 'state': 'state'})
+        self.addCleanup(credential_store.reset_credentials_cache)
+        return response
+
+    def test_google_tokens_kept_out_of_session(self):
+        response = self.google_login()
+        self.assertRedirects(response, reverse('dashboard'))
+        self.assertNotIn('google_credentials', self.client.session)
+        self.assertEqual(GoogleCredentials.objects.get(user=self.user).token, 'token')
+
+    def test_later_login_without_refresh_token_keeps_stored_one(self):
+        self.google_login()
+        # Google only returns a refresh token on the first consent
+        self.google_login(token='second', refresh_token=None)
+        stored = GoogleCredentials.objects.get(user=self.user)
+        self.assertEqual((stored.token, stored.refresh_token), ('second', 'refresh'))
+        self.assertEqual(credential_store.get_credentials(self.user.pk).refresh_token, 'refresh')
+
+    def test_logout_keeps_stored_credentials(self):
+        self.google_login()
+        self.client.get(reverse('logout'))
+        self.assertNotIn('_auth_user_id', self.client.session)
+        self.assertEqual(GoogleCredentials.objects.get(user=self.user).refresh_token, 'refresh')
@@ -0,0 +1,151 @@
+"""Google ID token verification with cached signing certificates.
+
+``id_token.verify_oauth2_token`` downloads Google's certificates on every
+call. Here they are kept in memory for as long as Google's Cache-Control
+header allows and fetched over a pooled ``requests`` session, so verifying
+a login token is normally just local signature checking. A token signed
+with a key the cache doesn't know yet (Google rotated its keys) triggers
+one early refetch.
+
+Only one thread fetches at a time, and callers whose certificates are
+still fresh never wait for it. If a refetch fails, the previous
+certificates keep being used for up to ``STALE_GRACE`` seconds past
+their expiry, so a Google outage doesn't stop logins at once.
+"""
+import logging
+import re
+import threading
+import time
+
+import requests
+from django.conf import settings
+from google.auth import jwt
+
+logger = logging.getLogger(__name__)
+
+CERTS_URL = 'https://www.googleapis.com/oauth2/v1/certs'
+ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+
+# Seconds certificates are kept when Google's response doesn't say
+DEFAULT_MAX_AGE = 300
+
+# Least seconds between refetches for unknown key ids, so forged tokens can't hammer Google
+MIN_REFRESH_INTERVAL = 60
+
+# Seconds expired certificates are still used while refetching them fails;
+# failed refetches are retried every MIN_REFRESH_INTERVAL seconds meanwhile
+STALE_GRACE = 3600
+
+HTTP_TIMEOUT = 10
+
+MAX_AGE = re.compile(r'max-age=(\d+)')
+
+
+def _max_age(headers):
+    """Seconds a response may be cached for, going by Cache-Control and Age"""
+    match = MAX_AGE.search(headers.get('Cache-Control', ''))
+    if not match:
+        return DEFAULT_MAX_AGE
+    return max(int(match.group(1)) - int(headers.get('Age', 0) or 0), 0)
+
+
+class CertificateCache:
+    """Google's signing certificates, refetched only once they expire"""
+
+    def __init__(self, url=CERTS_URL, session=None):
+        self.url = url
+        self.session = session or requests.Session()
+        # Guards the fields below; held only to read or replace them
+        self.lock = threading.Lock()
+        # Held by the one thread fetching
+        self.fetch_lock = threading.Lock()
+        self.certs = None
+        self.expires_at = 0
+        self.fetched_at = 0
+        self.retry_at = 0
+
+    def get(self, key_id=None):
+        """The current certificates, by key id.
+
+        Also refetched early if ``key_id`` isn't among them, at most once
+        every ``MIN_REFRESH_INTERVAL`` seconds.
+        """
+        with self.lock:
+            if not self._stale(key_id, time.monotonic()):
+                return self.certs
+
+        with self.fetch_lock:
+            now = time.monotonic()
+            with self.lock:
+                # Fetched by another thread while this one waited
+                if not self._stale(key_id, now):
+                    return self.certs
+            try:
+                return self._fetch(now)
+            except (requests.RequestException, ValueError) as e:
+                with self.lock:
+                    self.retry_at = now + MIN_REFRESH_INTERVAL
+                    if self.certs is None or now >= self.expires_at + STALE_GRACE:
+                        raise
+                    logger.warning("Could not refetch Google signing certificates, using the previous ones: %s", e)
+                    return self.certs
+
+    def _stale(self, key_id, now):
+        if self.certs is None or now >= self.expires_at + STALE_GRACE:
+            return True
+        if now < self.retry_at:
+            return False  # The last refetch failed; keep the previous certificates for now
+        if now >= self.expires_at:
+            return True
+        return key_id is not None and key_id not in self.certs and now - self.fetched_at >= MIN_REFRESH_INTERVAL
+
+    def _fetch(self, now):
+        response = self.session.get(self.url, timeout=HTTP_TIMEOUT)
+        response.raise_for_status()
+        certs = response.json()
+        with self.lock:
+            self.certs = certs
+            self.fetched_at = now
+            self.expires_at = now + _max_age(response.headers)
+        logger.info("Fetched %s Google signing certificates", len(certs))
+        return certs
+
+
+class IdTokenVerifier:
+    def __init__(self, certs=None):
+        self.certs = certs or CertificateCache()
+
+    def verify(self, token, audience, clock_skew_in_seconds=0):
+        """Decode a Google-issued ID token, checking signature, audience, expiry and issuer.
+
+        Raises ValueError if the token isn't valid.
+        """
+        key_id = jwt.decode_header(token).get('kid')
+        idinfo = jwt.decode(
+            token,
+            certs=self.certs.get(key_id),
+            audience=audience,
+            clock_skew_in_seconds=clock_skew_in_seconds,
+        )
+        if idinfo.get('iss') not in ISSUERS:
+            raise ValueError(f"Wrong issuer: {idinfo.get('iss')}")
+        return idinfo
+
+
+_verifier = None
+_verifier_lock = threading.Lock()
+
+
+def get_id_token_verifier():
+    global _verifier
+    with _verifier_lock:
+        if _verifier is None:
+            _verifier = IdTokenVerifier()
+        return _verifier
+
+
+def verify_google_id_token(token, clock_skew_in_seconds=0):
+    """Verify an ID token issued to this app's Google client"""
+    return get_id_token_verifier().verify(
+        token, settings.GOOGLE_CLIENT_ID, clock_skew_in_seconds=clock_skew_in_seconds
+    )
@@ -2,8 +2,6 @@ from django.shortcuts import render, redirect
 from django.contrib.auth import login, authenticate, logout
 from django.conf import settings
 from google_auth_oauthlib.flow import Flow
-from google.oauth2 import id_token
-from google.auth.transport import requests
 from google.auth import exceptions
 import os
 from datetime import datetime, timedelta
@@ -11,7 +9,8 @@ from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.contrib.auth.models import User
 import logging
-import secrets
+from .credentials import save_credentials
+from .tokens import verify_google_id_token
 
 logger = logging.getLogger(__name__)
 
@@ -26,15 +25,6 @@ SCOPES = [
 ]
 
 def login_view(request):
-    # Clear any existing state and ensure a fresh session
-    if 'oauth_state' in request.session:
-        del request.session['oauth_state']
-    
-    # Generate a new state parameter
-    state = secrets.token_urlsafe(32)
-    request.session['oauth_state'] = state
-    request.session.modified = True
-    
     logger.info("Login page accessed")
     return render(request, 'accounts/login.html')
 
@@ -55,7 +45,7 @@ def google_login(request):
         request.session['google_auth_state'] = state
         return redirect(authorization_url)
     except Exception as e:
-        logger.error(f"Google login error: {str(e)}")
+        logger.error("Google login error: %s", e)
         messages.error(request, "Failed to start Google login process")
         return redirect('login')
 
@@ -77,23 +67,8 @@ def google_callback(request):
         
         credentials = flow.credentials
 
-        # Store credentials in session
-        request.session['google_credentials'] = {
-            'token': credentials.token,
-            'refresh_token': credentials.refresh_token,
-            'token_uri': credentials.token_uri,
-            'client_id': credentials.client_id,
-            'client_secret': credentials.client_secret,
-            'scopes': credentials.scopes
-        }
-        
         # Verify token and get user info
-        idinfo = id_token.verify_oauth2_token(
-            credentials.id_token,
-            requests.Request(),
-            settings.GOOGLE_CLIENT_ID,
-            clock_skew_in_seconds=10
-        )
+        idinfo = verify_google_id_token(credentials.id_token, clock_skew_in_seconds=10)
         
         email = idinfo['email']
         first_name = idinfo.get('given_name', '')
@@ -101,17 +76,20 @@ def google_callback(request):
         # Get or create user
         try:
             user = User.objects.get(email=email)
-            logger.info(f"Existing user logged in: {email}")
+            logger.info("Existing user logged in: %s", email)
         except User.DoesNotExist:
             user = User.objects.create_user(
                 username=email,
                 email=email,
                 first_name=first_name
             )
-            logger.info(f"New user created: {email}")
+            logger.info("New user created: %s", email)
         
         login(request, user, backend='django.contrib.auth.backends.ModelBackend')
         
+        # Tokens live in the credential store, not the session
+        save_credentials(user, credentials)
+
         # Initialize Drive connection
         request.session['drive_connected'] = True
         
@@ -119,19 +97,23 @@ def google_callback(request):
         return redirect('dashboard')
         
     except Exception as e:
-        logger.error(f"Authentication error: {str(e)}")
+        logger.error("Authentication error: %s", e)
         messages.error(request, "Authentication failed. Please try again.")
         return redirect('login')
 
 @login_required
 def dashboard(request):
-    logger.info(f"Dashboard accessed by user: {request.user.email}")
+    logger.info("Dashboard accessed by user: %s", request.user.email)
     return render(request, 'accounts/dashboard.html', {
         'user': request.user
     })
 
 def logout_view(request):
-    logger.info(f"Logout initiated for user: {request.user.email}")
+    logger.info("Logout initiated for user: %s", request.user.email)
+    # Only the session ends. The user's stored Google credentials are kept:
+    # queued Drive jobs run with them after the user leaves, and Google only
+    # sends a refresh token on first consent, so the next login needs the
+    # stored one. Deleting the user deletes them.
     logout(request)
     messages.success(request, "You've been successfully logged out!")
     return redirect('home')
\ No newline at end of file
@@ -0,0 +1,159 @@
+"""Helpers shared by the chat benchmark management commands"""
+import asyncio
+import contextlib
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of ``samples`` (``pct`` in 0-100)"""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def summarize(samples):
+    """Latency summary in milliseconds for a list of durations in seconds"""
+    return {
+        'count': len(samples),
+        'p50_ms': round(percentile(samples, 50) * 1000, 3),
+        'p95_ms': round(percentile(samples, 95) * 1000, 3),
+        'p99_ms': round(percentile(samples, 99) * 1000, 3),
+        'max_ms': round(max(samples, default=0.0) * 1000, 3),
+    }
+
+
+@contextlib.contextmanager
+def benchmark_database(on_disk=False):
+    """Run the body against a throwaway test database so seeding never
+    touches the real one.
+
+    SQLite test databases live in memory by default; ``on_disk`` puts them
+    in a temporary file so write benchmarks pay for real fsyncs and locking.
+    """
+    setup_test_environment()
+    test_settings = connection.settings_dict.setdefault('TEST', {})
+    old_test_name = test_settings.get('NAME')
+    tmpdir = None
+    if on_disk and connection.vendor == 'sqlite':
+        tmpdir = tempfile.mkdtemp()
+        test_settings['NAME'] = os.path.join(tmpdir, 'bench.sqlite3')
+
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        test_settings['NAME'] = old_test_name
+        if tmpdir:
+            os.rmdir(tmpdir)
+        teardown_test_environment()
+
+
+def rss_bytes(pid=None):
+    """Resident set size of a process (this one by default), None if unknown"""
+    try:
+        with open(f"/proc/{pid or 'self'}/status") as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class CommunicatorClient:
+    """Drives the ASGI application in-process through WebsocketCommunicator"""
+
+    def __init__(self, application, path):
+        self.communicator = WebsocketCommunicator(application, path)
+
+    async def connect(self):
+        connected, _ = await self.communicator.connect()
+        if not connected:
+            raise RuntimeError('WebSocket connection was rejected')
+
+    async def receive_json(self, timeout=30):
+        return json.loads(await self.communicator.receive_from(timeout=timeout))
+
+    async def send_json(self, data):
+        await self.communicator.send_to(text_data=json.dumps(data))
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class WebsocketsClient:
+    """Talks to a running server over a real socket"""
+
+    def __init__(self, url):
+        self.url = url
+        self.socket = None
+
+    async def connect(self):
+        import websockets
+
+        self.socket = await websockets.connect(self.url, open_timeout=30, max_queue=None)
+
+    async def receive_json(self, timeout=30):
+        return json.loads(await asyncio.wait_for(self.socket.recv(), timeout))
+
+    async def send_json(self, data):
+        await self.socket.send(json.dumps(data))
+
+    async def close(self):
+        await self.socket.close()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30, process=None):
+    """Block until something accepts connections on ``port``; fails early if ``process`` exits"""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline or (process is not None and process.poll() is not None):
+                raise RuntimeError(f'Nothing listening on port {port}')
+            time.sleep(0.1)
+
+
+@contextlib.contextmanager
+def local_server(env=None, startup_timeout=30):
+    """Start a Daphne worker on a free port against a throwaway, migrated
+    SQLite database. Yields ``(base_ws_url, pid)``."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        env = {**os.environ, **(env or {}), 'SQLITE_PATH': os.path.join(tmpdir, 'db.sqlite3')}
+        manage = os.path.join(settings.BASE_DIR, 'manage.py')
+        subprocess.run([sys.executable, manage, 'migrate', '--verbosity=0'], env=env, check=True)
+
+        port = free_port()
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'daphne', '-b', '127.0.0.1', '-p', str(port), 'socialconnect.asgi:application'],
+            env=env, cwd=settings.BASE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_for_port(port, startup_timeout, server)
+            yield f'ws://127.0.0.1:{port}', server.pid
+        finally:
+            server.terminate()
+            server.wait()
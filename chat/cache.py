@@ -0,0 +1,172 @@
+"""Bounded per-room buffers of recent, pre-serialized chat messages.
+
+The buffer is filled from the database the first time a room is asked for
+and then kept current by ``ChatConsumer`` as messages are saved, so history
+on connect is served without touching the database. Entries are stored as
+the JSON strings that go over the wire, so they are never re-serialized.
+
+Backends are pluggable through ``settings.CHAT_RECENT_MESSAGES``:
+``LocalRecentMessages`` keeps a deque per room in this process, while
+``RedisRecentMessages`` shares the buffers between processes.
+"""
+import asyncio
+import json
+import weakref
+from collections import deque
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from . import history
+
+
+def _merge(primed_entries, buffered_entries, size):
+    """Combine a database page with entries appended while it was loading"""
+    by_id = {}
+    for entry in list(primed_entries) + list(buffered_entries):
+        by_id[json.loads(entry)['id']] = entry
+    ordered = sorted(by_id.items(), key=lambda item: (json.loads(item[1])['timestamp'], item[0]))
+    return [entry for _, entry in ordered[-size:]]
+
+
+class BaseRecentMessages:
+    def __init__(self, size):
+        self.size = size
+
+    async def get(self, room):
+        """Buffered entries oldest-first, or None if the room was never filled"""
+        raise NotImplementedError
+
+    async def fill(self, room, entries):
+        """Seed the buffer from the database and return what it now holds"""
+        raise NotImplementedError
+
+    async def append(self, room, entry):
+        raise NotImplementedError
+
+
+class LocalRecentMessages(BaseRecentMessages):
+    """Per-process buffers; every worker fills its own from the database"""
+
+    def __init__(self, size):
+        super().__init__(size)
+        self.buffers = {}
+        self.primed = set()
+
+    def _buffer(self, room):
+        return self.buffers.setdefault(room, deque(maxlen=self.size))
+
+    async def get(self, room):
+        if room not in self.primed:
+            return None
+        return list(self.buffers[room])
+
+    async def fill(self, room, entries):
+        buffer = self._buffer(room)
+        merged = _merge(entries, buffer, self.size)
+        buffer.clear()
+        buffer.extend(merged)
+        self.primed.add(room)
+        return merged
+
+    async def append(self, room, entry):
+        self._buffer(room).append(entry)
+
+
+class RedisRecentMessages(BaseRecentMessages):
+    """Buffers kept in Redis lists so every worker process shares them"""
+
+    def __init__(self, size, url='redis://localhost:6379/0', prefix='chat:recent'):
+        super().__init__(size)
+        self.url = url
+        self.prefix = prefix
+        # redis.asyncio connections are tied to the loop that opened them
+        self._clients = weakref.WeakKeyDictionary()
+
+    def _client(self):
+        import redis.asyncio as redis
+
+        loop = asyncio.get_running_loop()
+        if loop not in self._clients:
+            self._clients[loop] = redis.Redis.from_url(self.url, decode_responses=True)
+        return self._clients[loop]
+
+    def _keys(self, room):
+        key = f"{self.prefix}:{room}"
+        return key, f"{key}:primed"
+
+    async def get(self, room):
+        key, primed_key = self._keys(room)
+        primed, entries = await (
+            self._client().pipeline(transaction=False)
+            .exists(primed_key)
+            .lrange(key, 0, -1)
+            .execute()
+        )
+        return entries if primed else None
+
+    async def fill(self, room, entries):
+        key, primed_key = self._keys(room)
+        client = self._client()
+        merged = _merge(entries, await client.lrange(key, 0, -1), self.size)
+
+        pipeline = client.pipeline(transaction=True).delete(key)
+        if merged:
+            pipeline.rpush(key, *merged)
+        await pipeline.set(primed_key, 1).execute()
+        return merged
+
+    async def append(self, room, entry):
+        key, _ = self._keys(room)
+        await (
+            self._client().pipeline(transaction=True)
+            .rpush(key, entry)
+            .ltrim(key, -self.size, -1)
+            .execute()
+        )
+
+
+_recent_messages = None
+
+
+def get_recent_messages():
+    """The configured recent-messages backend for this process"""
+    global _recent_messages
+    if _recent_messages is None:
+        config = settings.CHAT_RECENT_MESSAGES
+        backend = import_string(config['BACKEND'])
+        _recent_messages = backend(size=settings.CHAT_HISTORY_LIMIT, **config.get('OPTIONS', {}))
+    return _recent_messages
+
+
+def reset_recent_messages():
+    global _recent_messages
+    _recent_messages = None
+
+
+@receiver(setting_changed)
+def _reset_on_setting_change(setting, **kwargs):
+    if setting in ('CHAT_RECENT_MESSAGES', 'CHAT_HISTORY_LIMIT'):
+        reset_recent_messages()
+
+
+async def get_recent_page(room, load_page):
+    """Latest history page for ``room``, filling the buffer via ``load_page`` once.
+
+    ``load_page`` must return a page whose messages are already encoded
+    with ``history.encode_entry``.
+    """
+    recent = get_recent_messages()
+    entries = await recent.get(room)
+    if entries is None:
+        page = await load_page()
+        entries = await recent.fill(room, page['messages'])
+
+    # A full buffer means there may be older messages to scroll back to
+    next_cursor = None
+    if entries and len(entries) >= recent.size:
+        oldest = json.loads(entries[0])
+        next_cursor = history.encode_cursor(oldest['timestamp'], oldest['id'])
+    return {'messages': entries, 'next_cursor': next_cursor}
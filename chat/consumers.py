@@ -1,13 +1,35 @@
 import json
+import logging
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
+from django.conf import settings
 from django.contrib.auth.models import User
-from .models import Message
+from socialconnect.metrics import MetricsConsumerMixin
+from socialconnect.profiling import ProfiledConsumerMixin
+from . import history
+from .cache import get_recent_messages, get_recent_page
+from .models import Message, Room
+from .persistence import get_message_writer
 
-class ChatConsumer(AsyncWebsocketConsumer):
+logger = logging.getLogger(__name__)
+
+# Bump whenever the shape of the history frame changes so chat.js can tell
+# which payload it is rendering.
+HISTORY_VERSION = 1
+
+class ChatConsumer(ProfiledConsumerMixin, MetricsConsumerMixin, AsyncWebsocketConsumer):
     async def connect(self):
-        # Join the chat room group
-        self.room_group_name = 'chat_room'
+        self.room_name = self.scope['url_route']['kwargs'].get('room_name', settings.CHAT_DEFAULT_ROOM)
+        self.room_group_name = None
+        try:
+            # Only signed-in users may bring a new room into existence
+            self.room_id = await self.get_room_id(create=self.scope['user'].is_authenticated)
+        except Room.DoesNotExist:
+            await self.close()
+            return
+
+        # Join the room's group so broadcasts only reach its members
+        self.room_group_name = f'chat_{self.room_name}'
         
         await self.channel_layer.group_add(
             self.room_group_name,
@@ -15,28 +37,32 @@ class ChatConsumer(AsyncWebsocketConsumer):
         )
         
         await self.accept()
-        print(f"WebSocket connected: {self.channel_name}")
+        logger.info("WebSocket connected: %s", self.channel_name)
         
-        # Send previous messages
-        messages = await self.get_messages()
-        for message in messages:
-            await self.send(text_data=json.dumps({
-                'message': message['content'],
-                'user_email': message['sender_email'],
-                'timestamp': message['timestamp']
-            }))
+        # Send previous messages, from the recent-messages buffer once it is filled
+        page = await get_recent_page(self.room_name, self.get_history)
+        await self.send_history(page)
 
     async def disconnect(self, close_code):
+        if self.room_group_name is None:
+            return
+
         # Leave the chat room group
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
-        print(f"WebSocket disconnected: {self.channel_name} with code {close_code}")
+        logger.info("WebSocket disconnected: %s with code %s", self.channel_name, close_code)
 
     async def receive(self, text_data):
         try:
             text_data_json = json.loads(text_data)
+
+            # Scroll-back request for older messages
+            if text_data_json.get('type') == 'history':
+                await self.send_older_history(text_data_json)
+                return
+
             message = text_data_json.get('message', '')
             
             # Get user
@@ -48,7 +74,7 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 await self.save_message(user, message)
             
             # Send message to the chat room group
-            await self.channel_layer.group_send(
+            await self.group_send(
                 self.room_group_name,
                 {
                     'type': 'chat_message',
@@ -62,11 +88,52 @@ class ChatConsumer(AsyncWebsocketConsumer):
                 'error': 'Invalid message format'
             }))
         except Exception as e:
-            print(f"Error in receive: {str(e)}")
+            logger.error("Error in receive: %s", e)
             await self.send(text_data=json.dumps({
                 'error': 'An error occurred processing your message'
             }))
     
+    async def send_history(self, page, before=None):
+        """Replay a history page, batched into versioned frames when enabled.
+
+        Older pages (``before`` set) are always batched: bare message frames
+        would look like new messages to the client.
+
+        ``page['messages']`` holds entries that are already JSON-encoded, so
+        frames are assembled by joining strings rather than re-serializing.
+        """
+        entries = page['messages']
+
+        if before is None and not settings.CHAT_HISTORY_BATCHED:
+            for entry in entries:
+                await self.send(text_data=entry)
+            return
+
+        # Always send at least one frame so the client knows the replay is over
+        chunk_size = max(1, settings.CHAT_HISTORY_CHUNK_SIZE)
+        starts = range(0, len(entries), chunk_size) or [0]
+        for start in starts:
+            envelope = json.dumps({
+                'type': 'history',
+                'version': HISTORY_VERSION,
+                'before': before,
+                'next_cursor': page['next_cursor'],
+                'done': start + chunk_size >= len(entries)
+            }, separators=(',', ':'))
+            chunk = ','.join(entries[start:start + chunk_size])
+            await self.send(text_data=f'{envelope[:-1]},"messages":[{chunk}]}}')
+
+    async def send_older_history(self, request):
+        before = request.get('before')
+        try:
+            page = await self.get_history(before, request.get('limit'))
+        except (TypeError, ValueError):
+            await self.send(text_data=json.dumps({
+                'error': 'Invalid history request'
+            }))
+            return
+        await self.send_history(page, before=before)
+
     # Receive message from the chat room group
     async def chat_message(self, event):
         message = event['message']
@@ -78,18 +145,25 @@ class ChatConsumer(AsyncWebsocketConsumer):
             'user_email': user_email
         }))
     
+    async def save_message(self, user, message):
+        if settings.CHAT_WRITE_BEHIND['ENABLED']:
+            # Batched with other messages; the writer updates the recent-messages buffer
+            await get_message_writer().submit(self.room_id, self.room_name, user, message)
+            return
+
+        saved = await self.create_message(user, message)
+        await get_recent_messages().append(self.room_name, history.encode_saved(saved, user.email))
+
+    @database_sync_to_async
+    def create_message(self, user, message):
+        return Message.objects.create(room_id=self.room_id, sender=user, content=message)
+
     @database_sync_to_async
-    def save_message(self, user, message):
-        return Message.objects.create(sender=user, content=message)
+    def get_room_id(self, create=False):
+        return Room.objects.get_id_for_name(self.room_name, create=create)
     
     @database_sync_to_async
-    def get_messages(self):
-        messages = Message.objects.all().order_by('-timestamp')[:50]
-        return [
-            {
-                'content': message.content,
-                'sender_email': message.sender.email,
-                'timestamp': message.timestamp.isoformat()
-            }
-            for message in reversed(messages)  # Reverse to show oldest first
-        ] 
\ No newline at end of file
+    def get_history(self, before=None, limit=None):
+        page = history.get_page(self.room_id, before=before, limit=int(limit) if limit else None)
+        page['messages'] = [history.encode_entry(entry) for entry in page['messages']]
+        return page
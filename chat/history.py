@@ -0,0 +1,92 @@
+"""Keyset (cursor) pagination over the chat history.
+
+Pages are read newest-first from the ``(room, timestamp, id)`` index and returned
+oldest-first, so the cost of a page is independent of how far back the
+cursor points.
+"""
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+
+from .models import Message
+
+
+def encode_cursor(timestamp, pk):
+    """Opaque cursor pointing just before the given message"""
+    if not isinstance(timestamp, str):
+        timestamp = timestamp.isoformat()
+    raw = f"{timestamp}|{pk}".encode()
+    return base64.urlsafe_b64encode(raw).decode()
+
+
+def decode_cursor(cursor):
+    """Return ``(timestamp, id)`` for a cursor, raising ValueError if it is malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        timestamp, pk = raw.rsplit('|', 1)
+        return datetime.fromisoformat(timestamp), int(pk)
+    except (binascii.Error, UnicodeError, AttributeError, ValueError):
+        raise ValueError(f"Invalid history cursor: {cursor!r}")
+
+
+# Only the columns the wire format needs; the sender email comes from the
+# same joined query instead of one extra lookup per message
+HISTORY_FIELDS = ('id', 'content', 'sender__email', 'timestamp')
+
+
+def serialize_message(row):
+    """Wire format shared by WebSocket history and the HTTP API"""
+    return {
+        'id': row['id'],
+        'message': row['content'],
+        'user_email': row['sender__email'],
+        'timestamp': row['timestamp'].isoformat()
+    }
+
+
+def encode_entry(entry):
+    """Compact JSON for one serialized message, as cached and sent over the wire"""
+    return json.dumps(entry, separators=(',', ':'))
+
+
+def encode_saved(message, sender_email):
+    """Encoded entry for a freshly saved Message without another sender lookup"""
+    return encode_entry(serialize_message({
+        'id': message.id,
+        'content': message.content,
+        'sender__email': sender_email,
+        'timestamp': message.timestamp
+    }))
+
+
+def get_page(room_id, before=None, limit=None):
+    """Fetch one page of a room's history older than ``before`` (or the latest page)"""
+    limit = min(limit or settings.CHAT_HISTORY_LIMIT, settings.CHAT_HISTORY_MAX_PAGE_SIZE)
+
+    queryset = (
+        Message.objects
+        .filter(room_id=room_id)
+        .order_by('-timestamp', '-id')
+        .values(*HISTORY_FIELDS)
+    )
+    if before:
+        timestamp, pk = decode_cursor(before)
+        # Written as a range on the leading index column so the database
+        # can seek straight to the cursor instead of evaluating an OR
+        queryset = queryset.filter(
+            Q(timestamp__lte=timestamp) & ~Q(timestamp=timestamp, id__gte=pk)
+        )
+
+    rows = list(queryset[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()  # Oldest first
+
+    return {
+        'messages': [serialize_message(row) for row in rows],
+        'next_cursor': encode_cursor(rows[0]['timestamp'], rows[0]['id']) if has_more else None
+    }
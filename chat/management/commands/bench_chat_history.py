@@ -0,0 +1,83 @@
+import asyncio
+import json
+import time
+
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+
+from chat.bench import benchmark_database, summarize
+from chat.cache import reset_recent_messages
+from chat.models import Message, Room
+
+
+class Command(BaseCommand):
+    help = "Measure connect-to-first-render latency of the chat history replay with N concurrent clients"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=100, help='Concurrent WebSocket clients')
+        parser.add_argument('--messages', type=int, default=50, help='Messages to seed into the history')
+        parser.add_argument('--mode', choices=['batched', 'legacy', 'both'], default='both')
+
+    def handle(self, *args, **options):
+        from socialconnect.asgi import application
+
+        modes = ['legacy', 'batched'] if options['mode'] == 'both' else [options['mode']]
+        with benchmark_database():
+            self.seed(options['messages'])
+            for mode in modes:
+                # Start cold so every mode pays for one database fill
+                reset_recent_messages()
+                with override_settings(CHAT_HISTORY_BATCHED=(mode == 'batched')):
+                    result = async_to_sync(self.run_clients)(
+                        application, options['clients'], options['messages']
+                    )
+                result['mode'] = mode
+                self.stdout.write(json.dumps(result))
+
+    def seed(self, count):
+        user = User.objects.create_user(username='bench@example.com', email='bench@example.com')
+        room = Room.objects.get(name=settings.CHAT_DEFAULT_ROOM)
+        Message.objects.bulk_create(
+            Message(room=room, sender=user, content=f'benchmark message {i}') for i in range(count)
+        )
+
+    async def run_clients(self, application, clients, expected):
+        started = time.perf_counter()
+        results = await asyncio.gather(*(
+            self.connect_and_render(application, expected) for _ in range(clients)
+        ))
+        elapsed = time.perf_counter() - started
+
+        summary = summarize([latency for latency, _ in results])
+        summary['frames_per_client'] = results[0][1] if results else 0
+        summary['wall_s'] = round(elapsed, 3)
+        return summary
+
+    async def connect_and_render(self, application, expected):
+        """Time from opening the socket until the whole backlog is renderable"""
+        communicator = WebsocketCommunicator(application, '/ws/chat/')
+        started = time.perf_counter()
+        connected, _ = await communicator.connect()
+        if not connected:
+            raise RuntimeError('WebSocket connection was rejected')
+
+        frames = received = 0
+        while True:
+            data = json.loads(await communicator.receive_from(timeout=30))
+            frames += 1
+            if data.get('type') == 'history':
+                received += len(data['messages'])
+                if data['done']:
+                    break
+            else:
+                received += 1
+                if received >= expected:
+                    break
+        latency = time.perf_counter() - started
+
+        await communicator.disconnect()
+        return latency, frames
@@ -0,0 +1,173 @@
+import asyncio
+import json
+import os
+import time
+from datetime import datetime, timezone
+
+from asgiref.sync import async_to_sync
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.bench import (
+    CommunicatorClient, WebsocketsClient, benchmark_database, local_server, rss_bytes, summarize,
+)
+
+# Metrics compared against --baseline and whether bigger numbers are better
+REGRESSION_CHECKS = [
+    (('connect', 'p95_ms'), False),
+    (('fanout', 'p50_ms'), False),
+    (('fanout', 'p95_ms'), False),
+    (('messages_per_s',), True),
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "Load-test ws/chat/ with many concurrent clients and report connect latency, "
+        "broadcast fan-out latency percentiles, messages/sec and RSS per connection as JSON"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clients', type=int, default=1000, help='Concurrent WebSocket clients')
+        parser.add_argument('--senders', type=int, default=10, help='How many of the clients send messages')
+        parser.add_argument('--messages', type=int, default=20, help='Messages sent by each sender')
+        parser.add_argument('--room', default='lobby')
+        parser.add_argument('--connect-concurrency', type=int, default=200,
+                            help='Maximum handshakes in flight at once')
+        parser.add_argument('--timeout', type=float, default=60, help='Seconds to wait for fan-out to finish')
+        target = parser.add_mutually_exclusive_group()
+        target.add_argument('--url', help='Base URL of a running server, e.g. ws://127.0.0.1:8000')
+        target.add_argument('--serve', action='store_true',
+                            help='Start a local Daphne worker on a throwaway database and test it')
+        parser.add_argument('--server-pid', type=int, help='PID of the --url server, to report its RSS')
+        parser.add_argument('--output', help='Write the JSON result to this file')
+        parser.add_argument('--baseline', help='Earlier JSON result to compare against')
+        parser.add_argument('--tolerance', type=float, default=0.25,
+                            help='Allowed relative slowdown against --baseline before failing')
+
+    def handle(self, *args, **options):
+        path = f"/ws/chat/{options['room']}/"
+
+        if options['serve']:
+            with local_server() as (base_url, pid):
+                result = self.run('local-server', lambda: WebsocketsClient(base_url + path), pid, options)
+        elif options['url']:
+            base_url = options['url'].rstrip('/')
+            result = self.run('remote', lambda: WebsocketsClient(base_url + path), options['server_pid'], options)
+        else:
+            from socialconnect.asgi import application
+
+            # Server and clients share this process, so RSS covers both sides
+            with benchmark_database():
+                result = self.run('in-process', lambda: CommunicatorClient(application, path), os.getpid(), options)
+
+        output = json.dumps(result, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as fh:
+                fh.write(output + '\n')
+        self.stdout.write(output)
+
+        if options['baseline']:
+            self.compare(result, options['baseline'], options['tolerance'])
+
+    def run(self, target, make_client, server_pid, options):
+        result = async_to_sync(self.load)(make_client, server_pid, options)
+        result.update({
+            'target': target,
+            'clients': options['clients'],
+            'senders': options['senders'],
+            'messages_per_sender': options['messages'],
+            'recorded_at': datetime.now(timezone.utc).isoformat(),
+        })
+        return result
+
+    async def load(self, make_client, server_pid, options):
+        clients = options['clients']
+        senders = min(options['senders'], clients)
+        per_sender = options['messages']
+        expected = senders * per_sender
+
+        rss_before = rss_bytes(server_pid) if server_pid else None
+
+        # Connect everyone; a client counts as connected once its history
+        # replay is complete, which also means it has joined the room group
+        handshake_slots = asyncio.Semaphore(options['connect_concurrency'])
+        connect_latencies = []
+
+        async def connect():
+            client = make_client()
+            async with handshake_slots:
+                started = time.perf_counter()
+                await client.connect()
+                while True:
+                    frame = await client.receive_json()
+                    if frame.get('type') == 'history' and frame.get('done'):
+                        break
+                connect_latencies.append(time.perf_counter() - started)
+            return client
+
+        connect_started = time.perf_counter()
+        connected = await asyncio.gather(*(connect() for _ in range(clients)))
+        connect_wall = time.perf_counter() - connect_started
+        rss_after = rss_bytes(server_pid) if server_pid else None
+
+        # Every sender's message is broadcast to every client, each stamped
+        # with its send time so receivers can measure fan-out latency
+        fanout_latencies = []
+
+        async def listen(client):
+            received = 0
+            while received < expected:
+                frame = await client.receive_json(timeout=options['timeout'])
+                text = frame.get('message', '')
+                if text.startswith('bench|'):
+                    fanout_latencies.append(time.perf_counter() - float(text.rsplit('|', 1)[1]))
+                    received += 1
+
+        async def send(client, sender):
+            for seq in range(per_sender):
+                await client.send_json({'message': f'bench|{sender}|{seq}|{time.perf_counter()!r}'})
+
+        listeners = [asyncio.ensure_future(listen(client)) for client in connected]
+        started = time.perf_counter()
+        await asyncio.gather(*(send(client, i) for i, client in enumerate(connected[:senders])))
+        done, pending = await asyncio.wait(listeners, timeout=options['timeout'])
+        elapsed = time.perf_counter() - started
+
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*(client.close() for client in connected), return_exceptions=True)
+
+        deliveries = len(fanout_latencies)
+        result = {
+            'connect': summarize(connect_latencies),
+            'connect_wall_s': round(connect_wall, 3),
+            'fanout': summarize(fanout_latencies),
+            'sent': expected,
+            'deliveries': deliveries,
+            'deliveries_expected': expected * clients,
+            'incomplete_clients': len(pending) + sum(1 for task in done if task.exception()),
+            'messages_per_s': round(deliveries / elapsed, 1) if elapsed else 0.0,
+            'rss_per_connection_kb': None,
+        }
+        if rss_before is not None and rss_after is not None:
+            result['rss_per_connection_kb'] = round((rss_after - rss_before) / clients / 1024, 2)
+        return result
+
+    def compare(self, result, baseline_path, tolerance):
+        with open(baseline_path) as fh:
+            baseline = json.load(fh)
+
+        regressions = []
+        for keys, higher_is_better in REGRESSION_CHECKS:
+            current, previous = result, baseline
+            for key in keys:
+                current, previous = current[key], previous[key]
+            if not previous:
+                continue
+            change = (current - previous) / previous
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(f"{'.'.join(keys)}: {previous} -> {current} ({change:+.0%})")
+
+        if regressions:
+            raise CommandError("Performance regressed against baseline:\n" + "\n".join(regressions))
+        self.stdout.write(self.style.SUCCESS("No regressions against baseline"))
@@ -0,0 +1,93 @@
+import asyncio
+import contextlib
+import json
+import time
+
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import override_settings
+
+from chat.bench import benchmark_database
+from chat.models import Message, Room
+from chat.persistence import MessageWriter
+
+
+# SQLite connection settings compared by --sqlite=compare: the library defaults and the tuned ones
+SQLITE_PROFILES = {
+    'default': {'journal_mode': 'DELETE', 'synchronous': 'FULL'},
+    'tuned': {'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'busy_timeout': 5000},
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure sustained chat message writes/second, per-message inserts vs write-behind batching, "
+        "on the configured database (SQLite or PostgreSQL)"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=5000, help='Messages to write per mode')
+        parser.add_argument('--senders', type=int, default=50, help='Concurrent senders')
+        parser.add_argument('--mode', choices=['direct', 'write-behind', 'both'], default='both')
+        parser.add_argument('--in-memory', action='store_true', help='Use an in-memory SQLite database')
+        parser.add_argument(
+            '--sqlite', choices=['configured', 'compare'], default='compare',
+            help='On SQLite, run with SQLITE_PRAGMAS as configured, or with default and tuned pragmas in turn',
+        )
+
+    def handle(self, *args, **options):
+        modes = ['direct', 'write-behind'] if options['mode'] == 'both' else [options['mode']]
+        if connection.vendor == 'sqlite' and options['sqlite'] == 'compare':
+            profiles = SQLITE_PROFILES.items()
+        else:
+            profiles = [('configured', None)]
+
+        for profile, pragmas in profiles:
+            # A fresh database per profile: journal_mode=WAL sticks to the file
+            overridden = override_settings(SQLITE_PRAGMAS=pragmas) if pragmas is not None else contextlib.nullcontext()
+            with overridden, benchmark_database(on_disk=not options['in_memory']):
+                user = User.objects.create_user(username='bench@example.com', email='bench@example.com')
+                room = Room.objects.create(name='bench')
+                for mode in modes:
+                    Message.objects.all().delete()
+                    elapsed = async_to_sync(self.run)(mode, room, user, options['messages'], options['senders'])
+                    self.stdout.write(json.dumps({
+                        'mode': mode,
+                        'database': settings.DATABASES['default']['ENGINE'],
+                        'profile': profile,
+                        'pooled': bool(settings.DATABASES['default'].get('OPTIONS', {}).get('pool')),
+                        'messages': options['messages'],
+                        'senders': options['senders'],
+                        'elapsed_s': round(elapsed, 3),
+                        'messages_per_s': round(options['messages'] / elapsed, 1),
+                    }))
+
+    async def run(self, mode, room, user, total, senders):
+        create = database_sync_to_async(Message.objects.create)
+        config = settings.CHAT_WRITE_BEHIND
+        writer = MessageWriter(
+            batch_size=config['BATCH_SIZE'],
+            flush_interval=config['FLUSH_INTERVAL'],
+            max_pending=config['MAX_PENDING'],
+            retries=config['RETRIES'],
+        )
+
+        async def sender(count):
+            for i in range(count):
+                if mode == 'direct':
+                    await create(room=room, sender=user, content=f'benchmark message {i}')
+                else:
+                    await writer.submit(room.id, room.name, user, f'benchmark message {i}')
+
+        per_sender, remainder = divmod(total, senders)
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            sender(per_sender + (1 if i < remainder else 0)) for i in range(senders)
+        ))
+        # Time until everything is durable, not just queued
+        await writer.close()
+        return time.perf_counter() - started
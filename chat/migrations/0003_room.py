@@ -0,0 +1,51 @@
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def move_messages_to_default_room(apps, schema_editor):
+    Room = apps.get_model('chat', 'Room')
+    Message = apps.get_model('chat', 'Message')
+    room, _ = Room.objects.get_or_create(name=settings.CHAT_DEFAULT_ROOM)
+    Message.objects.filter(room__isnull=True).update(room=room)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_message_timestamp_id_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Room',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.SlugField(unique=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['name'],
+            },
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='room',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='chat.room'),
+        ),
+        # Everything sent before rooms existed belongs to the default room
+        migrations.RunPython(move_messages_to_default_room, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='message',
+            name='room',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='chat.room'),
+        ),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='chat_message_ts_id_idx',
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', 'timestamp', 'id'], name='chat_message_room_ts_id_idx'),
+        ),
+    ]
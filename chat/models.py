@@ -1,13 +1,62 @@
 from django.db import models
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.contrib.auth.models import User
 
+
+class RoomManager(models.Manager):
+    # Room names never change, so name -> id lookups are cached per process
+    # to keep the WebSocket connect path free of database queries. Deleting
+    # a room drops its entry (see _forget_deleted_room below).
+    _ids = {}
+
+    def get_id_for_name(self, name, create=False):
+        if name not in self._ids:
+            if create:
+                room, _ = self.get_or_create(name=name)
+            else:
+                room = self.get(name=name)
+            self._ids[name] = room.id
+        return self._ids[name]
+
+    def forget(self, name):
+        self._ids.pop(name, None)
+
+    def clear_cache(self):
+        self._ids.clear()
+
+
+class Room(models.Model):
+    name = models.SlugField(max_length=50, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    objects = RoomManager()
+
+    class Meta:
+        ordering = ['name']
+
+    def __str__(self):
+        return self.name
+
+
+@receiver(post_delete, sender=Room)
+def _forget_deleted_room(sender, instance, **kwargs):
+    # A room recreated under the same name gets a new id
+    Room.objects.forget(instance.name)
+
+
 class Message(models.Model):
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='messages')
     sender = models.ForeignKey(User, on_delete=models.CASCADE)
     content = models.TextField()
     timestamp = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         ordering = ['timestamp']
+        indexes = [
+            # Backs per-room keyset pagination in chat.history
+            models.Index(fields=['room', 'timestamp', 'id'], name='chat_message_room_ts_id_idx'),
+        ]
         
     def __str__(self):
-        return f"{self.sender.email}: {self.content[:50]}"
\ No newline at end of file
+        return f"{self.sender.email}: {self.content[:50]}"
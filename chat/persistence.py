@@ -0,0 +1,146 @@
+"""Write-behind persistence for chat messages.
+
+Instead of one ``Message.objects.create`` (and one SQLite write transaction)
+per incoming frame, ``ChatConsumer`` hands messages to a ``MessageWriter``
+which saves them with ``bulk_create`` once ``BATCH_SIZE`` messages are
+waiting or ``FLUSH_INTERVAL`` seconds have passed, whichever comes first.
+
+``FLUSH_INTERVAL`` is therefore the window in which an already broadcast
+message may not be on disk yet. ``MAX_PENDING`` bounds memory: when that
+many messages are waiting, senders are held until the next flush. Anything
+still pending when the process exits is written synchronously.
+"""
+import asyncio
+import atexit
+import logging
+import weakref
+from collections import deque, namedtuple
+
+from channels.db import database_sync_to_async
+from django.conf import settings
+
+from . import history
+from .cache import get_recent_messages
+from .models import Message
+
+logger = logging.getLogger(__name__)
+
+PendingMessage = namedtuple('PendingMessage', ['room_id', 'room_name', 'user', 'content'])
+
+
+class MessageWriter:
+    def __init__(self, batch_size=100, flush_interval=0.25, max_pending=5000, retries=3):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.retries = retries
+
+        self._pending = deque()
+        self._has_pending = asyncio.Event()
+        self._batch_ready = asyncio.Event()
+        self._flushed = asyncio.Event()
+        self._lock = asyncio.Lock()
+        self._task = None
+
+    async def submit(self, room_id, room_name, user, content):
+        """Queue a message for saving, waiting for a flush if the queue is full"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+        while len(self._pending) >= self.max_pending:
+            await self._flushed.wait()
+
+        self._pending.append(PendingMessage(room_id, room_name, user, content))
+        self._has_pending.set()
+        if len(self._pending) >= self.batch_size:
+            self._batch_ready.set()
+
+    async def flush(self):
+        """Write everything queued so far, including a batch already in flight"""
+        async with self._lock:
+            try:
+                while self._pending:
+                    batch = [self._pending.popleft() for _ in range(min(self.batch_size, len(self._pending)))]
+                    await self._write(batch)
+            finally:
+                if not self._pending:
+                    self._has_pending.clear()
+                    self._batch_ready.clear()
+                # Wake any sender held back by MAX_PENDING
+                self._flushed.set()
+                self._flushed.clear()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    def drain(self):
+        """Synchronously save whatever is left; used when the process exits"""
+        batch = list(self._pending)
+        self._pending.clear()
+        if batch:
+            Message.objects.bulk_create(self._build(batch))
+
+    async def _run(self):
+        while True:
+            await self._has_pending.wait()
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Chat message flush failed")
+
+    def _build(self, batch):
+        return [Message(room_id=item.room_id, sender=item.user, content=item.content) for item in batch]
+
+    async def _write(self, batch):
+        for attempt in range(self.retries + 1):
+            try:
+                saved = await database_sync_to_async(Message.objects.bulk_create)(self._build(batch))
+                break
+            except Exception:
+                if attempt == self.retries:
+                    logger.exception("Dropping %d chat messages after %d failed writes", len(batch), attempt + 1)
+                    return
+                await asyncio.sleep(self.flush_interval * 2 ** attempt)
+
+        # The messages are saved; a recent-messages cache that is down must not undo that
+        try:
+            recent = get_recent_messages()
+            for item, message in zip(batch, saved):
+                # Backends that cannot return ids from bulk inserts leave pk unset
+                if message.pk is not None:
+                    await recent.append(item.room_name, history.encode_saved(message, item.user.email))
+        except Exception:
+            logger.exception("Could not add %d saved chat messages to the recent-messages cache", len(batch))
+
+
+# One writer per event loop: asyncio primitives cannot be shared across loops
+_writers = weakref.WeakKeyDictionary()
+
+
+def get_message_writer():
+    loop = asyncio.get_running_loop()
+    if loop not in _writers:
+        config = settings.CHAT_WRITE_BEHIND
+        _writers[loop] = MessageWriter(
+            batch_size=config['BATCH_SIZE'],
+            flush_interval=config['FLUSH_INTERVAL'],
+            max_pending=config['MAX_PENDING'],
+            retries=config['RETRIES'],
+        )
+    return _writers[loop]
+
+
+@atexit.register
+def _drain_writers():
+    for writer in list(_writers.values()):
+        try:
+            writer.drain()
+        except Exception:
+            logger.exception("Failed to save pending chat messages on shutdown")
@@ -2,5 +2,7 @@ from django.urls import re_path
 from . import consumers
 
 websocket_urlpatterns = [
-    re_path(r'ws/chat/$', consumers.ChatConsumer.as_asgi()),
+    # Room names double as channel group names, so keep them ASCII
+    re_path(r'ws/chat/(?P<room_name>[-a-zA-Z0-9_]{1,50})/$', consumers.ChatConsumer.as_asgi()),
+    re_path(r'ws/chat/$', consumers.ChatConsumer.as_asgi()),  # Default room
 ] 
\ No newline at end of file
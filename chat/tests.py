@@ -1,3 +1,481 @@
-from django.test import TestCase
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import unittest
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser, User
+from django.conf import settings
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings, tag
+from django.urls import reverse
+
+from socialconnect.asgi import application
+from . import history
+from .bench import free_port, percentile, summarize, wait_for_port
+from .cache import LocalRecentMessages, RedisRecentMessages, reset_recent_messages
+from .consumers import HISTORY_VERSION
+from .models import Message, Room
+from .routing import websocket_urlpatterns
+from .persistence import MessageWriter, PendingMessage, get_message_writer
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+try:
+    import websockets
+except ImportError:
+    websockets = None
+
+
+def reset_chat_state():
+    """Forget process-level caches that would outlive a test's database"""
+    reset_recent_messages()
+    Room.objects.clear_cache()
+
+
+def lobby():
+    return Room.objects.get_or_create(name='lobby')[0]
+
+
+class HistoryReplayTests(TransactionTestCase):
+    def setUp(self):
+        reset_chat_state()
+        self.user = User.objects.create_user(username='alice@example.com', email='alice@example.com')
+        self.room = lobby()
+        self.room_id = self.room.id
+        Message.objects.bulk_create(
+            Message(room=self.room, sender=self.user, content=f'message {i}') for i in range(5)
+        )
+
+    async def receive_json(self, communicator):
+        return json.loads(await communicator.receive_from())
+
+    async def test_history_sent_as_single_batch(self):
+        communicator = WebsocketCommunicator(application, '/ws/chat/')
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+
+        frame = await self.receive_json(communicator)
+        self.assertEqual(frame['type'], 'history')
+        self.assertEqual(frame['version'], HISTORY_VERSION)
+        self.assertTrue(frame['done'])
+        self.assertEqual([m['message'] for m in frame['messages']], [f'message {i}' for i in range(5)])
+        self.assertTrue(await communicator.receive_nothing())
+        await communicator.disconnect()
+
+    @override_settings(CHAT_HISTORY_CHUNK_SIZE=2)
+    async def test_history_split_into_bounded_chunks(self):
+        communicator = WebsocketCommunicator(application, '/ws/chat/')
+        await communicator.connect()
+
+        frames = [await self.receive_json(communicator) for _ in range(3)]
+        self.assertEqual([len(f['messages']) for f in frames], [2, 2, 1])
+        self.assertEqual([f['done'] for f in frames], [False, False, True])
+        await communicator.disconnect()
+
+    async def test_empty_history_still_sends_final_frame(self):
+        await Message.objects.all().adelete()
+        communicator = WebsocketCommunicator(application, '/ws/chat/')
+        await communicator.connect()
+
+        frame = await self.receive_json(communicator)
+        self.assertEqual(frame['messages'], [])
+        self.assertTrue(frame['done'])
+        await communicator.disconnect()
+
+    @override_settings(CHAT_HISTORY_BATCHED=False)
+    async def test_legacy_mode_sends_one_frame_per_message(self):
+        communicator = WebsocketCommunicator(application, '/ws/chat/')
+        await communicator.connect()
+
+        frames = [await self.receive_json(communicator) for _ in range(5)]
+        self.assertEqual(frames[0]['message'], 'message 0')
+        self.assertNotIn('type', frames[0])
+        await communicator.disconnect()
+
+
+class HistoryPaginationTests(TransactionTestCase):
+    def setUp(self):
+        reset_chat_state()
+        self.user = User.objects.create_user(username='alice@example.com', email='alice@example.com')
+        self.room = lobby()
+        self.room_id = self.room.id
+        # bulk_create gives every row the same timestamp, so paging has to
+        # fall back on the id tie-breaker
+        Message.objects.bulk_create(
+            Message(room=self.room, sender=self.user, content=f'message {i}') for i in range(7)
+        )
+
+    def test_pages_walk_backwards_without_gaps_or_duplicates(self):
+        seen = []
+        before = None
+        while True:
+            page = history.get_page(self.room_id, before=before, limit=3)
+            seen = [m['message'] for m in page['messages']] + seen
+            before = page['next_cursor']
+            if before is None:
+                break
+        self.assertEqual(seen, [f'message {i}' for i in range(7)])
+
+    def test_invalid_cursor_rejected(self):
+        with self.assertRaises(ValueError):
+            history.get_page(self.room_id, before='not-a-cursor')
+
+    def test_http_endpoint(self):
+        self.client.force_login(self.user)
+        url = reverse('message_history', kwargs={'room_name': self.room.name})
+        response = self.client.get(url, {'limit': 5})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual(len(data['messages']), 5)
+
+        response = self.client.get(url, {'before': data['next_cursor']})
+        self.assertEqual([m['message'] for m in response.json()['messages']], ['message 0', 'message 1'])
+        self.assertIsNone(response.json()['next_cursor'])
+
+        response = self.client.get(url, {'before': 'garbage'})
+        self.assertEqual(response.status_code, 400)
+
+    async def test_websocket_scroll_back(self):
+        with self.settings(CHAT_HISTORY_LIMIT=4):
+            communicator = WebsocketCommunicator(application, '/ws/chat/')
+            await communicator.connect()
+            initial = json.loads(await communicator.receive_from())
+        self.assertEqual(len(initial['messages']), 4)
+        self.assertIsNone(initial['before'])
+
+        await communicator.send_to(text_data=json.dumps({'type': 'history', 'before': initial['next_cursor']}))
+        older = json.loads(await communicator.receive_from())
+        self.assertEqual(older['before'], initial['next_cursor'])
+        self.assertEqual([m['message'] for m in older['messages']], [f'message {i}' for i in range(3)])
+        self.assertIsNone(older['next_cursor'])
+        await communicator.disconnect()
+
+    @override_settings(CHAT_HISTORY_BATCHED=False, CHAT_HISTORY_CHUNK_SIZE=2, CHAT_HISTORY_LIMIT=2)
+    async def test_websocket_scroll_back_batched_in_legacy_mode(self):
+        communicator = WebsocketCommunicator(application, '/ws/chat/')
+        await communicator.connect()
+        newest = [json.loads(await communicator.receive_from()) for _ in range(2)]
+        self.assertNotIn('type', newest[0])
+
+        cursor = (await sync_to_async(history.get_page)(self.room_id, limit=2))['next_cursor']
+        await communicator.send_to(text_data=json.dumps({'type': 'history', 'before': cursor, 'limit': 5}))
+        frames = [json.loads(await communicator.receive_from()) for _ in range(3)]
+        self.assertEqual({frame['type'] for frame in frames}, {'history'})
+        self.assertEqual([frame['done'] for frame in frames], [False, False, True])
+        self.assertEqual(
+            [m['message'] for frame in frames for m in frame['messages']], [f'message {i}' for i in range(5)]
+        )
+        await communicator.disconnect()
+
+
+class HistoryQueryCountTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.room = room = lobby()
+        senders = [
+            User.objects.create_user(username=f'user{i}@example.com', email=f'user{i}@example.com')
+            for i in range(5)
+        ]
+        Message.objects.bulk_create(
+            Message(room=room, sender=senders[i % len(senders)], content=f'message {i}') for i in range(60)
+        )
+
+    def test_history_page_is_a_single_query(self):
+        with self.assertNumQueries(1):
+            page = history.get_page(self.room.id)
+        self.assertEqual(len(page['messages']), 50)
+        self.assertEqual(page['messages'][-1]['user_email'], 'user4@example.com')
+
+    def test_scroll_back_page_is_a_single_query(self):
+        cursor = history.get_page(self.room.id)['next_cursor']
+        with self.assertNumQueries(1):
+            page = history.get_page(self.room.id, before=cursor)
+        self.assertEqual(len(page['messages']), 10)
+
+
+def entry(pk, timestamp='2025-03-06T13:05:00+00:00'):
+    return history.encode_entry({'id': pk, 'message': f'message {pk}', 'user_email': 'a@example.com', 'timestamp': timestamp})
+
+
+class RecentMessagesTests(TransactionTestCase):
+    def setUp(self):
+        reset_chat_state()
+        self.user = User.objects.create_user(username='alice@example.com', email='alice@example.com')
+        self.room = lobby()
+        self.room_id = self.room.id
+        Message.objects.bulk_create(
+            Message(room=self.room, sender=self.user, content=f'message {i}') for i in range(3)
+        )
+
+    async def connect_and_read_history(self):
+        communicator = WebsocketCommunicator(application, '/ws/chat/')
+        await communicator.connect()
+        frame = json.loads(await communicator.receive_from())
+        await communicator.disconnect()
+        return [m['message'] for m in frame['messages']]
+
+    async def test_history_served_from_buffer_once_filled(self):
+        self.assertEqual(await self.connect_and_read_history(), ['message 0', 'message 1', 'message 2'])
+
+        # The database is no longer consulted for the latest page
+        await Message.objects.all().adelete()
+        self.assertEqual(await self.connect_and_read_history(), ['message 0', 'message 1', 'message 2'])
+
+    async def test_saved_messages_are_appended(self):
+        await self.connect_and_read_history()
+
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/chat/')
+        communicator.scope['user'] = self.user
+        await communicator.connect()
+        await communicator.receive_from()
+        await communicator.send_to(text_data=json.dumps({'message': 'hello'}))
+        await communicator.receive_from()
+        await communicator.disconnect()
+        await get_message_writer().close()
+
+        self.assertEqual((await self.connect_and_read_history())[-1], 'hello')
+
+    async def test_fill_keeps_entries_appended_while_loading(self):
+        recent = LocalRecentMessages(size=3)
+        await recent.append('room', entry(4))
+        self.assertIsNone(await recent.get('room'))
+
+        filled = await recent.fill('room', [entry(2), entry(3), entry(4)])
+        self.assertEqual([json.loads(e)['id'] for e in filled], [2, 3, 4])
+
+        await recent.append('room', entry(5))
+        self.assertEqual([json.loads(e)['id'] for e in await recent.get('room')], [3, 4, 5])
+
+
+class RoomTests(TransactionTestCase):
+    def setUp(self):
+        reset_chat_state()
+        self.user = User.objects.create_user(username='alice@example.com', email='alice@example.com')
+
+    async def connect(self, path, user=None):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), path)
+        communicator.scope['user'] = user or self.user
+        connected, _ = await communicator.connect()
+        return communicator, connected
+
+    async def test_messages_stay_in_their_room(self):
+        general, _ = await self.connect('/ws/chat/general/')
+        random, _ = await self.connect('/ws/chat/random/')
+        await general.receive_from()
+        await random.receive_from()
+
+        await general.send_to(text_data=json.dumps({'message': 'hello general'}))
+        self.assertEqual(json.loads(await general.receive_from())['message'], 'hello general')
+        self.assertTrue(await random.receive_nothing())
+
+        await general.disconnect()
+        await random.disconnect()
+        await get_message_writer().close()
+
+        contents = [m async for m in Message.objects.filter(room__name='general').values_list('content', flat=True)]
+        self.assertEqual(contents, ['hello general'])
+        self.assertFalse(await Message.objects.filter(room__name='random').aexists())
+
+    async def test_anonymous_users_cannot_create_rooms(self):
+        _, connected = await self.connect('/ws/chat/brand-new/', user=AnonymousUser())
+        self.assertFalse(connected)
+        self.assertFalse(await Room.objects.filter(name='brand-new').aexists())
+
+    def test_room_page_and_history_endpoint(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('chat_room', kwargs={'room_name': 'general'}))
+        self.assertContains(response, 'data-room="general"')
+
+        room = Room.objects.get(name='general')
+        Message.objects.create(room=room, sender=self.user, content='in general')
+        response = self.client.get(reverse('message_history', kwargs={'room_name': 'general'}))
+        self.assertEqual([m['message'] for m in response.json()['messages']], ['in general'])
+
+        response = self.client.get(reverse('message_history', kwargs={'room_name': 'missing'}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_room_named_history_reachable(self):
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('chat_room', kwargs={'room_name': 'history'}))
+        self.assertContains(response, 'data-room="history"')
+        response = self.client.get(reverse('message_history', kwargs={'room_name': 'history'}))
+        self.assertEqual(response.json()['messages'], [])
+
+    def test_deleted_room_dropped_from_id_cache(self):
+        old_id = Room.objects.get_id_for_name('general', create=True)
+        Room.objects.get(name='general').delete()
+        with self.assertRaises(Room.DoesNotExist):
+            Room.objects.get_id_for_name('general')
+        self.assertNotEqual(Room.objects.get_id_for_name('general', create=True), old_id)
+
+
+class MessageWriterTests(TransactionTestCase):
+    def setUp(self):
+        reset_chat_state()
+        self.user = User.objects.create_user(username='alice@example.com', email='alice@example.com')
+        self.room_id = lobby().id
+
+    async def test_messages_saved_in_batches(self):
+        writer = MessageWriter(batch_size=3, flush_interval=60)
+        for i in range(3):
+            await writer.submit(self.room_id, 'lobby', self.user, f'message {i}')
+
+        # A full batch is written without waiting for the interval
+        await asyncio.sleep(0.1)
+        self.assertEqual(await Message.objects.acount(), 3)
+
+        # A partial one waits for the interval (or shutdown)
+        for i in range(3, 5):
+            await writer.submit(self.room_id, 'lobby', self.user, f'message {i}')
+        await asyncio.sleep(0.1)
+        self.assertEqual(await Message.objects.acount(), 3)
+
+        await writer.close()
+        contents = [m async for m in Message.objects.order_by('id').values_list('content', flat=True)]
+        self.assertEqual(contents, [f'message {i}' for i in range(5)])
+
+    async def test_partial_batch_flushed_after_interval(self):
+        writer = MessageWriter(batch_size=100, flush_interval=0.05)
+        await writer.submit(self.room_id, 'lobby', self.user, 'hello')
+        await asyncio.sleep(0.2)
+        self.assertEqual(await Message.objects.acount(), 1)
+        await writer.close()
+
+    async def test_full_queue_holds_senders_until_flush(self):
+        writer = MessageWriter(batch_size=100, flush_interval=60, max_pending=2)
+        await writer.submit(self.room_id, 'lobby', self.user, 'one')
+        await writer.submit(self.room_id, 'lobby', self.user, 'two')
+
+        blocked = asyncio.ensure_future(writer.submit(self.room_id, 'lobby', self.user, 'three'))
+        await asyncio.sleep(0.05)
+        self.assertFalse(blocked.done())
+
+        await writer.flush()
+        await asyncio.wait_for(blocked, 1)
+        await writer.close()
+        self.assertEqual(await Message.objects.acount(), 3)
+
+    async def test_cache_failure_does_not_stop_writes(self):
+        writer = MessageWriter(batch_size=1, flush_interval=60, max_pending=1)
+        broken = mock.Mock(append=mock.AsyncMock(side_effect=ConnectionError('cache down')))
+        with mock.patch('chat.persistence.get_recent_messages', return_value=broken), \
+                self.assertLogs('chat.persistence', 'ERROR'):
+            for i in range(3):
+                await asyncio.wait_for(writer.submit(self.room_id, 'lobby', self.user, f'message {i}'), 1)
+            await writer.close()
+        self.assertEqual(await Message.objects.acount(), 3)
+
+    async def test_crashed_flush_task_restarted(self):
+        writer = MessageWriter(batch_size=1, flush_interval=60)
+        with mock.patch.object(writer, '_write', side_effect=RuntimeError('boom')):
+            writer._task = asyncio.get_running_loop().create_task(writer.flush())
+            writer._pending.append(PendingMessage(self.room_id, 'lobby', self.user, 'lost'))
+            with self.assertRaises(RuntimeError):
+                await writer._task
+        await writer.submit(self.room_id, 'lobby', self.user, 'hello')
+        await asyncio.sleep(0.1)
+        self.assertTrue(await Message.objects.filter(content='hello').aexists())
+        await writer.close()
+
+    def test_drain_saves_pending_messages(self):
+        writer = MessageWriter()
+        writer._pending.append(PendingMessage(self.room_id, 'lobby', self.user, 'left over'))
+        writer.drain()
+        self.assertTrue(Message.objects.filter(content='left over').exists())
+
+
+@unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+class RedisRecentMessagesTests(TestCase):
+    async def test_buffer_is_bounded_and_shared(self):
+        server = fakeredis.FakeServer()
+        first, second = RedisRecentMessages(size=2), RedisRecentMessages(size=2)
+        for backend in (first, second):
+            backend._client = lambda: fakeredis.FakeAsyncRedis(server=server, decode_responses=True)
+
+        self.assertIsNone(await first.get('room'))
+        await first.fill('room', [entry(1)])
+        await first.append('room', entry(2))
+        await first.append('room', entry(3))
+
+        self.assertEqual([json.loads(e)['id'] for e in await second.get('room')], [2, 3])
+
+
+class BenchHelpersTests(SimpleTestCase):
+    def test_percentiles_use_nearest_rank(self):
+        samples = [0.001 * i for i in range(1, 101)]
+        self.assertAlmostEqual(percentile(samples, 50), 0.050)
+        self.assertAlmostEqual(percentile(samples, 95), 0.095)
+        self.assertEqual(percentile([], 95), 0.0)
+
+    def test_summary_reports_milliseconds(self):
+        summary = summarize([0.002, 0.004])
+        self.assertEqual(summary['count'], 2)
+        self.assertEqual(summary['max_ms'], 4.0)
+
+
+@tag('integration')
+@unittest.skipIf(fakeredis is None or websockets is None, 'fakeredis and websockets are required')
+class RedisChannelLayerIntegrationTests(SimpleTestCase):
+    """Two Daphne worker processes sharing a Redis channel layer.
+
+    Set TEST_REDIS_URL to run against a real Redis instead of fakeredis.
+    """
+
+    def setUp(self):
+        redis_url = os.getenv('TEST_REDIS_URL')
+        if not redis_url:
+            redis_port = free_port()
+            server = fakeredis.TcpFakeServer(('127.0.0.1', redis_port), server_type='redis')
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.addCleanup(server.server_close)
+            self.addCleanup(server.shutdown)
+            redis_url = f'redis://127.0.0.1:{redis_port}/0'
+
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.env = {
+            **os.environ,
+            'CHANNEL_LAYER': 'redis',
+            'CHANNEL_REDIS_HOSTS': redis_url,
+            'REDIS_URL': redis_url,
+            'SQLITE_PATH': os.path.join(tmpdir.name, 'db.sqlite3'),
+        }
+        manage = os.path.join(settings.BASE_DIR, 'manage.py')
+        subprocess.run([sys.executable, manage, 'migrate', '--verbosity=0'], env=self.env, check=True)
+
+        self.ports = [free_port(), free_port()]
+        for port in self.ports:
+            worker = subprocess.Popen(
+                [sys.executable, '-m', 'daphne', '-b', '127.0.0.1', '-p', str(port), 'socialconnect.asgi:application'],
+                env=self.env, cwd=settings.BASE_DIR,
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            )
+            self.addCleanup(worker.wait)
+            self.addCleanup(worker.terminate)
+        for port in self.ports:
+            wait_for_port(port)
+
+    async def exchange(self):
+        first_port, second_port = self.ports
+        async with websockets.connect(f'ws://127.0.0.1:{first_port}/ws/chat/') as first, \
+                websockets.connect(f'ws://127.0.0.1:{second_port}/ws/chat/') as second:
+            # Both history replays have arrived, so both sockets are in the group
+            await first.recv()
+            await second.recv()
+
+            await first.send(json.dumps({'message': 'across workers'}))
+            return json.loads(await asyncio.wait_for(second.recv(), 10))
+
+    def test_group_messages_cross_worker_processes(self):
+        received = asyncio.run(self.exchange())
+        self.assertEqual(received['message'], 'across workers')
@@ -3,4 +3,6 @@ from . import views
 
 urlpatterns = [
     path('', views.chat_room, name='chat_room'),
-]
\ No newline at end of file
+    path('<slug:room_name>/', views.chat_room, name='chat_room'),
+    path('<slug:room_name>/history/', views.message_history, name='message_history'),
+]
@@ -1,6 +1,45 @@
-from django.shortcuts import render
+from django.conf import settings
+from django.http import Http404, JsonResponse
+from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
+from django.core.validators import validate_slug
+from django.core.exceptions import ValidationError
+from . import history
+from .consumers import HISTORY_VERSION
+from .models import Room
 
 @login_required
-def chat_room(request):
-    return render(request, 'chat/chat_room.html')
\ No newline at end of file
+def chat_room(request, room_name=None):
+    # "Join room" form on the chat page
+    if request.GET.get('room'):
+        try:
+            validate_slug(request.GET['room'])
+        except ValidationError:
+            return redirect('chat_room')
+        return redirect('chat_room', room_name=request.GET['room'])
+
+    room_name = room_name or settings.CHAT_DEFAULT_ROOM
+    if len(room_name) > Room._meta.get_field('name').max_length:
+        raise Http404("Room name too long")
+    Room.objects.get_id_for_name(room_name, create=True)
+    return render(request, 'chat/chat_room.html', {
+        'room_name': room_name,
+        'rooms': Room.objects.values_list('name', flat=True)[:50],
+    })
+
+
+@login_required
+def message_history(request, room_name):
+    """Cursor-paginated chat history: ?before=<next_cursor>&limit=<n>"""
+    try:
+        room_id = Room.objects.get_id_for_name(room_name)
+    except Room.DoesNotExist:
+        return JsonResponse({'error': 'Unknown room'}, status=404)
+
+    try:
+        limit = int(request.GET['limit']) if request.GET.get('limit') else None
+        page = history.get_page(room_id, before=request.GET.get('before'), limit=limit)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid history cursor or limit'}, status=400)
+
+    return JsonResponse({'version': HISTORY_VERSION, **page})
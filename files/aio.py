@@ -0,0 +1,323 @@
+"""Async Drive client for the ASGI deployment.
+
+Talks to the Drive REST API with httpx instead of googleapiclient, so list,
+metadata, download and upload calls await on the event loop instead of
+holding a worker thread each. Every event loop shares one pooled
+keep-alive ``httpx.AsyncClient``.
+
+The metadata cache (see metadata.py) is kept in step the same way as on the
+sync path; only its database work runs in a thread.
+"""
+import asyncio
+import logging
+import random
+import weakref
+
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from google.auth.transport.requests import Request as GoogleAuthRequest
+
+from . import metadata
+from .models import DriveSyncState
+from .uploads import upload_chunk_size
+from .downloads import MEDIA_OPERATION
+from .utils import DRIVE_REQUEST_SECONDS, get_user_credentials
+
+logger = logging.getLogger(__name__)
+
+API_ROOT = 'https://www.googleapis.com/drive/v3'
+UPLOAD_ROOT = 'https://www.googleapis.com/upload/drive/v3'
+
+# Statuses worth retrying with backoff
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# httpx connections are tied to the loop that opened them
+_clients = weakref.WeakKeyDictionary()
+
+
+class DriveError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"Drive returned {status}: {message}")
+        self.status = status
+
+
+def get_http_client():
+    """The pooled HTTP client for the running event loop"""
+    loop = asyncio.get_running_loop()
+    if loop not in _clients:
+        _clients[loop] = httpx.AsyncClient(
+            timeout=settings.DRIVE_HTTP_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=settings.DRIVE_ASYNC_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.DRIVE_ASYNC_MAX_CONNECTIONS,
+            ),
+        )
+    return _clients[loop]
+
+
+async def get_async_drive(request):
+    """An AsyncDrive for the signed-in user, or None without stored credentials"""
+    credentials = await sync_to_async(get_user_credentials)(request)
+    if not credentials:
+        return None
+    return AsyncDrive(credentials)
+
+
+def _backoff(attempt):
+    return min(2 ** attempt, 30) * random.uniform(0.5, 1)
+
+
+def _error_message(response):
+    try:
+        return response.json()['error']['message']
+    except (ValueError, KeyError, TypeError):
+        return response.text[:200]
+
+
+class AsyncDrive:
+    """The Drive v3 calls the files app makes, awaitable"""
+
+    def __init__(self, credentials, http=None):
+        self.credentials = credentials
+        self.http = http or get_http_client()
+
+    async def _auth_headers(self, refresh=False):
+        if refresh or not self.credentials.valid:
+            # google-auth only refreshes synchronously; this is rare, so a thread is
+            # fine. Shared credentials save the new token, so it has to be a thread
+            # Django manages the database connection of.
+            await sync_to_async(self.credentials.refresh)(GoogleAuthRequest())
+        return {'Authorization': f'Bearer {self.credentials.token}'}
+
+    async def request(self, method, url, params=None, headers=None, stream=False, operation='drive', **kwargs):
+        """Send a request, retrying transient failures and refreshing an expired token once.
+
+        ``operation`` names the API method in the Drive request timings.
+        """
+        params = {key: value for key, value in (params or {}).items() if value is not None}
+        refreshed = False
+        attempt = 0
+        while True:
+            auth = await self._auth_headers(refresh=refreshed)
+            request = self.http.build_request(method, url, params=params, headers={**auth, **(headers or {})}, **kwargs)
+            with DRIVE_REQUEST_SECONDS.time(operation=operation):
+                response = await self.http.send(request, stream=stream)
+            if response.status_code == 401 and not refreshed:
+                await response.aclose()
+                refreshed = True
+                continue
+            if response.status_code in RETRY_STATUSES and attempt < settings.DRIVE_NUM_RETRIES:
+                await response.aclose()
+                await asyncio.sleep(_backoff(attempt))
+                attempt += 1
+                continue
+            if response.status_code >= 400:
+                await response.aread()
+                await response.aclose()
+                raise DriveError(response.status_code, _error_message(response))
+            return response
+
+    async def get_json(self, url, params=None, operation='drive'):
+        response = await self.request('GET', url, params=params, operation=operation)
+        return response.json()
+
+    async def list_files(self, page_token=None):
+        return await self.get_json(f'{API_ROOT}/files', metadata.list_params(page_token), 'drive.files.list')
+
+    async def iter_pages(self):
+        """Yield pages of the user's files, newest first, fetching each when needed"""
+        page_token = None
+        while True:
+            response = await self.list_files(page_token)
+            yield response.get('files', [])
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return
+
+    async def get_start_page_token(self):
+        response = await self.get_json(f'{API_ROOT}/changes/startPageToken', operation='drive.changes.getStartPageToken')
+        return response['startPageToken']
+
+    async def list_changes(self, page_token):
+        return await self.get_json(f'{API_ROOT}/changes', metadata.changes_params(page_token), 'drive.changes.list')
+
+    async def get_metadata(self, file_id, fields=metadata.FILE_FIELDS):
+        return await self.get_json(f'{API_ROOT}/files/{file_id}', {'fields': fields}, 'drive.files.get')
+
+    async def open_media(self, file_id, export_type=None, byte_range=None):
+        """Start a media download, of bytes ``first`` to ``last`` only with ``byte_range``.
+
+        The returned response's body has not been read yet.
+        """
+        if export_type:
+            url, params = f'{API_ROOT}/files/{file_id}/export', {'mimeType': export_type}
+            operation = 'drive.files.export'
+        else:
+            url, params = f'{API_ROOT}/files/{file_id}', {'alt': 'media'}
+            operation = MEDIA_OPERATION
+        headers = {'Range': 'bytes={}-{}'.format(*byte_range)} if byte_range else None
+        return await self.request('GET', url, params=params, headers=headers, stream=True, operation=operation)
+
+    @staticmethod
+    async def iter_body(response, chunk_size=None):
+        """Yield a streamed response's body in chunks, closing it afterwards"""
+        try:
+            async for chunk in response.aiter_bytes(chunk_size or settings.DRIVE_DOWNLOAD_CHUNK_SIZE):
+                yield chunk
+        finally:
+            await response.aclose()
+
+    async def upload(self, uploaded_file, fields='id, name, webViewLink', progress=None):
+        """Upload a Django ``UploadedFile`` through a resumable session.
+
+        Mirrors ``uploads.upload_to_drive``: chunks of ``DRIVE_UPLOAD_CHUNK_SIZE``,
+        and transient failures resume from the last byte Drive acknowledged,
+        up to ``DRIVE_UPLOAD_MAX_RESUMES`` times in a row.
+        """
+        total = uploaded_file.size
+        mime_type = uploaded_file.content_type or 'application/octet-stream'
+        response = await self.request(
+            'POST', f'{UPLOAD_ROOT}/files',
+            params={'uploadType': 'resumable', 'fields': fields},
+            headers={'X-Upload-Content-Type': mime_type, 'X-Upload-Content-Length': str(total)},
+            json={'name': uploaded_file.name},
+            operation='drive.files.create',
+        )
+        session = response.headers['location']
+
+        read = sync_to_async(uploaded_file.read, thread_sensitive=False)
+        offset = 0
+        resumes = 0
+        while True:
+            uploaded_file.seek(offset)
+            data = await read(upload_chunk_size())
+            content_range = f'bytes {offset}-{offset + len(data) - 1}/{total}' if data else f'bytes */{total}'
+            try:
+                with DRIVE_REQUEST_SECONDS.time(operation='drive.files.create'):
+                    response = await self.http.put(session, content=data, headers={'Content-Range': content_range})
+                if response.status_code not in RETRY_STATUSES:
+                    done, result = self._upload_state(response)
+                    if done:
+                        return result
+                    offset, resumes = result, 0
+                    if progress:
+                        progress(offset, total)
+                    continue
+                error = DriveError(response.status_code, _error_message(response))
+            except httpx.TransportError as e:
+                error = e
+
+            if resumes >= settings.DRIVE_UPLOAD_MAX_RESUMES:
+                raise error
+            resumes += 1
+            logger.warning("Resuming upload of %s after error: %s", uploaded_file.name, error)
+            await asyncio.sleep(_backoff(resumes))
+            # Ask Drive how much it already has, then carry on from there
+            try:
+                response = await self.http.put(session, headers={'Content-Range': f'bytes */{total}'})
+            except httpx.TransportError:
+                continue
+            if response.status_code in RETRY_STATUSES:
+                continue
+            done, result = self._upload_state(response)
+            if done:
+                return result
+            offset = result
+
+    async def upload_files(self, uploaded_files, fields='id, name, webViewLink'):
+        """Upload several files concurrently, ``DRIVE_TRANSFER_WORKERS`` at a time.
+
+        Returns ``(uploaded_file, result)`` pairs like ``uploads.upload_files``.
+        """
+        slots = asyncio.Semaphore(settings.DRIVE_TRANSFER_WORKERS)
+
+        async def upload(uploaded_file):
+            async with slots:
+                return await self.upload(uploaded_file, fields=fields)
+
+        results = await asyncio.gather(*(upload(f) for f in uploaded_files), return_exceptions=True)
+        return list(zip(uploaded_files, results))
+
+    @staticmethod
+    def _upload_state(response):
+        """``(True, file)`` once an upload is complete, else ``(False, next offset)``"""
+        if response.status_code in (200, 201):
+            return True, response.json()
+        if response.status_code == 308:
+            received = response.headers.get('range')
+            return False, int(received.rpartition('-')[2]) + 1 if received else 0
+        raise DriveError(response.status_code, _error_message(response))
+
+
+# Metadata cache, kept in step as metadata.sync does
+
+async def full_sync_pages(drive, user):
+    """Re-list the user's files, storing and yielding each page as it arrives"""
+    page_token = await drive.get_start_page_token()
+    seen = set()
+    async for page in drive.iter_pages():
+        await sync_to_async(metadata.store_page)(user, page, seen)
+        yield page
+    await sync_to_async(metadata.finish_full_sync)(user, page_token, seen)
+
+
+async def apply_changes(drive, user, state):
+    page_token = state.page_token
+    updated, removed = {}, set()
+    while True:
+        response = await drive.list_changes(page_token)
+        metadata.merge_changes(response, updated, removed)
+        if 'newStartPageToken' in response:
+            return await sync_to_async(metadata.save_changes)(
+                user, state, updated, removed, response['newStartPageToken']
+            )
+        page_token = response['nextPageToken']
+
+
+async def sync(drive, user, max_age=None):
+    """Async counterpart of ``metadata.sync``"""
+    state = await DriveSyncState.objects.filter(user=user).afirst()
+    if state is None:
+        return sum([len(page) async for page in full_sync_pages(drive, user)])
+    if metadata.is_fresh(state, max_age):
+        return 0
+
+    try:
+        return await apply_changes(drive, user, state)
+    except DriveError as e:
+        if e.status not in metadata.EXPIRED_TOKEN_STATUSES:
+            raise
+        logger.warning("Drive change token rejected (%s), re-listing files", e.status)
+        return sum([len(page) async for page in full_sync_pages(drive, user)])
+
+
+async def refresh(drive, user):
+    return await sync(drive, user, max_age=metadata.sync_interval())
+
+
+async def iter_files(drive, user, offset=0):
+    """Async counterpart of ``metadata.iter_files``"""
+    if await DriveSyncState.objects.filter(user=user).aexists():
+        await refresh(drive, user)
+        async for file in metadata.cached_files(user)[offset:].aiterator(chunk_size=metadata.ITERATOR_CHUNK_SIZE):
+            yield file
+        return
+
+    skipped = 0
+    async for page in full_sync_pages(drive, user):
+        for file in page:
+            if skipped < offset:
+                skipped += 1
+            else:
+                yield file
+
+
+async def get_file_metadata(drive, user, file_id):
+    """Async counterpart of ``metadata.get_file_metadata``"""
+    await refresh(drive, user)
+    file = await metadata.cached_files(user).filter(file_id=file_id).afirst()
+    if file is None:
+        file = await drive.get_metadata(file_id)
+        await sync_to_async(metadata.store_file)(user, file)
+    return file
@@ -0,0 +1,158 @@
+"""Async variants of the Drive listing, download and upload views.
+
+Routed instead of their counterparts in views.py when ``DRIVE_ASYNC_IO`` is
+set. They await Drive over the pooled httpx client in aio.py, so under ASGI
+a slow listing or a long transfer does not tie up a worker thread.
+"""
+import logging
+
+from asgiref.sync import sync_to_async
+from django.contrib import messages
+from django.contrib.auth.decorators import login_required
+from django.http import JsonResponse, StreamingHttpResponse
+from django.shortcuts import redirect, render
+from django.utils.http import content_disposition_header
+
+from . import aio, metadata
+from .content_cache import content_key, file_response, get_content_cache
+from .downloads import (
+    conditional_response, range_not_satisfiable, requested_range, set_content_range, set_validators,
+)
+from .listing import async_streaming_list_response, list_row
+from .views import _page_params, _report_uploads
+
+logger = logging.getLogger(__name__)
+
+
+@login_required
+async def upload_file(request):
+    """Handle file uploads to Google Drive; several files are uploaded concurrently"""
+    logger.info("Starting file upload process")
+    uploaded_files = []
+    if request.method == 'POST':
+        # Parsing the multipart body reads spooled files, so keep it off the loop
+        uploaded_files = await sync_to_async(request.FILES.getlist, thread_sensitive=False)('file')
+
+    if uploaded_files:
+        try:
+            logger.info("Processing upload: %s", ', '.join(f.name for f in uploaded_files))
+
+            drive = await aio.get_async_drive(request)
+            if not drive:
+                logger.error("Drive service unavailable")
+                messages.error(request, "Drive service not available. Please reconnect.")
+                return redirect('drive_home')
+
+            results = await drive.upload_files(uploaded_files, fields=metadata.FILE_FIELDS)
+            await sync_to_async(_report_uploads)(request, uploaded_files, results)
+            return redirect('drive_home')
+
+        except Exception as e:
+            logger.error("Upload error: %s", e)
+            messages.error(request, "Upload failed. Please try again.")
+            return redirect('drive_home')
+
+    return await sync_to_async(render)(request, 'files/upload.html')
+
+
+@login_required
+async def file_list_data(request):
+    """Paginated file listing as JSON: ?offset=<next_offset>&limit=<n>"""
+    try:
+        offset, limit = _page_params(request)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid offset or limit'}, status=400)
+
+    drive = await aio.get_async_drive(request)
+    if not drive:
+        return JsonResponse({'error': 'Drive service not available'}, status=401)
+
+    user = await request.auser()
+    try:
+        await aio.refresh(drive, user)
+        page = [list_row(file) async for file in metadata.cached_files(user)[offset:offset + limit + 1]]
+    except Exception as e:
+        logger.error("Error fetching files: %s", e)
+        return JsonResponse({'error': 'Failed to fetch files'}, status=502)
+
+    next_offset = offset + limit if len(page) > limit else None
+    return JsonResponse({'files': page[:limit], 'next_offset': next_offset})
+
+
+@login_required
+async def file_list_stream(request):
+    """Every file after ?offset=<n> as a stream of NDJSON rows"""
+    try:
+        offset, _ = _page_params(request)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid offset'}, status=400)
+
+    drive = await aio.get_async_drive(request)
+    if not drive:
+        return JsonResponse({'error': 'Drive service not available'}, status=401)
+
+    try:
+        return await async_streaming_list_response(aio.iter_files(drive, await request.auser(), offset))
+    except Exception as e:
+        logger.error("Error streaming files: %s", e)
+        return JsonResponse({'error': 'Failed to fetch files'}, status=502)
+
+
+@login_required
+async def download_file(request, file_id):
+    """Download files from Google Drive"""
+    logger.info("Initiating download for file: %s", file_id)
+
+    try:
+        drive = await aio.get_async_drive(request)
+
+        if not drive:
+            logger.warning("Drive service not available")
+            messages.error(request, "Please connect to Google Drive first")
+            return redirect('file_list')
+
+        file_metadata = await aio.get_file_metadata(drive, await request.auser(), file_id)
+        file_name = file_metadata.get('name', 'downloaded_file')
+        mime_type = file_metadata.get('mimeType', 'application/octet-stream')
+
+        # The browser may already hold this version, or part of it
+        not_modified = conditional_response(request, file_metadata)
+        if not_modified:
+            return not_modified
+        try:
+            byte_range = requested_range(request, file_metadata)
+        except ValueError:
+            return range_not_satisfiable(file_metadata)
+
+        cache = get_content_cache()
+        cache_key = content_key(file_metadata) if cache and cache.cacheable(file_metadata) else None
+        if cache_key and (path := cache.get(cache_key)):
+            logger.info("Download served from the content cache")
+            response = await sync_to_async(file_response, thread_sensitive=False)(
+                request, path, file_name, mime_type, byte_range
+            )
+            set_validators(response, file_metadata)
+            return response
+
+        try:
+            # Opened before responding so a Drive error can still redirect
+            media = await drive.open_media(file_id, byte_range=byte_range)
+        except Exception as download_error:
+            logger.error("Download error: %s", download_error)
+            messages.error(request, "Download failed. Please try again.")
+            return redirect('file_list')
+
+        body = drive.iter_body(media)
+        if cache_key and not byte_range:
+            body = cache.atee(cache_key, body, file_metadata['size'])
+        response = StreamingHttpResponse(body, content_type=mime_type)
+        response['Content-Disposition'] = content_disposition_header(True, file_name)
+        set_content_range(response, byte_range, file_metadata.get('size'))
+        set_validators(response, file_metadata)
+        logger.info("Download streaming started")
+        return response
+
+    except Exception as e:
+        logger.error("File access error: %s", e)
+        messages.error(request, "Failed to access file. Please try again.")
+        return redirect('file_list')
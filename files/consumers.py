@@ -0,0 +1,40 @@
+import asyncio
+import json
+
+from asgiref.sync import sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer
+from socialconnect.metrics import MetricsConsumerMixin
+
+from . import jobs
+
+
+class DriveJobConsumer(MetricsConsumerMixin, AsyncWebsocketConsumer):
+    """Pushes the signed-in user's background transfer progress"""
+
+    async def connect(self):
+        user = self.scope['user']
+        self.group_name = None
+        if not user.is_authenticated:
+            await self.close()
+            return
+
+        # Job events for this process's sockets are sent from this loop
+        jobs.bind_listener_loop(asyncio.get_running_loop())
+        self.group_name = jobs.job_group(user.pk)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.accept()
+
+        # Current state first, so a reconnecting page catches up
+        user_jobs = await sync_to_async(jobs.get_job_runner().store.for_user)(user.pk)
+        await self.send(text_data=json.dumps({
+            'type': 'jobs',
+            'jobs': [jobs.public_job(job) for job in user_jobs]
+        }))
+
+    async def disconnect(self, close_code):
+        if self.group_name is None:
+            return
+        await self.channel_layer.group_discard(self.group_name, self.channel_name)
+
+    async def job_update(self, event):
+        await self.send(text_data=json.dumps({'type': 'job', 'job': event['job']}))
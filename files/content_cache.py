@@ -0,0 +1,226 @@
+"""On-disk cache of downloaded Drive file contents.
+
+Entries are addressed by file id plus the file's version (``md5Checksum``,
+or ``modifiedTime`` for files Drive doesn't checksum), both taken from the
+metadata cache. Revalidating an entry therefore costs no more than the
+metadata lookup a download already makes: when the file changes on Drive,
+its key changes and the old entry is simply never asked for again.
+
+A miss is streamed to the client as usual while a copy is written beside
+the cache; the copy becomes an entry only once the whole file arrived.
+Hits are served from disk, whole or in part. Once the cache grows past
+``DRIVE_CONTENT_CACHE['MAX_SIZE']`` bytes, the least recently served
+entries are deleted. Each process keeps a running total of the bytes it
+knows about and only rescans the directory when that goes over the limit,
+which is also when entries other processes added are counted.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.http import FileResponse
+from django.utils.http import content_disposition_header
+
+from .downloads import set_content_range
+
+logger = logging.getLogger(__name__)
+
+# Bytes read from an entry at a time when it is served under ASGI
+READ_SIZE = 256 * 1024
+
+PART_SUFFIX = '.part'
+
+
+def content_key(file):
+    """Cache key for a file's current contents, or None if its version is unknown"""
+    version = file.get('md5Checksum') or file.get('modifiedTime')
+    if not file.get('id') or not version:
+        return None
+    return hashlib.sha256(f"{file['id']}\0{version}".encode()).hexdigest()
+
+
+class _FileSlice:
+    """Read-only view of ``length`` bytes of an open file from its current position.
+
+    Keeps ``fileno`` so WSGI servers can still hand the range to sendfile.
+    """
+
+    def __init__(self, fh, length):
+        self.fh = fh
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fh.read(size)
+        self.remaining -= len(data)
+        return data
+
+    def fileno(self):
+        return self.fh.fileno()
+
+    def close(self):
+        self.fh.close()
+
+
+async def _aiter_file(body):
+    read = sync_to_async(body.read, thread_sensitive=False)
+    try:
+        while chunk := await read(READ_SIZE):
+            yield chunk
+    finally:
+        body.close()
+
+
+class ContentCache:
+    def __init__(self, directory, max_size, max_file_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_file_size = min(max_file_size, max_size)
+        # Bytes in the cache as of the last scan plus entries added since; None until the first scan
+        self._size = None
+        self._size_lock = threading.Lock()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def cacheable(self, file):
+        size = file.get('size')
+        return size is not None and int(size) <= self.max_file_size
+
+    def get(self, key):
+        """Path of the entry for ``key``, marked as just used, or None"""
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def _open_part(self, key):
+        directory = os.path.dirname(self.path(key))
+        os.makedirs(directory, exist_ok=True)
+        fd, part = tempfile.mkstemp(dir=directory, prefix=key, suffix=PART_SUFFIX)
+        return os.fdopen(fd, 'wb'), part
+
+    def _finish(self, key, part, size, complete):
+        if complete and os.path.getsize(part) == int(size):
+            os.replace(part, self.path(key))
+            self._added(int(size))
+        else:
+            os.remove(part)
+
+    def tee(self, key, chunks, size):
+        """Pass ``chunks`` through, storing them as the entry for ``key`` if all ``size`` bytes arrive"""
+        fh, part = self._open_part(key)
+        complete = False
+        try:
+            with fh:
+                for chunk in chunks:
+                    fh.write(chunk)
+                    yield chunk
+            complete = True
+        finally:
+            self._finish(key, part, size, complete)
+
+    async def atee(self, key, chunks, size):
+        """``tee`` for an async iterable of chunks"""
+        fh, part = await sync_to_async(self._open_part, thread_sensitive=False)(key)
+        write = sync_to_async(fh.write, thread_sensitive=False)
+        complete = False
+        try:
+            async for chunk in chunks:
+                await write(chunk)
+                yield chunk
+            complete = True
+        finally:
+            fh.close()
+            await sync_to_async(self._finish, thread_sensitive=False)(key, part, size, complete)
+
+    def _added(self, size):
+        with self._size_lock:
+            if self._size is not None:
+                self._size += size
+                if self._size <= self.max_size:
+                    return
+        self.evict()
+
+    def evict(self):
+        """Delete the least recently used entries until the cache fits in ``max_size``"""
+        entries = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith(PART_SUFFIX):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            logger.info("Evicted %s from the Drive content cache", path)
+        with self._size_lock:
+            self._size = total
+
+
+def file_response(request, path, file_name, mime_type, byte_range=None):
+    """Serve a cached file, or bytes ``first`` to ``last`` of it.
+
+    Under WSGI the open file goes to ``FileResponse`` so the server can use
+    sendfile; under ASGI it is read in a worker thread, chunk by chunk.
+    """
+    fh = open(path, 'rb')
+    size = os.fstat(fh.fileno()).st_size
+    first, last = byte_range or (0, size - 1)
+    fh.seek(first)
+    body = _FileSlice(fh, last - first + 1)
+
+    response = FileResponse(_aiter_file(body) if isinstance(request, ASGIRequest) else body, content_type=mime_type)
+    response['Content-Disposition'] = content_disposition_header(True, file_name)
+    set_content_range(response, byte_range, size)
+    return response
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_content_cache():
+    """This process's content cache, or None if ``DRIVE_CONTENT_CACHE`` disables it"""
+    global _cache
+    config = settings.DRIVE_CONTENT_CACHE
+    if not config['MAX_SIZE']:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = ContentCache(config['DIR'], config['MAX_SIZE'], config['MAX_FILE_SIZE'])
+        return _cache
+
+
+def reset_content_cache():
+    global _cache
+    with _cache_lock:
+        _cache = None
+
+
+@receiver(setting_changed)
+def _reset_on_setting_change(setting, **kwargs):
+    if setting == 'DRIVE_CONTENT_CACHE':
+        reset_content_cache()
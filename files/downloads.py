@@ -0,0 +1,317 @@
+"""Streaming Google Drive downloads.
+
+Media is fetched from Drive in ``DRIVE_DOWNLOAD_CHUNK_SIZE`` ranged requests
+and each chunk is handed to the client as soon as it arrives, so memory per
+download is bounded by the chunk size rather than the file size.
+
+Several files can be downloaded as one ZIP archive that is written while it
+streams: files are fetched concurrently and the archive is never held in
+memory or on disk as a whole.
+"""
+import io
+import itertools
+import logging
+import queue
+import re
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.dateparse import parse_datetime
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe, quote_etag
+from googleapiclient.http import HttpRequest, MediaIoBaseDownload
+
+from .utils import DRIVE_REQUEST_SECONDS, clone_drive_service, private_transport
+
+logger = logging.getLogger(__name__)
+
+# Chunks fetched ahead per file while an archive is being written
+ARCHIVE_PREFETCH_CHUNKS = 2
+
+# A single byte range; several ranges in one header are answered with the whole file
+BYTE_RANGE = re.compile(r'bytes=(\d*)-(\d*)')
+
+# Label of media download chunks in the Drive request timings
+MEDIA_OPERATION = 'drive.files.download'
+
+_DONE = object()
+
+
+def iter_media_chunks(media_request, chunk_size=None, byte_range=None):
+    """Yield the body of a Drive media request one chunk at a time.
+
+    With ``byte_range``, only bytes ``first`` to ``last`` (inclusive) are
+    fetched, still in ranged requests of at most ``chunk_size`` bytes.
+    """
+    chunk_size = chunk_size or settings.DRIVE_DOWNLOAD_CHUNK_SIZE
+    if byte_range:
+        yield from _iter_range_chunks(media_request, chunk_size, *byte_range)
+        return
+
+    buffer = io.BytesIO()
+    downloader = MediaIoBaseDownload(buffer, media_request, chunksize=chunk_size)
+    done = False
+    while not done:
+        with DRIVE_REQUEST_SECONDS.time(operation=MEDIA_OPERATION):
+            status, done = downloader.next_chunk(num_retries=settings.DRIVE_NUM_RETRIES)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+def _iter_range_chunks(media_request, chunk_size, first, last):
+    # MediaIoBaseDownload always starts at byte 0, so send the ranged requests here
+    headers = {
+        # Compressed responses would not line up with the byte offsets asked for
+        key: value for key, value in media_request.headers.items() if key.lower() not in ('accept', 'accept-encoding')
+    }
+    for start in range(first, last + 1, chunk_size):
+        end = min(start + chunk_size, last + 1) - 1
+        ranged = HttpRequest(
+            media_request.http, media_request.postproc, media_request.uri,
+            headers={**headers, 'range': f'bytes={start}-{end}'}, methodId=media_request.methodId,
+        )
+        with DRIVE_REQUEST_SECONDS.time(operation=MEDIA_OPERATION):
+            chunk = ranged.execute(num_retries=settings.DRIVE_NUM_RETRIES)
+        yield chunk[:end - start + 1]
+
+
+def download_to_file(media_request, fh, progress=None):
+    """Download a Drive media request into the file object ``fh``.
+
+    ``progress`` is called with ``(bytes_received, total_bytes)`` after each chunk.
+    """
+    downloader = MediaIoBaseDownload(fh, media_request, chunksize=settings.DRIVE_DOWNLOAD_CHUNK_SIZE)
+    done = False
+    while not done:
+        with DRIVE_REQUEST_SECONDS.time(operation=MEDIA_OPERATION):
+            status, done = downloader.next_chunk(num_retries=settings.DRIVE_NUM_RETRIES)
+        if progress:
+            progress(status.resumable_progress, status.total_size)
+
+
+def parse_range(header, size):
+    """The ``(first, last)`` bytes a ``Range`` header asks for out of ``size``.
+
+    Returns None when there is no header or it isn't a single byte range,
+    which the caller answers with the whole file. Raises ValueError for a
+    range that lies outside the file.
+    """
+    match = BYTE_RANGE.fullmatch(header.strip()) if header else None
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if not first:
+        # Suffix range: the last N bytes
+        if int(last) == 0 or size == 0:
+            raise ValueError("Unsatisfiable range")
+        return max(size - int(last), 0), size - 1
+    first = int(first)
+    if last and int(last) < first:
+        return None
+    if first >= size:
+        raise ValueError("Unsatisfiable range")
+    last = min(int(last), size - 1) if last else size - 1
+    return first, last
+
+
+def _validators(file):
+    """ETag and Last-Modified timestamp for a Drive file's current contents"""
+    version = file.get('md5Checksum') or file.get('modifiedTime')
+    etag = quote_etag(f"{file['id']}-{version}") if version else None
+    modified = parse_datetime(file['modifiedTime']) if file.get('modifiedTime') else None
+    return etag, int(modified.timestamp()) if modified else None
+
+
+def conditional_response(request, file):
+    """A 304 (or 412) response if the client's copy of ``file`` is current, else None"""
+    etag, last_modified = _validators(file)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is not None:
+        set_validators(response, file)
+    return response
+
+
+def set_validators(response, file):
+    etag, last_modified = _validators(file)
+    if etag:
+        response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified)
+    if file.get('size') is not None:
+        response['Accept-Ranges'] = 'bytes'
+
+
+def requested_range(request, file):
+    """The byte range to send of ``file``, or None for all of it.
+
+    An ``If-Range`` that no longer matches the file means the client's
+    partial copy is stale, so it gets the whole file. Raises ValueError for
+    an unsatisfiable range.
+    """
+    if file.get('size') is None:
+        return None
+    if_range = request.headers.get('If-Range')
+    if if_range:
+        etag, last_modified = _validators(file)
+        if if_range != etag and (last_modified is None or parse_http_date_safe(if_range) != last_modified):
+            return None
+    return parse_range(request.headers.get('Range'), int(file['size']))
+
+
+def range_not_satisfiable(file):
+    response = HttpResponse(status=416)
+    response['Content-Range'] = f"bytes */{file['size']}"
+    return response
+
+
+def set_content_range(response, byte_range, size):
+    """Make ``response`` carry bytes ``first`` to ``last`` of ``size``, or the whole body"""
+    if byte_range:
+        first, last = byte_range
+        response.status_code = 206
+        response['Content-Range'] = f'bytes {first}-{last}/{size}'
+        response['Content-Length'] = last - first + 1
+    elif size is not None:
+        response['Content-Length'] = size
+
+
+async def _aiter_chunks(chunks):
+    """Pull each blocking Drive chunk in a worker thread so the event loop keeps serving"""
+    next_chunk = sync_to_async(next, thread_sensitive=False)
+    while True:
+        chunk = await next_chunk(chunks, None)
+        if chunk is None:
+            return
+        yield chunk
+
+
+def streaming_download_response(request, media_request, file_name, mime_type, size=None, tee=None, byte_range=None):
+    """Build a StreamingHttpResponse relaying a Drive media request.
+
+    The first chunk is fetched before returning so that Drive errors surface
+    while the view can still redirect, instead of as a truncated body.
+    ``tee``, if given, wraps the chunk iterator, e.g. to copy it to a cache.
+    With ``byte_range`` only that part of the file is fetched and sent.
+    """
+    # Chunks may be pulled from any worker thread, so the download must not
+    # share the calling thread's pooled connection
+    media_request.http = private_transport(media_request.http)
+    chunks = iter_media_chunks(media_request, byte_range=byte_range)
+    first = next(chunks)
+    body = itertools.chain([first], chunks)
+    if tee:
+        body = tee(body)
+
+    # Under ASGI an async iterator lets Django stream without buffering;
+    # under WSGI it would be collected into memory, so stay synchronous
+    if isinstance(request, ASGIRequest):
+        body = _aiter_chunks(body)
+
+    response = StreamingHttpResponse(body, content_type=mime_type)
+    response['Content-Disposition'] = content_disposition_header(True, file_name)
+    set_content_range(response, byte_range, size)
+    return response
+
+
+class _ArchiveBuffer:
+    """Write-only file object collecting what ZipFile writes between yields"""
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.parts)
+        self.parts.clear()
+        return data
+
+
+def _put(chunks, item, cancelled):
+    """Queue ``item`` unless the archive is abandoned first"""
+    while not cancelled.is_set():
+        try:
+            chunks.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def iter_archive(service, entries):
+    """Yield a ZIP archive of ``entries`` as it is built.
+
+    ``entries`` are ``(archive_name, make_request)`` pairs, where
+    ``make_request(service)`` returns the Drive media request for the file.
+    Up to ``DRIVE_TRANSFER_WORKERS`` files are fetched at once into small
+    per-file queues while the archive is written in order. Files that fail
+    before sending any data are listed in ``ERRORS.txt`` instead.
+    """
+    cancelled = threading.Event()
+    queues = [queue.Queue(maxsize=ARCHIVE_PREFETCH_CHUNKS) for _ in entries]
+
+    def fetch(make_request, chunks):
+        try:
+            media_request = make_request(clone_drive_service(service))
+            for chunk in iter_media_chunks(media_request):
+                if not _put(chunks, chunk, cancelled):
+                    return
+            _put(chunks, _DONE, cancelled)
+        except Exception as error:
+            _put(chunks, error, cancelled)
+
+    # A pool per archive: workers block on their queues until the archive
+    # reaches their file, so a shared pool could deadlock across requests
+    pool = ThreadPoolExecutor(max_workers=max(1, min(settings.DRIVE_TRANSFER_WORKERS, len(entries))))
+    buffer = _ArchiveBuffer()
+    failed = []
+    try:
+        for (_, make_request), chunks in zip(entries, queues):
+            pool.submit(fetch, make_request, chunks)
+
+        with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as archive:
+            for (name, _), chunks in zip(entries, queues):
+                chunk = chunks.get()
+                if isinstance(chunk, Exception):
+                    logger.error("Archive download of %s failed: %s", name, chunk)
+                    failed.append(name)
+                    continue
+
+                with archive.open(name, 'w', force_zip64=True) as member:
+                    while chunk is not _DONE:
+                        # Past the first byte the archive can only be abandoned
+                        if isinstance(chunk, Exception):
+                            raise chunk
+                        member.write(chunk)
+                        if data := buffer.take():
+                            yield data
+                        chunk = chunks.get()
+
+            if failed:
+                archive.writestr('ERRORS.txt', 'These files could not be downloaded:\n' + '\n'.join(failed) + '\n')
+        yield buffer.take()
+    finally:
+        cancelled.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def streaming_archive_response(request, service, entries, archive_name):
+    """Build a StreamingHttpResponse of a ZIP archive of Drive files"""
+    body = iter_archive(service, entries)
+    if isinstance(request, ASGIRequest):
+        body = _aiter_chunks(body)
+
+    response = StreamingHttpResponse(body, content_type='application/zip')
+    response['Content-Disposition'] = content_disposition_header(True, archive_name)
+    return response
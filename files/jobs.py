@@ -0,0 +1,511 @@
+"""Background Drive transfers.
+
+Uploads and downloads queued here run outside the request cycle. An asyncio
+loop on a daemon thread schedules the jobs, and the blocking Drive calls run
+on a pool of ``DRIVE_JOBS['WORKERS']`` threads. Any one user gets at most
+``DRIVE_JOBS['PER_USER']`` of them at a time. Each chunk's progress is
+published to the user's channel group, and ``DriveJobConsumer`` relays it
+over the WebSocket.
+
+Job records live in a job store, in memory by default, which only works
+with a single server process: other processes cannot see its jobs.
+``SQLiteJobStore`` keeps them in an SQLite file that several processes on
+one host can share. A runner claims a job atomically before running it and
+holds a lease on it, renewed every ``DRIVE_JOBS['LEASE'] / 3`` seconds. Jobs
+still queued, or running under a lease that has run out because its
+process stopped, are picked up by any runner. Upload data and finished
+downloads are spooled to ``DRIVE_JOBS['SPOOL_DIR']``.
+"""
+import asyncio
+import json
+import logging
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from accounts.credentials import get_credentials
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import UploadedFile
+from django.core.signals import setting_changed
+from django.db import connection
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from . import metadata
+from .downloads import download_to_file
+from .uploads import upload_to_drive
+from .utils import build_drive_service
+
+logger = logging.getLogger(__name__)
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+UPLOAD, DOWNLOAD = 'upload', 'download'
+
+# Fields that never leave the server
+PRIVATE_FIELDS = ('spool_path', 'owner', 'lease_expires')
+
+
+class CredentialsMissing(Exception):
+    """The job's user has no stored Google credentials to run it with"""
+
+
+def job_group(user_id):
+    return f'drive_jobs_{user_id}'
+
+
+def public_job(job):
+    return {key: value for key, value in job.items() if key not in PRIVATE_FIELDS}
+
+
+def spool_path(job_id):
+    os.makedirs(settings.DRIVE_JOBS['SPOOL_DIR'], exist_ok=True)
+    return os.path.join(settings.DRIVE_JOBS['SPOOL_DIR'], job_id)
+
+
+def new_job(user_id, kind, name, **fields):
+    now = time.time()
+    job = {
+        'id': uuid.uuid4().hex,
+        'user_id': user_id,
+        'kind': kind,
+        'state': QUEUED,
+        'name': name,
+        'file_id': None,
+        'mime_type': None,
+        'export_type': None,
+        'size': None,
+        'transferred': 0,
+        'error': None,
+        'result': None,
+        'spool_path': None,
+        # Runner holding the job while it runs, until when
+        'owner': None,
+        'lease_expires': None,
+        'created_at': now,
+        'updated_at': now,
+    }
+    job.update(fields)
+    return job
+
+
+def upload_job(user_id, uploaded_file):
+    """An upload job for a Django ``UploadedFile``, with its data moved to the spool"""
+    job = new_job(
+        user_id, UPLOAD, uploaded_file.name,
+        mime_type=uploaded_file.content_type or 'application/octet-stream',
+        size=uploaded_file.size,
+    )
+    job['spool_path'] = spool_path(job['id'])
+    if hasattr(uploaded_file, 'temporary_file_path'):
+        # Already on disk; Django tolerates the temporary file going missing
+        shutil.move(uploaded_file.temporary_file_path(), job['spool_path'])
+    else:
+        with open(job['spool_path'], 'wb') as spooled:
+            for chunk in uploaded_file.chunks():
+                spooled.write(chunk)
+    return job
+
+
+def download_job(user_id, file, name=None, export_type=None):
+    """A download job for a Drive file resource; Google Docs are exported as ``export_type``"""
+    return new_job(
+        user_id, DOWNLOAD, name or file.get('name') or file['id'],
+        file_id=file['id'],
+        mime_type=file.get('mimeType'),
+        export_type=export_type,
+        size=None if export_type else int(file['size']) if file.get('size') else None,
+    )
+
+
+class MemoryJobStore:
+    """Job records kept in this process only"""
+
+    def __init__(self):
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def add(self, job):
+        with self.lock:
+            self.jobs[job['id']] = dict(job)
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else None
+
+    def update(self, job_id, **fields):
+        with self.lock:
+            self.jobs[job_id].update(fields)
+            return dict(self.jobs[job_id])
+
+    def remove(self, job_id):
+        with self.lock:
+            self.jobs.pop(job_id, None)
+
+    def claim(self, job_id, owner, lease_expires):
+        """Mark a queued job running for ``owner``; None if it isn't queued any more"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job['state'] != QUEUED:
+                return None
+            job.update(state=RUNNING, owner=owner, lease_expires=lease_expires, updated_at=time.time())
+            return dict(job)
+
+    def renew(self, owner, lease_expires):
+        with self.lock:
+            for job in self.jobs.values():
+                if job['state'] == RUNNING and job['owner'] == owner:
+                    job['lease_expires'] = lease_expires
+
+    def requeue_expired(self, now):
+        """Queue again the running jobs whose owner stopped renewing their lease"""
+        with self.lock:
+            for job in self.jobs.values():
+                if job['state'] == RUNNING and (job.get('lease_expires') or 0) < now:
+                    job.update(state=QUEUED, owner=None, lease_expires=None, transferred=0)
+
+    def for_user(self, user_id):
+        with self.lock:
+            jobs = [dict(job) for job in self.jobs.values() if job['user_id'] == user_id]
+        return sorted(jobs, key=lambda job: job['created_at'])
+
+    def queued(self):
+        with self.lock:
+            jobs = [dict(job) for job in self.jobs.values() if job['state'] == QUEUED]
+        return sorted(jobs, key=lambda job: job['created_at'])
+
+    def finished_before(self, timestamp):
+        with self.lock:
+            return [
+                dict(job) for job in self.jobs.values()
+                if job['state'] in (DONE, FAILED) and job['updated_at'] < timestamp
+            ]
+
+
+class SQLiteJobStore:
+    """Job records kept in an SQLite file, so they outlive the process and
+    can be shared by the processes of one host"""
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute(
+            'CREATE TABLE IF NOT EXISTS drive_job ('
+            'id TEXT PRIMARY KEY, user_id INTEGER NOT NULL, state TEXT NOT NULL, '
+            'created_at REAL NOT NULL, updated_at REAL NOT NULL, data TEXT NOT NULL, '
+            'owner TEXT, lease_expires REAL)'
+        )
+        columns = {row[1] for row in self.db.execute('PRAGMA table_info(drive_job)')}
+        for column, kind in (('owner', 'TEXT'), ('lease_expires', 'REAL')):
+            if column not in columns:
+                self.db.execute(f'ALTER TABLE drive_job ADD COLUMN {column} {kind}')
+        self.db.execute('CREATE INDEX IF NOT EXISTS drive_job_user_idx ON drive_job (user_id, created_at)')
+        # Records written before jobs stopped carrying a copy of the user's tokens
+        self.db.execute(
+            "UPDATE drive_job SET data = json_remove(data, '$.credentials') "
+            "WHERE json_type(data, '$.credentials') IS NOT NULL"
+        )
+
+    def _query(self, sql, params=()):
+        with self.lock:
+            return [json.loads(row[0]) for row in self.db.execute(sql, params)]
+
+    def add(self, job):
+        with self.lock:
+            self.db.execute(
+                'INSERT INTO drive_job (id, user_id, state, created_at, updated_at, data) VALUES (?, ?, ?, ?, ?, ?)',
+                (job['id'], job['user_id'], job['state'], job['created_at'], job['updated_at'], json.dumps(job))
+            )
+
+    def get(self, job_id):
+        jobs = self._query('SELECT data FROM drive_job WHERE id = ?', (job_id,))
+        return jobs[0] if jobs else None
+
+    def update(self, job_id, **fields):
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                (data,) = self.db.execute('SELECT data FROM drive_job WHERE id = ?', (job_id,)).fetchone()
+                job = {**json.loads(data), **fields}
+                self.db.execute(
+                    'UPDATE drive_job SET state = ?, updated_at = ?, data = ? WHERE id = ?',
+                    (job['state'], job['updated_at'], json.dumps(job), job_id)
+                )
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            self.db.execute('COMMIT')
+        return job
+
+    def remove(self, job_id):
+        with self.lock:
+            self.db.execute('DELETE FROM drive_job WHERE id = ?', (job_id,))
+
+    def claim(self, job_id, owner, lease_expires):
+        """Mark a queued job running for ``owner``; None if it isn't queued any more"""
+        now = time.time()
+        with self.lock:
+            # One statement, so two processes can never both claim the job
+            claimed = self.db.execute(
+                'UPDATE drive_job SET state = ?, owner = ?, lease_expires = ?, updated_at = ?, '
+                "data = json_set(data, '$.state', ?, '$.owner', ?, '$.lease_expires', ?, '$.updated_at', ?) "
+                'WHERE id = ? AND state = ?',
+                (RUNNING, owner, lease_expires, now, RUNNING, owner, lease_expires, now, job_id, QUEUED)
+            ).rowcount
+        return self.get(job_id) if claimed else None
+
+    def renew(self, owner, lease_expires):
+        with self.lock:
+            self.db.execute(
+                "UPDATE drive_job SET lease_expires = ?, data = json_set(data, '$.lease_expires', ?) "
+                'WHERE owner = ? AND state = ?',
+                (lease_expires, lease_expires, owner, RUNNING)
+            )
+
+    def requeue_expired(self, now):
+        """Queue again the running jobs whose owner stopped renewing their lease"""
+        with self.lock:
+            self.db.execute(
+                'UPDATE drive_job SET state = ?, owner = NULL, lease_expires = NULL, '
+                "data = json_set(data, '$.state', ?, '$.owner', NULL, '$.lease_expires', NULL, '$.transferred', 0) "
+                'WHERE state = ? AND (lease_expires IS NULL OR lease_expires < ?)',
+                (QUEUED, QUEUED, RUNNING, now)
+            )
+
+    def for_user(self, user_id):
+        return self._query('SELECT data FROM drive_job WHERE user_id = ? ORDER BY created_at', (user_id,))
+
+    def queued(self):
+        return self._query('SELECT data FROM drive_job WHERE state = ? ORDER BY created_at', (QUEUED,))
+
+    def finished_before(self, timestamp):
+        return self._query(
+            'SELECT data FROM drive_job WHERE state IN (?, ?) AND updated_at < ?', (DONE, FAILED, timestamp)
+        )
+
+
+def job_credentials(job):
+    """The user's shared credentials, looked up when the job runs so refreshed
+    tokens are reused and saved; jobs never keep a copy of their own"""
+    credentials = get_credentials(job['user_id'])
+    if credentials is None:
+        raise CredentialsMissing(f"User {job['user_id']} has no Google credentials")
+    return credentials
+
+
+def run_upload(job, progress):
+    service = build_drive_service(job_credentials(job))
+    with open(job['spool_path'], 'rb') as spooled:
+        uploaded_file = UploadedFile(
+            spooled, name=job['name'], content_type=job['mime_type'], size=os.path.getsize(job['spool_path'])
+        )
+        file = upload_to_drive(service, uploaded_file, fields=metadata.FILE_FIELDS, progress=progress)
+    metadata.store_file(User(pk=job['user_id']), file)
+    os.remove(job['spool_path'])
+    return {'result': file, 'file_id': file['id'], 'spool_path': None}
+
+
+def run_download(job, progress):
+    service = build_drive_service(job_credentials(job))
+    if job['export_type']:
+        media_request = service.files().export_media(fileId=job['file_id'], mimeType=job['export_type'])
+    else:
+        media_request = service.files().get_media(fileId=job['file_id'])
+
+    path = spool_path(job['id'])
+    with open(path, 'wb') as spooled:
+        download_to_file(media_request, spooled, progress=progress)
+    return {'spool_path': path, 'size': os.path.getsize(path)}
+
+
+TRANSFERS = {UPLOAD: run_upload, DOWNLOAD: run_download}
+
+# Loop serving the job WebSockets of this process (see publish)
+_listener_loop = None
+
+
+def bind_listener_loop(loop):
+    global _listener_loop
+    _listener_loop = loop
+
+
+async def publish(group, event):
+    """Send ``event`` to a channel group from the loop its listeners run on.
+
+    The in-memory channel layer is not thread-safe, so sends to it must
+    happen on the loop that serves the WebSockets, not the runner's own.
+    """
+    layer = get_channel_layer()
+    if layer is None:
+        return
+    loop = _listener_loop
+    try:
+        if loop is None or loop.is_closed() or loop is asyncio.get_running_loop():
+            await layer.group_send(group, event)
+        else:
+            await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(layer.group_send(group, event), loop))
+    except Exception as e:
+        logger.warning("Could not publish job event to %s: %s", group, e)
+
+
+class JobRunner:
+    """Runs queued Drive transfers on a background event loop and thread pool"""
+
+    def __init__(self, store, workers=None, per_user=None):
+        self.store = store
+        self.workers = workers or settings.DRIVE_JOBS['WORKERS']
+        self.per_user = per_user or settings.DRIVE_JOBS['PER_USER']
+        self.lease = settings.DRIVE_JOBS['LEASE']
+        # Names this runner's claims on jobs in a store other processes share
+        self.worker_id = f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        self.loop = None
+        self.executor = None
+        self.tasks = set()
+        self.scheduled = set()
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Start the loop thread, picking up queued jobs and those whose runner stopped"""
+        with self.lock:
+            if self.loop is not None:
+                return
+            self.loop = asyncio.new_event_loop()
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='drive-job')
+            threading.Thread(target=self.loop.run_forever, name='drive-jobs', daemon=True).start()
+            asyncio.run_coroutine_threadsafe(self._setup(), self.loop).result()
+        self.recover()
+
+    async def _setup(self):
+        # Created on the runner's loop, which they belong to
+        self.slots = asyncio.Semaphore(self.workers)
+        self.user_slots = defaultdict(lambda: asyncio.Semaphore(self.per_user))
+        self._track(self.loop.create_task(self._heartbeat()))
+
+    def recover(self):
+        """Schedule the store's queued jobs, after queueing again those whose lease ran out"""
+        self.store.requeue_expired(time.time())
+        for job in self.store.queued():
+            self.loop.call_soon_threadsafe(self._schedule, job['id'])
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                self.store.renew(self.worker_id, time.time() + self.lease)
+                self.recover()
+            except Exception as e:
+                logger.warning("Drive job heartbeat failed: %s", e)
+
+    def stop(self):
+        if self.loop is None:
+            return
+        for task in list(self.tasks):
+            self.loop.call_soon_threadsafe(task.cancel)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.loop = None
+
+    def submit(self, job):
+        """Queue a job created by ``upload_job`` or ``download_job``"""
+        self.purge_expired()
+        self.store.add(job)
+        self.start()
+        self.loop.call_soon_threadsafe(self._schedule, job['id'])
+        return job
+
+    def purge_expired(self):
+        """Forget finished jobs older than ``DRIVE_JOBS['RESULT_TTL']``, with their spooled data"""
+        for job in self.store.finished_before(time.time() - settings.DRIVE_JOBS['RESULT_TTL']):
+            if job['spool_path'] and os.path.exists(job['spool_path']):
+                os.remove(job['spool_path'])
+            self.store.remove(job['id'])
+
+    def _schedule(self, job_id):
+        if job_id in self.scheduled:
+            return
+        self.scheduled.add(job_id)
+        task = self._track(self.loop.create_task(self._run(job_id)))
+        task.add_done_callback(lambda task: self.scheduled.discard(job_id))
+
+    def _track(self, task):
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def _run(self, job_id):
+        job = self.store.get(job_id)
+        if job is None or job['state'] != QUEUED:
+            return
+
+        # Wait for a per-user slot first so one user's backlog never holds
+        # pool slots other users could run in
+        async with self.user_slots[job['user_id']], self.slots:
+            job = self.store.claim(job_id, self.worker_id, time.time() + self.lease)
+            if job is None:
+                return  # Claimed by another runner sharing the store
+            await self._publish(job)
+            try:
+                outcome = await self.loop.run_in_executor(self.executor, self._transfer, job)
+            except Exception as e:
+                logger.error("Drive %s job %s failed: %s", job['kind'], job_id, e)
+                await self._update(job_id, state=FAILED, error=str(e))
+            else:
+                await self._update(job_id, state=DONE, transferred=outcome.get('size', job['size']), **outcome)
+
+    def _transfer(self, job):
+        """Run on a pool thread"""
+        def progress(transferred, total):
+            asyncio.run_coroutine_threadsafe(
+                self._update(job['id'], transferred=transferred, size=total), self.loop
+            )
+
+        try:
+            return TRANSFERS[job['kind']](job, progress)
+        finally:
+            connection.close()
+
+    async def _update(self, job_id, **fields):
+        job = self.store.update(job_id, updated_at=time.time(), **fields)
+        await self._publish(job)
+        return job
+
+    async def _publish(self, job):
+        await publish(job_group(job['user_id']), {'type': 'job.update', 'job': public_job(job)})
+
+
+_runner = None
+_runner_lock = threading.Lock()
+
+
+def get_job_runner():
+    """This process's job runner, using the configured store"""
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            config = settings.DRIVE_JOBS['STORE']
+            store = import_string(config['BACKEND'])(**config.get('OPTIONS', {}))
+            _runner = JobRunner(store)
+        return _runner
+
+
+def reset_job_runner():
+    global _runner
+    with _runner_lock:
+        if _runner is not None:
+            _runner.stop()
+        _runner = None
+
+
+@receiver(setting_changed)
+def _reset_on_setting_change(setting, **kwargs):
+    if setting == 'DRIVE_JOBS':
+        reset_job_runner()
@@ -0,0 +1,86 @@
+"""Paginated and streamed Drive file listings for the browser.
+
+Rows carry only the fields the file list renders. The stream endpoint sends
+one JSON object per line (NDJSON) in batches as they are read from the
+metadata cache, or from Drive while a cold cache is being filled, so the
+first screen renders quickly and memory stays flat however many files a
+user has.
+"""
+import itertools
+import json
+
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+from django.http import StreamingHttpResponse
+
+# File fields sent to the browser for each row
+ROW_FIELDS = ('id', 'name', 'mimeType', 'modifiedTime', 'webViewLink')
+
+# Rows written to the stream at a time
+STREAM_BATCH_SIZE = 200
+
+
+def list_row(file):
+    return {field: file[field] for field in ROW_FIELDS if field in file}
+
+
+def iter_ndjson(files, batch_size=STREAM_BATCH_SIZE):
+    """Encode files as NDJSON rows, joined into batches of ``batch_size`` lines"""
+    files = iter(files)
+    while batch := list(itertools.islice(files, batch_size)):
+        yield ''.join(json.dumps(list_row(file), separators=(',', ':')) + '\n' for file in batch).encode()
+
+
+async def aiter_ndjson(files, batch_size=STREAM_BATCH_SIZE):
+    """``iter_ndjson`` for an async iterable of files"""
+    batch = []
+    async for file in files:
+        batch.append(json.dumps(list_row(file), separators=(',', ':')) + '\n')
+        if len(batch) == batch_size:
+            yield ''.join(batch).encode()
+            batch = []
+    if batch:
+        yield ''.join(batch).encode()
+
+
+async def _aiter_batches(batches):
+    """Pull each batch on the thread that owns the request's database connection"""
+    next_batch = sync_to_async(next)
+    while True:
+        batch = await next_batch(batches, None)
+        if batch is None:
+            return
+        yield batch
+
+
+def streaming_list_response(request, files):
+    """Build a StreamingHttpResponse of NDJSON rows for ``files``.
+
+    The first batch is read before returning so that Drive errors surface
+    while the view can still answer with an error status.
+    """
+    batches = iter_ndjson(files)
+    first = next(batches, b'')
+    body = itertools.chain([first], batches)
+
+    if isinstance(request, ASGIRequest):
+        body = _aiter_batches(body)
+
+    response = StreamingHttpResponse(body, content_type='application/x-ndjson')
+    response['Cache-Control'] = 'no-store'
+    return response
+
+
+async def async_streaming_list_response(files):
+    """``streaming_list_response`` for an async iterable of files"""
+    batches = aiter_ndjson(files)
+    first = await anext(batches, b'')
+
+    async def body():
+        yield first
+        async for batch in batches:
+            yield batch
+
+    response = StreamingHttpResponse(body(), content_type='application/x-ndjson')
+    response['Cache-Control'] = 'no-store'
+    return response
@@ -0,0 +1,38 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from google.oauth2.credentials import Credentials
+from googleapiclient.discovery import build
+
+from chat.bench import summarize
+from files import utils
+
+
+class Command(BaseCommand):
+    help = "Compare per-request Drive client setup: building a new client vs reusing the cached one"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=200, help='Simulated requests per mode')
+        parser.add_argument('--users', type=int, default=1, help='Distinct users the requests rotate through')
+
+    def handle(self, *args, **options):
+        credentials = Credentials(token='benchmark-token')
+        for mode, setup in (('cold', self.cold), ('warm', self.warm)):
+            samples = []
+            for i in range(options['iterations']):
+                started = time.perf_counter()
+                # Build the request a file_list view would send, without executing it
+                setup(i % options['users'], credentials).files().list(
+                    pageSize=10, fields='files(id, name, mimeType)'
+                )
+                samples.append(time.perf_counter() - started)
+            result = summarize(samples)
+            result['mode'] = mode
+            self.stdout.write(json.dumps(result))
+
+    def cold(self, user, credentials):
+        return build('drive', 'v3', credentials=credentials, static_discovery=True)
+
+    def warm(self, user, credentials):
+        return utils.get_user_drive_service(user, credentials)
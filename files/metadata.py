@@ -0,0 +1,286 @@
+"""Per-user cache of Drive file metadata, kept current with the Changes API.
+
+The first sync lists the user's files once and records a start page token.
+Later syncs only fetch the changes Drive logged since that token, so file
+listings and download preflights are answered from the database and only
+deltas go over the wire.
+"""
+import itertools
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from googleapiclient.errors import HttpError
+
+from .models import DriveFile, DriveSyncState
+
+logger = logging.getLogger(__name__)
+
+# Drive file fields kept in the cache
+FILE_FIELDS = 'id, name, mimeType, size, md5Checksum, webViewLink, createdTime, modifiedTime, trashed'
+
+# Largest page size Drive accepts for files.list and changes.list
+API_PAGE_SIZE = 1000
+
+# Stale cache rows deleted per query after a full listing
+DELETE_BATCH_SIZE = 500
+
+# Cached rows fetched per query while iterating over a user's files
+ITERATOR_CHUNK_SIZE = 500
+
+# Calls Drive accepts in one batch request
+BATCH_SIZE = 100
+
+# Statuses Drive answers with when a saved page token is no longer usable
+EXPIRED_TOKEN_STATUSES = (400, 404, 410)
+
+
+def list_params(page_token=None):
+    """files.list parameters for one page of the user's untrashed files, newest first"""
+    return {
+        'q': 'trashed = false',
+        'orderBy': 'modifiedTime desc',
+        'pageSize': API_PAGE_SIZE,
+        'pageToken': page_token,
+        'fields': f'nextPageToken, files({FILE_FIELDS})',
+    }
+
+
+def changes_params(page_token):
+    """changes.list parameters for one page of the change log"""
+    return {
+        'pageToken': page_token,
+        'pageSize': API_PAGE_SIZE,
+        'includeRemoved': True,
+        'spaces': 'drive',
+        'fields': f'nextPageToken, newStartPageToken, changes(changeType, fileId, removed, file({FILE_FIELDS}))',
+    }
+
+
+def iter_drive_pages(service):
+    """Yield pages of the user's Drive files, most recently modified first,
+    fetching each page only when the previous one has been consumed"""
+    page_token = None
+    while True:
+        response = service.files().list(**list_params(page_token)).execute()
+        yield response.get('files', [])
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return
+
+
+def iter_drive_files(service):
+    """Yield every file in the user's Drive that is not in the trash"""
+    for page in iter_drive_pages(service):
+        yield from page
+
+
+def _cache_entry(user, file):
+    return DriveFile(
+        user=user,
+        file_id=file['id'],
+        modified_time=parse_datetime(file['modifiedTime']) if file.get('modifiedTime') else None,
+        metadata=file,
+    )
+
+
+def _upsert(user, files):
+    DriveFile.objects.bulk_create(
+        [_cache_entry(user, file) for file in files],
+        update_conflicts=True,
+        unique_fields=['user', 'file_id'],
+        update_fields=['modified_time', 'metadata'],
+    )
+
+
+def store_page(user, page, seen):
+    """Cache one page of a full listing, remembering its ids in ``seen``"""
+    _upsert(user, page)
+    seen.update(file['id'] for file in page)
+
+
+def finish_full_sync(user, page_token, seen):
+    """Drop cached files a full listing did not return and save its page token"""
+    cached_ids = DriveFile.objects.filter(user=user).values_list('file_id', flat=True)
+    stale = [file_id for file_id in cached_ids.iterator() if file_id not in seen]
+    with transaction.atomic():
+        for start in range(0, len(stale), DELETE_BATCH_SIZE):
+            DriveFile.objects.filter(user=user, file_id__in=stale[start:start + DELETE_BATCH_SIZE]).delete()
+        DriveSyncState.objects.update_or_create(
+            user=user, defaults={'page_token': page_token, 'synced_at': timezone.now()}
+        )
+    logger.info("Cached metadata for %s Drive files", len(seen))
+
+
+def iter_full_sync(service, user):
+    """Re-list the user's files, storing and yielding each page as it arrives.
+
+    Only one page is held in memory at a time. Cached files that were not
+    listed are dropped and the new page token saved once the listing is
+    exhausted.
+    """
+    # Take the token first so changes made while listing are replayed later
+    page_token = service.changes().getStartPageToken().execute()['startPageToken']
+    seen = set()
+    for page in iter_drive_pages(service):
+        store_page(user, page, seen)
+        yield page
+    finish_full_sync(user, page_token, seen)
+
+
+def full_sync(service, user):
+    """Replace the user's cache with a fresh listing"""
+    return sum(len(page) for page in iter_full_sync(service, user))
+
+
+def merge_changes(response, updated, removed):
+    """Fold one changes.list page into the ``updated`` files and ``removed`` ids"""
+    for change in response.get('changes', []):
+        if change.get('changeType', 'file') != 'file':
+            continue
+        file_id = change['fileId']
+        file = change.get('file')
+        # Later changes to the same file supersede earlier ones
+        if change.get('removed') or not file or file.get('trashed'):
+            updated.pop(file_id, None)
+            removed.add(file_id)
+        else:
+            removed.discard(file_id)
+            updated[file_id] = file
+
+
+def save_changes(user, state, updated, removed, page_token):
+    with transaction.atomic():
+        if removed:
+            DriveFile.objects.filter(user=user, file_id__in=removed).delete()
+        if updated:
+            _upsert(user, updated.values())
+        state.page_token = page_token
+        state.synced_at = timezone.now()
+        state.save(update_fields=['page_token', 'synced_at'])
+    return len(updated) + len(removed)
+
+
+def apply_changes(service, user, state):
+    """Fetch the changes logged since ``state.page_token`` and apply them to the cache"""
+    page_token = state.page_token
+    updated, removed = {}, set()
+    while True:
+        response = service.changes().list(**changes_params(page_token)).execute()
+        merge_changes(response, updated, removed)
+        if 'newStartPageToken' in response:
+            return save_changes(user, state, updated, removed, response['newStartPageToken'])
+        page_token = response['nextPageToken']
+
+
+def is_fresh(state, max_age):
+    return max_age is not None and timezone.now() - state.synced_at < max_age
+
+
+def sync(service, user, max_age=None):
+    """Bring the user's cached metadata up to date.
+
+    Does nothing if the cache was synced less than ``max_age`` ago. Falls
+    back to a full listing on first use or when Drive no longer accepts the
+    saved page token.
+    """
+    state = DriveSyncState.objects.filter(user=user).first()
+    if state is None:
+        return full_sync(service, user)
+    if is_fresh(state, max_age):
+        return 0
+
+    try:
+        return apply_changes(service, user, state)
+    except HttpError as e:
+        if e.resp.status not in EXPIRED_TOKEN_STATUSES:
+            raise
+        logger.warning("Drive change token rejected (%s), re-listing files", e.resp.status)
+        return full_sync(service, user)
+
+
+def sync_interval():
+    return timedelta(seconds=settings.DRIVE_METADATA_SYNC_INTERVAL)
+
+
+def refresh(service, user):
+    """Sync the cache unless it was synced within ``DRIVE_METADATA_SYNC_INTERVAL`` seconds"""
+    return sync(service, user, max_age=sync_interval())
+
+
+def is_synced(user):
+    return DriveSyncState.objects.filter(user=user).exists()
+
+
+def iter_files(service, user, offset=0):
+    """Yield the user's files, most recently modified first, skipping ``offset``.
+
+    A warm cache is refreshed and read in chunks. A cold one is filled by a
+    full listing whose pages are yielded as they arrive, so the first rows
+    are available after a single Drive round trip.
+    """
+    if is_synced(user):
+        refresh(service, user)
+        yield from cached_files(user)[offset:].iterator(chunk_size=ITERATOR_CHUNK_SIZE)
+    else:
+        files = (file for page in iter_full_sync(service, user) for file in page)
+        yield from itertools.islice(files, offset, None)
+
+
+def cached_files(user):
+    """The user's cached files, most recently modified first"""
+    return DriveFile.objects.filter(user=user).order_by(
+        F('modified_time').desc(nulls_last=True)
+    ).values_list('metadata', flat=True)
+
+
+def store_file(user, file):
+    """Add or update one file resource fetched outside a sync"""
+    if not file.get('trashed'):
+        _upsert(user, [file])
+
+
+def get_file_metadata(service, user, file_id):
+    """Metadata for one file, from the cache when possible"""
+    refresh(service, user)
+    metadata = cached_files(user).filter(file_id=file_id).first()
+    if metadata is None:
+        metadata = service.files().get(fileId=file_id, fields=FILE_FIELDS).execute()
+        store_file(user, metadata)
+    return metadata
+
+
+def get_files_metadata(service, user, file_ids):
+    """Metadata for several files, in ``file_ids`` order.
+
+    Cached files come from the database; the rest are fetched through
+    Drive's batch endpoint, ``BATCH_SIZE`` calls per HTTP request. Files
+    Drive can't return are left out.
+    """
+    refresh(service, user)
+    found = dict(DriveFile.objects.filter(user=user, file_id__in=file_ids).values_list('file_id', 'metadata'))
+    missing = [file_id for file_id in dict.fromkeys(file_ids) if file_id not in found]
+
+    fetched = []
+
+    def collect(request_id, response, exception):
+        if exception is not None:
+            logger.warning("Could not fetch metadata for %s: %s", request_id, exception)
+        else:
+            fetched.append(response)
+
+    for start in range(0, len(missing), BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=collect)
+        for file_id in missing[start:start + BATCH_SIZE]:
+            batch.add(service.files().get(fileId=file_id, fields=FILE_FIELDS), request_id=file_id)
+        batch.execute()
+
+    live = [file for file in fetched if not file.get('trashed')]
+    if live:
+        _upsert(user, live)
+    found.update((file['id'], file) for file in fetched)
+    return [found[file_id] for file_id in dict.fromkeys(file_ids) if file_id in found]
@@ -1,3 +1,29 @@
 from django.db import models
+from django.contrib.auth.models import User
 
-# Create your models here.
+
+class DriveFile(models.Model):
+    """Cached Drive metadata for one of a user's files"""
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='drive_files')
+    file_id = models.CharField(max_length=128)
+    modified_time = models.DateTimeField(null=True)
+    # The Drive file resource as returned by the API (see metadata.FILE_FIELDS)
+    metadata = models.JSONField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'file_id'], name='files_drivefile_user_file_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['user', '-modified_time'], name='files_drivefile_user_mod_idx'),
+        ]
+
+    def __str__(self):
+        return self.metadata.get('name', self.file_id)
+
+
+class DriveSyncState(models.Model):
+    """Where a user's cached metadata stands in the Drive change log"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='drive_sync_state')
+    page_token = models.CharField(max_length=255)
+    synced_at = models.DateTimeField()
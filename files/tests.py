@@ -1,3 +1,1103 @@
-from django.test import TestCase
+import io
+import itertools
+import json
+import os
+import tempfile
+import threading
+import time
+import zipfile
+from collections import defaultdict
+from datetime import timedelta
+from email.parser import BytesParser
+from unittest import mock
+from urllib.parse import parse_qs, urlsplit
 
-# Create your tests here.
+import httplib2
+import httpx
+
+from accounts.credentials import reset_credentials_cache, save_credentials
+from accounts.models import GoogleCredentials
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.messages import get_messages
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db.models import QuerySet
+from django.http import StreamingHttpResponse
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.urls import include, path, reverse
+from django.utils import timezone
+from google.oauth2.credentials import Credentials
+from googleapiclient.http import HttpMockSequence
+
+from . import aio, async_views, jobs, metadata, utils
+from .models import DriveFile, DriveSyncState
+from .routing import websocket_urlpatterns
+from .content_cache import ContentCache, content_key, get_content_cache
+from .downloads import parse_range
+from .uploads import upload_to_drive
+from .urls import drive_urlpatterns
+from socialconnect.urls import urlpatterns as project_urlpatterns
+
+
+def fake_drive_service(responses):
+    """Drive client built from the bundled discovery document that answers
+    requests from ``responses`` instead of the network"""
+    return utils.build_drive_service(http=HttpMockSequence(responses))
+
+
+def json_response(body, status='200'):
+    return ({'status': status, 'content-type': 'application/json'}, json.dumps(body).encode())
+
+
+class FakeDrive:
+    """Stateful stand-in for the Drive HTTP API, used in place of ``httplib2.Http``.
+
+    Keeps a set of files and a change log, and answers files.list,
+    files.get (metadata, media and export), files.create (resumable
+    uploads), changes.getStartPageToken, changes.list and batch requests
+    from them. Thread-safe enough to serve concurrent workers.
+    """
+
+    def __init__(self, latency=0):
+        self.files = {}
+        self.contents = {}
+        self.changes = []
+        self.requests = []
+        self.uploads = {}
+        self.failures = {}
+        self.ranges = []
+        self.ids = itertools.count(1)
+        self.clock = timezone.now()
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.in_flight = self.max_in_flight = 0
+
+    def add(self, name, mime_type='text/plain', content=b''):
+        file_id = f'file-{next(self.ids)}'
+        self.files[file_id] = {
+            'id': file_id, 'name': name, 'mimeType': mime_type, 'size': str(len(content)), 'trashed': False
+        }
+        self.contents[file_id] = content
+        return self.touch(file_id)
+
+    def rename(self, file_id, name):
+        self.files[file_id]['name'] = name
+        return self.touch(file_id)
+
+    def trash(self, file_id):
+        self.files[file_id]['trashed'] = True
+        return self.touch(file_id)
+
+    def delete(self, file_id):
+        del self.files[file_id]
+        self.changes.append({'changeType': 'file', 'fileId': file_id, 'removed': True})
+
+    def touch(self, file_id):
+        self.clock += timedelta(seconds=1)
+        self.files[file_id]['modifiedTime'] = self.clock.isoformat().replace('+00:00', 'Z')
+        self.changes.append({'changeType': 'file', 'fileId': file_id, 'removed': False})
+        return self.files[file_id]
+
+    def paths(self):
+        return [path for _, path in self.requests]
+
+    def request(self, uri, method='GET', body=None, headers=None, redirections=5, connection_type=None):
+        url = urlsplit(uri)
+        with self.lock:
+            self.requests.append((method, url.path.removeprefix('/drive/v3')))
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            with self.lock:
+                return self.handle(method, url, body, {k.lower(): v for k, v in (headers or {}).items()})
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+    def handle(self, method, url, body, headers):
+        path = url.path.removeprefix('/drive/v3')
+        query = {key: values[0] for key, values in parse_qs(url.query).items()}
+
+        if path == '/batch/drive/v3':
+            return self.batch(body, headers)
+        if url.path == '/upload/drive/v3/files':
+            session = f'https://upload.fake/session-{next(self.ids)}'
+            self.uploads[session] = (json.loads(body or '{}'), bytearray())
+            return httplib2.Response({'status': 200, 'location': session}), b''
+        if url.geturl() in self.uploads:
+            return self.upload_chunk(url.geturl(), body, headers)
+        if path == '/changes/startPageToken':
+            return self.respond({'startPageToken': str(len(self.changes))})
+        if path == '/changes':
+            if not query['pageToken'].isdigit():
+                return self.respond({'error': {'code': 404, 'message': 'Invalid page token'}}, status=404)
+            start, size = int(query['pageToken']), int(query.get('pageSize', 100))
+            page = [dict(change) for change in self.changes[start:start + size]]
+            for change in page:
+                if not change['removed']:
+                    change['file'] = dict(self.files[change['fileId']])
+            if start + size < len(self.changes):
+                return self.respond({'changes': page, 'nextPageToken': str(start + size)})
+            return self.respond({'changes': page, 'newStartPageToken': str(len(self.changes))})
+        if path == '/files':
+            live = [file for file in self.files.values() if not file['trashed']]
+            if query.get('orderBy') == 'modifiedTime desc':
+                live.sort(key=lambda file: file['modifiedTime'], reverse=True)
+            start, size = int(query.get('pageToken', 0)), int(query.get('pageSize', 100))
+            response = {'files': live[start:start + size]}
+            if start + size < len(live):
+                response['nextPageToken'] = str(start + size)
+            return self.respond(response)
+        if path.startswith('/files/'):
+            file_id, _, action = path.removeprefix('/files/').partition('/')
+            if file_id not in self.files:
+                return self.respond({'error': {'code': 404, 'message': 'File not found'}}, status=404)
+            if file_id in self.failures:
+                status = self.failures[file_id]
+                return self.respond({'error': {'code': status, 'message': 'Injected failure'}}, status=status)
+            if action == 'export':
+                return httplib2.Response({'status': 200}), self.contents[file_id]
+            if query.get('alt') == 'media':
+                return self.media(file_id, headers)
+            return self.respond(self.files[file_id])
+        return self.respond({'error': {'code': 404, 'message': 'Not found'}}, status=404)
+
+    def media(self, file_id, headers):
+        content = self.contents[file_id]
+        if 'range' not in headers:
+            return httplib2.Response({'status': 200}), content
+        self.ranges.append(headers['range'])
+        first, last = (int(end) for end in headers['range'].removeprefix('bytes=').split('-'))
+        last = min(last, len(content) - 1)
+        return (
+            httplib2.Response({'status': 206, 'content-range': f'bytes {first}-{last}/{len(content)}'}),
+            content[first:last + 1],
+        )
+
+    def upload_chunk(self, session, body, headers):
+        resource, received = self.uploads[session]
+        received.extend(body.read() if hasattr(body, 'read') else body or b'')
+        total = int(headers['content-range'].rpartition('/')[2])
+        if len(received) < total:
+            return httplib2.Response({'status': 308, 'range': f'bytes=0-{len(received) - 1}'}), b''
+        file = self.add(resource.get('name', 'untitled'), content=bytes(received))
+        return self.respond(file)
+
+    def batch(self, body, headers):
+        """Answer a multipart/mixed batch request, one part per call"""
+        message = BytesParser().parsebytes(
+            f"Content-Type: {headers['content-type']}\r\n\r\n".encode() + (body.encode() if isinstance(body, str) else body)
+        )
+        parts = []
+        for part in message.get_payload():
+            method, target, _ = part.get_payload().splitlines()[0].split(' ')
+            response, content = self.handle(method, urlsplit(target), None, {})
+            parts.append(
+                '--batch\r\nContent-Type: application/http\r\n'
+                f"Content-ID: <response-{part['Content-ID'][1:-1]}>\r\n\r\n"
+                f"HTTP/1.1 {response.status} OK\r\nContent-Type: application/json\r\n\r\n"
+                f"{content.decode()}\r\n"
+            )
+        body = ''.join(parts) + '--batch--'
+        return httplib2.Response({'status': 200, 'content-type': 'multipart/mixed; boundary=batch'}), body.encode()
+
+    def respond(self, body, status=200):
+        return httplib2.Response({'status': status, 'content-type': 'application/json'}), json.dumps(body).encode()
+
+
+class DownloadTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice@example.com', email='alice@example.com')
+        self.client.force_login(self.user)
+        # Freshly synced metadata cache, so downloads go straight to the media request
+        DriveSyncState.objects.create(user=self.user, page_token='1', synced_at=timezone.now())
+        metadata.store_file(self.user, {'id': 'file-1', 'name': 'notes.txt', 'mimeType': 'text/plain', 'size': '10'})
+
+    def download(self, responses):
+        with mock.patch('files.views.get_drive_service', return_value=fake_drive_service(responses)):
+            return self.client.get(reverse('download_file', args=['file-1']))
+
+    @override_settings(DRIVE_DOWNLOAD_CHUNK_SIZE=4)
+    def test_download_is_streamed_in_chunks(self):
+        response = self.download([
+            ({'status': '206', 'content-range': 'bytes 0-3/10'}, b'0123'),
+            ({'status': '206', 'content-range': 'bytes 4-7/10'}, b'4567'),
+            ({'status': '206', 'content-range': 'bytes 8-9/10'}, b'89'),
+        ])
+
+        self.assertIsInstance(response, StreamingHttpResponse)
+        self.assertEqual(response['Content-Length'], '10')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="notes.txt"')
+        self.assertEqual(list(response.streaming_content), [b'0123', b'4567', b'89'])
+
+    def test_non_ascii_name_encoded(self):
+        metadata.store_file(self.user, {'id': 'file-1', 'name': 'résumé.txt', 'mimeType': 'text/plain', 'size': '2'})
+        response = self.download([({'status': '206', 'content-range': 'bytes 0-1/2'}, b'cv')])
+        self.assertEqual(response['Content-Disposition'], "attachment; filename*=utf-8''r%C3%A9sum%C3%A9.txt")
+
+    def test_drive_error_before_first_byte_redirects(self):
+        response = self.download([
+            json_response({'error': {'code': 403, 'message': 'forbidden'}}, status='403'),
+        ])
+        self.assertRedirects(response, reverse('file_list'), fetch_redirect_response=False)
+
+    @override_settings(DRIVE_DOWNLOAD_CHUNK_SIZE=4)
+    async def test_asgi_download_streams_asynchronously(self):
+        await self.async_client.aforce_login(self.user)
+        service = fake_drive_service([
+            ({'status': '206', 'content-range': 'bytes 0-3/10'}, b'0123'),
+            ({'status': '206', 'content-range': 'bytes 4-7/10'}, b'4567'),
+            ({'status': '206', 'content-range': 'bytes 8-9/10'}, b'89'),
+        ])
+        with mock.patch('files.views.get_drive_service', return_value=service):
+            response = await self.async_client.get(reverse('download_file', args=['file-1']))
+            self.assertTrue(response.is_async)
+            self.assertEqual([chunk async for chunk in response.streaming_content], [b'0123', b'4567', b'89'])
+
+
+@override_settings(DRIVE_UPLOAD_CHUNK_SIZE=256 * 1024, DRIVE_NUM_RETRIES=0)
+class UploadTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice@example.com', email='alice@example.com')
+        self.client.force_login(self.user)
+        self.content = bytes(range(256)) * 2400  # ~600 KiB, three chunks
+
+    def upload(self, responses):
+        service = fake_drive_service(responses)
+        with mock.patch('files.views.get_drive_service', return_value=service), \
+                mock.patch('files.uploads.time.sleep') as sleep:
+            response = self.client.post(reverse('upload_file'), {
+                'file': SimpleUploadedFile('big.bin', self.content, content_type='application/octet-stream')
+            })
+        return response, service, sleep
+
+    def test_upload_sent_in_resumable_chunks(self):
+        response, service, _ = self.upload([
+            ({'status': '200', 'location': 'https://upload.example/session'}, b''),
+            ({'status': '308', 'range': 'bytes=0-262143'}, b''),
+            ({'status': '308', 'range': 'bytes=0-524287'}, b''),
+            json_response({'id': 'new-file', 'name': 'big.bin'}),
+        ])
+        self.assertRedirects(response, reverse('drive_home'), fetch_redirect_response=False)
+        self.assertTrue(DriveFile.objects.filter(user=self.user, file_id='new-file').exists())
+        self.assertIn("'big.bin' uploaded successfully", [str(m) for m in get_messages(response.wsgi_request)][0])
+
+    def test_upload_resumes_after_transient_error(self):
+        response, _, sleep = self.upload([
+            ({'status': '200', 'location': 'https://upload.example/session'}, b''),
+            ({'status': '308', 'range': 'bytes=0-262143'}, b''),
+            ({'status': '503'}, b'unavailable'),
+            # Resume: Drive reports what it has, then the upload carries on
+            ({'status': '308', 'range': 'bytes=0-262143'}, b''),
+            ({'status': '308', 'range': 'bytes=0-524287'}, b''),
+            json_response({'id': 'new-file', 'name': 'big.bin'}),
+        ])
+        self.assertEqual(sleep.call_count, 1)
+        self.assertIn("'big.bin' uploaded successfully", [str(m) for m in get_messages(response.wsgi_request)][0])
+
+    @override_settings(DRIVE_UPLOAD_MAX_RESUMES=1)
+    def test_upload_gives_up_after_repeated_failures(self):
+        response, _, _ = self.upload([
+            ({'status': '200', 'location': 'https://upload.example/session'}, b''),
+            ({'status': '503'}, b'unavailable'),
+            ({'status': '503'}, b'unavailable'),
+        ])
+        self.assertEqual([str(m) for m in get_messages(response.wsgi_request)], ["Upload failed. Please try again."])
+
+    def test_rejected_upload_not_resumed(self):
+        response, _, sleep = self.upload([
+            ({'status': '200', 'location': 'https://upload.example/session'}, b''),
+            json_response({'error': {'code': 403, 'message': 'forbidden'}}, status='403'),
+        ])
+        sleep.assert_not_called()
+        self.assertEqual([str(m) for m in get_messages(response.wsgi_request)], ["Upload failed. Please try again."])
+
+
+class DriveServiceCacheTests(TestCase):
+    def setUp(self):
+        utils._local.__dict__.clear()
+        self.addCleanup(utils._local.__dict__.clear)
+
+    def credentials(self, token):
+        return Credentials(token=token)
+
+    def test_service_reused_for_same_user(self):
+        first = utils.get_user_drive_service(1, self.credentials('a'))
+        second = utils.get_user_drive_service(1, self.credentials('b'))
+        self.assertIs(first, second)
+        self.assertIs(first.files(), second.files())
+        # The client now authorizes with the latest credentials
+        self.assertEqual(second._http.credentials.token, 'b')
+
+    def test_users_get_separate_services_sharing_transport(self):
+        alice = utils.get_user_drive_service(1, self.credentials('a'))
+        bob = utils.get_user_drive_service(2, self.credentials('b'))
+        self.assertIsNot(alice, bob)
+        self.assertIs(alice._http.http, bob._http.http)
+
+    @override_settings(DRIVE_SERVICE_CACHE_SIZE=1)
+    def test_least_recently_used_service_evicted(self):
+        alice = utils.get_user_drive_service(1, self.credentials('a'))
+        utils.get_user_drive_service(2, self.credentials('b'))
+        self.assertIsNot(utils.get_user_drive_service(1, self.credentials('a')), alice)
+
+    def test_discovery_document_parsed_once(self):
+        utils._discovery_document = None
+        with mock.patch('files.utils.get_static_doc', wraps=utils.get_static_doc) as get_static_doc:
+            utils.build_drive_service()
+            utils.build_drive_service()
+        self.assertEqual(get_static_doc.call_count, 1)
+
+    def test_private_transport_has_own_connection(self):
+        service = utils.get_user_drive_service(1, self.credentials('a'))
+        http = utils.private_transport(service._http)
+        self.assertIsNot(http.http, service._http.http)
+        self.assertIs(http.credentials, service._http.credentials)
+
+
+class DriveTestCase(TestCase):
+    """Signed-in user whose Drive client talks to a FakeDrive"""
+    latency = 0
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice@example.com', email='alice@example.com')
+        self.client.force_login(self.user)
+        self.drive = FakeDrive(latency=self.latency)
+        self.service = fake_drive_service([])
+        self.service._http = self.drive
+        patcher = mock.patch('files.views.get_drive_service', return_value=self.service)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        cache_settings = override_settings(DRIVE_CONTENT_CACHE={
+            'DIR': cache_dir.name, 'MAX_SIZE': 1024 * 1024, 'MAX_FILE_SIZE': 1024 * 1024,
+        })
+        cache_settings.enable()
+        self.addCleanup(cache_settings.disable)
+
+
+class MetadataCacheTests(DriveTestCase):
+
+    def names(self):
+        return [file['name'] for file in metadata.cached_files(self.user)]
+
+    def test_first_sync_lists_files_once(self):
+        self.drive.add('a.txt')
+        self.drive.add('b.txt')
+        metadata.sync(self.service, self.user)
+        self.assertEqual(self.names(), ['b.txt', 'a.txt'])
+        self.assertEqual(self.drive.paths(), ['/changes/startPageToken', '/files'])
+        self.assertEqual(DriveSyncState.objects.get(user=self.user).page_token, '2')
+
+    def test_drive_calls_timed(self):
+        operations = ('drive.changes.getStartPageToken', 'drive.files.list')
+        before = [utils.DRIVE_REQUEST_SECONDS.count(operation=operation) for operation in operations]
+        metadata.sync(self.service, self.user)
+        after = [utils.DRIVE_REQUEST_SECONDS.count(operation=operation) for operation in operations]
+        self.assertEqual([b - a for a, b in zip(before, after)], [1, 1])
+
+    def test_later_syncs_apply_only_changes(self):
+        kept = self.drive.add('kept.txt')
+        renamed = self.drive.add('old.txt')
+        trashed = self.drive.add('trashed.txt')
+        deleted = self.drive.add('deleted.txt')
+        metadata.sync(self.service, self.user)
+
+        self.drive.rename(renamed['id'], 'new.txt')
+        self.drive.trash(trashed['id'])
+        self.drive.delete(deleted['id'])
+        self.drive.add('added.txt')
+        self.drive.requests.clear()
+
+        self.assertEqual(metadata.sync(self.service, self.user), 4)
+        self.assertEqual(self.drive.paths(), ['/changes'])
+        self.assertEqual(self.names(), ['added.txt', 'new.txt', kept['name']])
+
+    @mock.patch('files.metadata.API_PAGE_SIZE', 2)
+    def test_change_pages_followed(self):
+        metadata.sync(self.service, self.user)
+        for i in range(5):
+            self.drive.add(f'{i}.txt')
+        metadata.sync(self.service, self.user)
+        self.assertEqual(len(self.names()), 5)
+        self.assertEqual(DriveSyncState.objects.get(user=self.user).page_token, '5')
+
+    def test_expired_token_falls_back_to_listing(self):
+        self.drive.add('a.txt')
+        DriveSyncState.objects.create(user=self.user, page_token='expired', synced_at=timezone.now())
+        metadata.sync(self.service, self.user)
+        self.assertEqual(self.names(), ['a.txt'])
+        self.assertEqual(self.drive.paths(), ['/changes', '/changes/startPageToken', '/files'])
+        self.assertEqual(DriveSyncState.objects.get(user=self.user).page_token, '1')
+
+    def test_file_list_served_from_cache_within_interval(self):
+        self.drive.add('a.txt')
+        metadata.sync(self.service, self.user)
+        self.drive.add('b.txt')
+        self.drive.requests.clear()
+
+        response = self.client.get(reverse('file_list'))
+        self.assertEqual([file['name'] for file in response.context['files']], ['a.txt'])
+        self.assertEqual(self.drive.requests, [])
+
+        with override_settings(DRIVE_METADATA_SYNC_INTERVAL=0):
+            response = self.client.get(reverse('file_list'))
+        self.assertEqual([file['name'] for file in response.context['files']], ['b.txt', 'a.txt'])
+        self.assertEqual(self.drive.paths(), ['/changes'])
+
+    def test_metadata_lookup_falls_back_to_drive_for_unknown_file(self):
+        metadata.sync(self.service, self.user)
+        file = self.drive.add('late.txt')
+        self.drive.requests.clear()
+
+        found = metadata.get_file_metadata(self.service, self.user, file['id'])
+        self.assertEqual(found['name'], 'late.txt')
+        self.assertEqual(self.drive.paths(), [f"/files/{file['id']}"])
+        self.assertEqual(self.names(), ['late.txt'])
+
+
+@mock.patch('files.metadata.API_PAGE_SIZE', 2)
+class ListingTests(DriveTestCase):
+    def setUp(self):
+        super().setUp()
+        for i in range(5):
+            self.drive.add(f'{i}.txt')
+
+    def rows(self, response):
+        return [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+
+    def test_drive_pages_fetched_lazily(self):
+        pages = metadata.iter_drive_pages(self.service)
+        self.assertEqual([file['name'] for file in next(pages)], ['4.txt', '3.txt'])
+        self.assertEqual(self.drive.paths(), ['/files'])
+
+    def test_cold_cache_streamed_from_drive_and_stored(self):
+        response = self.client.get(reverse('file_list_stream'))
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = self.rows(response)
+        self.assertEqual([row['name'] for row in rows], ['4.txt', '3.txt', '2.txt', '1.txt', '0.txt'])
+        self.assertEqual(set(rows[0]), {'id', 'name', 'mimeType', 'modifiedTime'})
+        self.assertEqual(self.drive.paths(), ['/changes/startPageToken', '/files', '/files', '/files'])
+        self.assertTrue(metadata.is_synced(self.user))
+        self.assertEqual(DriveFile.objects.filter(user=self.user).count(), 5)
+
+    @override_settings(DRIVE_LIST_PAGE_SIZE=2)
+    def test_page_rendered_then_rest_streamed_from_cache(self):
+        metadata.sync(self.service, self.user)
+        self.drive.requests.clear()
+
+        response = self.client.get(reverse('file_list'))
+        self.assertEqual([file['name'] for file in response.context['files']], ['4.txt', '3.txt'])
+        self.assertFalse(response.context['complete'])
+        self.assertContains(response, f'{reverse("file_list_stream")}?offset=2')
+
+        response = self.client.get(reverse('file_list_stream'), {'offset': 2})
+        self.assertEqual([row['name'] for row in self.rows(response)], ['2.txt', '1.txt', '0.txt'])
+        self.assertEqual(self.drive.requests, [])
+
+    def test_json_pages(self):
+        response = self.client.get(reverse('file_list_data'), {'limit': 3})
+        self.assertEqual([file['name'] for file in response.json()['files']], ['4.txt', '3.txt', '2.txt'])
+        self.assertEqual(response.json()['next_offset'], 3)
+
+        response = self.client.get(reverse('file_list_data'), {'offset': 3, 'limit': 3})
+        self.assertEqual([file['name'] for file in response.json()['files']], ['1.txt', '0.txt'])
+        self.assertIsNone(response.json()['next_offset'])
+
+    def test_invalid_page_params_rejected(self):
+        for params in ({'offset': -1}, {'limit': 0}, {'limit': 'many'}):
+            self.assertEqual(self.client.get(reverse('file_list_data'), params).status_code, 400)
+
+    async def test_asgi_listing_streams_asynchronously(self):
+        await self.async_client.aforce_login(self.user)
+        response = await self.async_client.get(reverse('file_list_stream'))
+        self.assertTrue(response.is_async)
+        body = b''.join([chunk async for chunk in response.streaming_content])
+        self.assertEqual(len(body.splitlines()), 5)
+
+
+@override_settings(DRIVE_NUM_RETRIES=0, DRIVE_TRANSFER_WORKERS=4)
+class BatchUploadTests(DriveTestCase):
+    latency = 0.05
+
+    def post(self, *names):
+        return self.client.post(reverse('upload_file'), {
+            'file': [SimpleUploadedFile(name, name.encode() * 100) for name in names]
+        })
+
+    def test_files_uploaded_concurrently(self):
+        response = self.post('a.txt', 'b.txt', 'c.txt', 'd.txt')
+        self.assertEqual([str(m) for m in get_messages(response.wsgi_request)], ["4 files uploaded successfully!"])
+        self.assertEqual(sorted(file['name'] for file in self.drive.files.values()), ['a.txt', 'b.txt', 'c.txt', 'd.txt'])
+        contents = {file['name']: self.drive.contents[file['id']] for file in self.drive.files.values()}
+        self.assertEqual(contents['a.txt'], b'a.txt' * 100)
+        self.assertGreater(self.drive.max_in_flight, 1)
+        self.assertEqual(DriveFile.objects.filter(user=self.user).count(), 4)
+
+    def test_failed_files_reported_by_name(self):
+        def flaky(service, uploaded_file, **kwargs):
+            if uploaded_file.name == 'bad.txt':
+                raise RuntimeError('boom')
+            return upload_to_drive(service, uploaded_file, **kwargs)
+
+        with mock.patch('files.uploads.upload_to_drive', side_effect=flaky):
+            response = self.post('good.txt', 'bad.txt')
+        self.assertEqual([str(m) for m in get_messages(response.wsgi_request)], [
+            "File 'good.txt' uploaded successfully!",
+            "Upload failed for bad.txt. Please try again.",
+        ])
+
+
+@override_settings(DRIVE_DOWNLOAD_CHUNK_SIZE=4, DRIVE_TRANSFER_WORKERS=4)
+class ArchiveDownloadTests(DriveTestCase):
+    def download(self, file_ids):
+        response = self.client.post(reverse('download_archive'), {'file_id': file_ids})
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        return zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content)))
+
+    def test_selected_files_streamed_as_zip(self):
+        notes = self.drive.add('notes.txt', content=b'some notes')
+        copy = self.drive.add('notes.txt', content=b'other notes')
+        doc = self.drive.add('Plan', mime_type='application/vnd.google-apps.document', content=b'%PDF-plan')
+        folder = self.drive.add('Folder', mime_type='application/vnd.google-apps.folder')
+
+        archive = self.download([notes['id'], copy['id'], doc['id'], folder['id']])
+        self.assertEqual(archive.namelist(), ['notes.txt', 'notes (1).txt', 'Plan.pdf'])
+        self.assertEqual(archive.read('notes.txt'), b'some notes')
+        self.assertEqual(archive.read('notes (1).txt'), b'other notes')
+        self.assertEqual(archive.read('Plan.pdf'), b'%PDF-plan')
+
+    def test_names_cannot_escape_extraction_folder(self):
+        files = [
+            self.drive.add(name, content=b'x')
+            for name in ('../../etc/passwd', '..\\evil.bat', 'C:notes.txt', '/abs/path', '..')
+        ]
+        archive = self.download([file['id'] for file in files])
+        self.assertEqual(archive.namelist(), ['_.._etc_passwd', '_evil.bat', 'notes.txt', '_abs_path', files[-1]['id']])
+
+    def test_uncached_metadata_fetched_in_one_batch(self):
+        cached = self.drive.add('cached.txt', content=b'cached')
+        metadata.sync(self.service, self.user)
+        late = [self.drive.add(f'late-{i}.txt', content=b'late') for i in range(3)]
+        self.drive.requests.clear()
+
+        with override_settings(DRIVE_METADATA_SYNC_INTERVAL=3600):
+            archive = self.download([cached['id']] + [file['id'] for file in late])
+        self.assertEqual(len(archive.namelist()), 4)
+        self.assertEqual([path for path in self.drive.paths() if not path.startswith('/files/')], ['/batch/drive/v3'])
+        self.assertEqual(DriveFile.objects.filter(user=self.user).count(), 4)
+
+    def test_failed_file_listed_instead_of_included(self):
+        good = self.drive.add('good.txt', content=b'good')
+        bad = self.drive.add('bad.txt', content=b'bad')
+        self.drive.failures[bad['id']] = 403
+
+        archive = self.download([good['id'], bad['id']])
+        self.assertEqual(archive.namelist(), ['good.txt', 'ERRORS.txt'])
+        self.assertIn('bad.txt', archive.read('ERRORS.txt').decode())
+
+    def test_files_fetched_concurrently(self):
+        self.drive.latency = 0.05
+        files = [self.drive.add(f'{i}.txt', content=b'x' * 10) for i in range(4)]
+        archive = self.download([file['id'] for file in files])
+        self.assertEqual(len(archive.namelist()), 4)
+        self.assertGreater(self.drive.max_in_flight, 1)
+
+    def test_selection_required(self):
+        response = self.client.post(reverse('download_archive'))
+        self.assertRedirects(response, reverse('file_list'), fetch_redirect_response=False)
+
+
+class ContentCacheTests(DriveTestCase):
+    def setUp(self):
+        super().setUp()
+        self.file = self.drive.add('notes.txt', content=b'0123456789')
+        metadata.sync(self.service, self.user)
+
+    def download(self, **headers):
+        response = self.client.get(reverse('download_file', args=[self.file['id']]), **headers)
+        return response, b''.join(response.streaming_content)
+
+    def media_requests(self):
+        return self.drive.paths().count(f"/files/{self.file['id']}")
+
+    def test_repeat_download_served_from_disk(self):
+        response, body = self.download()
+        self.assertEqual(body, b'0123456789')
+        self.assertEqual(self.media_requests(), 1)
+
+        response, body = self.download()
+        self.assertEqual(body, b'0123456789')
+        self.assertEqual(response['Content-Length'], '10')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="notes.txt"')
+        self.assertEqual(self.media_requests(), 1)
+
+    def test_range_served_from_cache(self):
+        self.download()
+        response, body = self.download(HTTP_RANGE='bytes=2-5')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 2-5/10')
+        self.assertEqual(body, b'2345')
+
+
+    @override_settings(DRIVE_METADATA_SYNC_INTERVAL=0)
+    def test_changed_file_fetched_again(self):
+        self.download()
+        self.drive.contents[self.file['id']] = b'new notes!'
+        self.drive.touch(self.file['id'])
+
+        response, body = self.download()
+        self.assertEqual(body, b'new notes!')
+        self.assertEqual(self.media_requests(), 2)
+
+    @override_settings(DRIVE_DOWNLOAD_CHUNK_SIZE=4)
+    def test_interrupted_download_not_cached(self):
+        response = self.client.get(reverse('download_file', args=[self.file['id']]))
+        self.assertEqual(next(iter(response.streaming_content)), b'0123')
+        response.close()
+        self.assertIsNone(get_content_cache().get(content_key(self.file)))
+        self.assertEqual(os.listdir(os.path.dirname(get_content_cache().path(content_key(self.file)))), [])
+
+    def test_least_recently_used_entries_evicted(self):
+        cache = ContentCache(get_content_cache().directory, max_size=25, max_file_size=25)
+        for i, key in enumerate(['aa1', 'bb2', 'cc3']):
+            list(cache.tee(key, [b'x' * 10], 10))
+            os.utime(cache.path(key), (i, i))
+        self.assertIsNone(cache.get('aa1'))
+
+        cache.get('bb2')  # now the most recently used
+        list(cache.tee('dd4', [b'x' * 10], 10))
+        self.assertIsNotNone(cache.get('bb2'))
+        self.assertIsNone(cache.get('cc3'))
+
+    def test_directory_scanned_only_when_over_limit(self):
+        cache = ContentCache(get_content_cache().directory, max_size=25, max_file_size=25)
+        with mock.patch('files.content_cache.os.walk', wraps=os.walk) as walk:
+            for key in ['aa1', 'bb2']:
+                list(cache.tee(key, [b'x' * 10], 10))
+            self.assertEqual(walk.call_count, 1)  # Counting what was already there
+            list(cache.tee('cc3', [b'x' * 10], 10))
+            self.assertEqual(walk.call_count, 2)
+        self.assertIsNone(cache.get('aa1'))
+
+    def test_range_header_parsing(self):
+        self.assertEqual(parse_range('bytes=0-3', 10), (0, 3))
+        self.assertEqual(parse_range('bytes=4-', 10), (4, 9))
+        self.assertEqual(parse_range('bytes=-3', 10), (7, 9))
+        self.assertEqual(parse_range('bytes=5-100', 10), (5, 9))
+        for header in (None, 'bytes=0-1,4-5', 'items=0-3', 'bytes=5-2', 'bytes=-'):
+            self.assertIsNone(parse_range(header, 10))
+        for header in ('bytes=10-', 'bytes=-0'):
+            with self.assertRaises(ValueError):
+                parse_range(header, 10)
+
+class ConditionalDownloadTests(DriveTestCase):
+    def setUp(self):
+        super().setUp()
+        self.file = self.drive.add('notes.txt', content=b'0123456789')
+        metadata.sync(self.service, self.user)
+        self.url = reverse('download_file', args=[self.file['id']])
+
+    def media_requests(self):
+        return self.drive.paths().count(f"/files/{self.file['id']}")
+
+    def test_validators_sent_and_honoured(self):
+        response = self.client.get(self.url)
+        b''.join(response.streaming_content)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        etag, last_modified = response['ETag'], response['Last-Modified']
+
+        for headers in ({'HTTP_IF_NONE_MATCH': etag}, {'HTTP_IF_MODIFIED_SINCE': last_modified}):
+            response = self.client.get(self.url, **headers)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response['ETag'], etag)
+        self.assertEqual(self.media_requests(), 1)
+
+    @override_settings(DRIVE_DOWNLOAD_CHUNK_SIZE=4)
+    def test_range_fetched_from_drive(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=3-8')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 3-8/10')
+        self.assertEqual(response['Content-Length'], '6')
+        self.assertEqual(b''.join(response.streaming_content), b'345678')
+        self.assertEqual(self.drive.ranges, ['bytes=3-6', 'bytes=7-8'])
+        # A part of a file is never cached
+        self.assertIsNone(get_content_cache().get(content_key(self.file)))
+
+    def test_stale_if_range_gets_whole_file(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=3-8', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=3-8', HTTP_IF_RANGE=response['ETag'])
+        self.assertEqual(response.status_code, 206)
+
+    def test_unsatisfiable_range_rejected(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], 'bytes */10')
+
+def httpx_transport(drive, intercept=None):
+    """httpx transport answering from a FakeDrive; ``intercept(request)`` may answer first"""
+    def handler(request):
+        if intercept and (response := intercept(request)) is not None:
+            return response
+        url = urlsplit(str(request.url))
+        with drive.lock:
+            drive.requests.append((request.method, url.path.removeprefix('/drive/v3')))
+            response, content = drive.handle(request.method, url, request.content, dict(request.headers))
+        headers = {key: value for key, value in response.items() if key != 'status'}
+        return httpx.Response(response.status, headers=headers, content=content)
+    return httpx.MockTransport(handler)
+
+
+class AsyncDriveUrls:
+    """The project's routes with the files app served by its async views"""
+    urlpatterns = [path('files/', include(drive_urlpatterns(async_views)))] + project_urlpatterns
+
+
+@override_settings(ROOT_URLCONF=AsyncDriveUrls, DRIVE_NUM_RETRIES=0)
+class AsyncDriveTests(DriveTestCase):
+    intercept = None
+
+    def setUp(self):
+        super().setUp()
+        self.credentials = Credentials(token='token')
+
+        async def get_async_drive(request):
+            return aio.AsyncDrive(self.credentials, http=httpx.AsyncClient(transport=httpx_transport(
+                self.drive, lambda request: self.intercept and self.intercept(request)
+            )))
+
+        patcher = mock.patch('files.aio.get_async_drive', get_async_drive)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.async_client.force_login(self.user)
+
+    async def test_cold_listing_streamed_and_cached(self):
+        for i in range(3):
+            self.drive.add(f'{i}.txt')
+        response = await self.async_client.get(reverse('file_list_stream'))
+        body = b''.join([chunk async for chunk in response.streaming_content])
+        self.assertEqual([json.loads(line)['name'] for line in body.splitlines()], ['2.txt', '1.txt', '0.txt'])
+        self.assertEqual(self.drive.paths(), ['/changes/startPageToken', '/files'])
+
+        self.drive.add('3.txt')
+        with override_settings(DRIVE_METADATA_SYNC_INTERVAL=0):
+            response = await self.async_client.get(reverse('file_list_data'), {'limit': 2})
+        self.assertEqual([file['name'] for file in response.json()['files']], ['3.txt', '2.txt'])
+        self.assertEqual(response.json()['next_offset'], 2)
+        self.assertEqual(self.drive.paths()[-1], '/changes')
+        self.assertEqual(await DriveFile.objects.filter(user=self.user).acount(), 4)
+
+    async def test_cached_listing_not_loaded_at_once(self):
+        for i in range(3):
+            self.drive.add(f'{i}.txt')
+        drive = await aio.get_async_drive(None)
+        self.assertEqual(len([file async for file in aio.iter_files(drive, self.user)]), 3)
+
+        fetch_all = QuerySet._fetch_all
+
+        def fetch_all_but_files(queryset):
+            self.assertIsNot(queryset.model, DriveFile, 'cached files loaded in one go')
+            return fetch_all(queryset)
+
+        with mock.patch.object(QuerySet, '_fetch_all', autospec=True, side_effect=fetch_all_but_files):
+            names = [file['name'] async for file in aio.iter_files(drive, self.user, offset=1)]
+        self.assertEqual(names, ['1.txt', '0.txt'])
+
+    @override_settings(DRIVE_DOWNLOAD_CHUNK_SIZE=4)
+    async def test_download_streamed(self):
+        file = self.drive.add('notes.txt', content=b'some notes')
+        timed = utils.DRIVE_REQUEST_SECONDS.count(operation='drive.files.download')
+        response = await self.async_client.get(reverse('download_file', args=[file['id']]))
+        self.assertEqual(utils.DRIVE_REQUEST_SECONDS.count(operation='drive.files.download'), timed + 1)
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="notes.txt"')
+        self.assertEqual(response['Content-Length'], '10')
+        self.assertEqual(b''.join([chunk async for chunk in response.streaming_content]), b'some notes')
+
+    async def test_repeat_download_served_from_disk(self):
+        file = self.drive.add('notes.txt', content=b'some notes')
+        for _ in range(2):
+            response = await self.async_client.get(reverse('download_file', args=[file['id']]))
+            self.assertEqual(b''.join([chunk async for chunk in response.streaming_content]), b'some notes')
+        self.assertEqual(self.drive.paths().count(f"/files/{file['id']}"), 1)
+
+    async def test_range_fetched_from_drive(self):
+        file = self.drive.add('notes.txt', content=b'some notes')
+        response = await self.async_client.get(reverse('download_file', args=[file['id']]), headers={'Range': 'bytes=5-'})
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 5-9/10')
+        self.assertEqual(b''.join([chunk async for chunk in response.streaming_content]), b'notes')
+
+        response = await self.async_client.get(
+            reverse('download_file', args=[file['id']]), headers={'If-None-Match': response['ETag']}
+        )
+        self.assertEqual(response.status_code, 304)
+
+    async def test_drive_error_before_first_byte_redirects(self):
+        file = self.drive.add('notes.txt', content=b'some notes')
+        self.drive.failures[file['id']] = 403
+        response = await self.async_client.get(reverse('download_file', args=[file['id']]))
+        self.assertRedirects(response, reverse('file_list'), fetch_redirect_response=False)
+
+    @override_settings(DRIVE_UPLOAD_CHUNK_SIZE=256 * 1024)
+    @mock.patch('files.aio._backoff', return_value=0)
+    async def test_uploads_resumed_after_transient_error(self, backoff):
+        failed = []
+
+        def fail_once(request):
+            if request.method == 'PUT' and 'bytes 262144-' in request.headers.get('content-range', '') and not failed:
+                failed.append(request)
+                return httpx.Response(503)
+        self.intercept = fail_once
+
+        content = os.urandom(600 * 1024)
+        response = await self.async_client.post(reverse('upload_file'), {'file': [
+            SimpleUploadedFile('big.bin', content), SimpleUploadedFile('small.txt', b'small'),
+        ]})
+        self.assertEqual([str(m) for m in get_messages(response.asgi_request)], ["2 files uploaded successfully!"])
+        self.assertEqual(len(failed), 1)
+        contents = {file['name']: self.drive.contents[file['id']] for file in self.drive.files.values()}
+        self.assertEqual(contents, {'big.bin': content, 'small.txt': b'small'})
+        self.assertEqual(await DriveFile.objects.filter(user=self.user).acount(), 2)
+
+    async def test_rejected_token_refreshed_once(self):
+        self.credentials.refresh = mock.Mock(side_effect=lambda request: setattr(self.credentials, 'token', 'fresh'))
+        self.intercept = lambda request: (
+            httpx.Response(401) if request.headers['authorization'] == 'Bearer token' else None
+        )
+        response = await self.async_client.get(reverse('file_list_data'))
+        self.assertEqual(response.status_code, 200)
+        self.credentials.refresh.assert_called_once()
+
+CREDENTIALS = {
+    'token': 'token', 'refresh_token': 'refresh', 'token_uri': 'https://oauth2.googleapis.com/token',
+    'client_id': 'client', 'client_secret': 'secret', 'scopes': ['https://www.googleapis.com/auth/drive.file'],
+}
+
+
+class JobTests(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username='alice@example.com', email='alice@example.com')
+        self.client.force_login(self.user)
+        save_credentials(self.user, utils.credentials_from_dict(CREDENTIALS))
+        self.addCleanup(reset_credentials_cache)
+
+        spool = tempfile.TemporaryDirectory()
+        self.addCleanup(spool.cleanup)
+        overridden = override_settings(DRIVE_JOBS={**settings.DRIVE_JOBS, 'SPOOL_DIR': spool.name})
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+
+        self.drive = FakeDrive()
+        self.service = fake_drive_service([])
+        self.service._http = self.drive
+        # One transfer at a time: concurrent jobs writing DriveFile rows to the shared
+        # in-memory test database can fail with "database table is locked", which
+        # busy_timeout does not cover
+        self.runner = self.make_runner(jobs.MemoryJobStore(), per_user=1)
+        for target, value in (
+            ('files.jobs.build_drive_service', self.service),
+            ('files.views.get_drive_service', self.service),
+            ('files.views.get_job_runner', self.runner),
+        ):
+            patcher = mock.patch(target, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def make_runner(self, store, **kwargs):
+        runner = jobs.JobRunner(store, **{'workers': 4, 'per_user': 2, **kwargs})
+        self.addCleanup(runner.stop)
+        return runner
+
+    def wait(self, runner, job_ids, timeout=5):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            found = [runner.store.get(job_id) for job_id in job_ids]
+            if all(job['state'] in (jobs.DONE, jobs.FAILED) for job in found):
+                return found
+            time.sleep(0.01)
+        self.fail(f"Jobs did not finish: {[job['state'] for job in found]}")
+
+    def test_session_credentials_moved_to_store(self):
+        GoogleCredentials.objects.all().delete()
+        reset_credentials_cache()
+        session = self.client.session
+        session['google_credentials'] = {**CREDENTIALS, 'token': 'from-session'}
+        session.save()
+
+        request = RequestFactory().get('/')
+        request.user, request.session = self.user, self.client.session
+        self.assertEqual(utils.get_user_credentials(request).token, 'from-session')
+        self.assertNotIn('google_credentials', request.session)
+        self.assertEqual(GoogleCredentials.objects.get(user=self.user).token, 'from-session')
+
+    def test_upload_queued_and_run_in_background(self):
+        response = self.client.post(reverse('queue_upload'), {
+            'file': [SimpleUploadedFile('a.txt', b'aaa'), SimpleUploadedFile('b.txt', b'bbb')]
+        })
+        self.assertEqual(response.status_code, 202)
+        queued = response.json()['jobs']
+        self.assertNotIn('credentials', queued[0])
+
+        done = self.wait(self.runner, [job['id'] for job in queued])
+        self.assertEqual([job['state'] for job in done], [jobs.DONE, jobs.DONE])
+        self.assertEqual(sorted(self.drive.contents.values()), [b'aaa', b'bbb'])
+        self.assertFalse(any(os.path.exists(job['spool_path'] or '') for job in done))
+        self.assertEqual(DriveFile.objects.filter(user=self.user).count(), 2)
+        self.assertEqual(len(self.client.get(reverse('job_list')).json()['jobs']), 2)
+
+    @override_settings(DRIVE_DOWNLOAD_CHUNK_SIZE=4)
+    def test_download_fetched_into_spool_and_served(self):
+        file = self.drive.add('notes.txt', content=b'0123456789')
+        response = self.client.post(reverse('queue_download', args=[file['id']]))
+        self.assertEqual(response.status_code, 202)
+
+        (job,) = self.wait(self.runner, [response.json()['job']['id']])
+        self.assertEqual((job['state'], job['transferred'], job['size']), (jobs.DONE, 10, 10))
+        response = self.client.get(reverse('job_file', args=[job['id']]))
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="notes.txt"')
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+
+    def test_failed_job_recorded(self):
+        file = self.drive.add('notes.txt', content=b'0123456789')
+        self.drive.failures[file['id']] = 403
+        job = self.runner.submit(jobs.download_job(self.user.pk, file))
+        (job,) = self.wait(self.runner, [job['id']])
+        self.assertEqual(job['state'], jobs.FAILED)
+        self.assertIn('403', job['error'])
+        self.assertEqual(self.client.get(reverse('job_file', args=[job['id']])).status_code, 404)
+
+    def test_job_fails_once_credentials_removed(self):
+        file = self.drive.add('notes.txt', content=b'0123456789')
+        GoogleCredentials.objects.filter(user=self.user).delete()
+        reset_credentials_cache()
+        job = self.runner.submit(jobs.download_job(self.user.pk, file))
+        (job,) = self.wait(self.runner, [job['id']])
+        self.assertEqual(job['state'], jobs.FAILED)
+        self.assertIn('no Google credentials', job['error'])
+        self.assertEqual(self.drive.requests, [])
+
+    def test_sqlite_store_keeps_no_tokens(self):
+        path = os.path.join(settings.DRIVE_JOBS['SPOOL_DIR'], 'jobs.sqlite3')
+        os.makedirs(settings.DRIVE_JOBS['SPOOL_DIR'], exist_ok=True)
+        file = self.drive.add('notes.txt', content=b'0123456789')
+        # Written by an earlier version, which stored the tokens with the job
+        jobs.SQLiteJobStore(path).add({**jobs.download_job(self.user.pk, file), 'credentials': CREDENTIALS})
+
+        store = jobs.SQLiteJobStore(path)
+        store.add(jobs.download_job(self.user.pk, file))
+        self.assertTrue(all('credentials' not in job for job in store.for_user(self.user.pk)))
+        store.db.close()
+        with open(path, 'rb') as db:
+            self.assertNotIn(b'secret', db.read())
+
+    def test_other_users_jobs_hidden(self):
+        other = User.objects.create_user(username='bob@example.com', email='bob@example.com')
+        file = self.drive.add('notes.txt', content=b'secret')
+        job = self.runner.submit(jobs.download_job(other.pk, file))
+        self.wait(self.runner, [job['id']])
+        self.assertEqual(self.client.get(reverse('job_file', args=[job['id']])).status_code, 404)
+        self.assertEqual(self.client.get(reverse('job_list')).json()['jobs'], [])
+
+    def test_per_user_concurrency_limited(self):
+        running = defaultdict(int)
+        peak = defaultdict(int)
+        lock = threading.Lock()
+
+        def transfer(job, progress):
+            with lock:
+                running[job['user_id']] += 1
+                peak[job['user_id']] = max(peak[job['user_id']], running[job['user_id']])
+            time.sleep(0.05)
+            with lock:
+                running[job['user_id']] -= 1
+            return {}
+
+        runner = self.make_runner(jobs.MemoryJobStore(), workers=3, per_user=1)
+        with mock.patch.dict(jobs.TRANSFERS, {jobs.DOWNLOAD: transfer}):
+            submitted = [
+                runner.submit(jobs.download_job(user_id, {'id': f'file-{i}'}))
+                for i in range(4) for user_id in (1, 2)
+            ]
+            self.wait(runner, [job['id'] for job in submitted])
+        self.assertEqual(dict(peak), {1: 1, 2: 1})
+
+    def test_sqlite_store_resumes_unfinished_jobs(self):
+        path = os.path.join(settings.DRIVE_JOBS['SPOOL_DIR'], 'jobs.sqlite3')
+        os.makedirs(settings.DRIVE_JOBS['SPOOL_DIR'], exist_ok=True)
+        file = self.drive.add('notes.txt', content=b'0123456789')
+
+        # Left behind by a process that stopped mid-transfer
+        job = jobs.download_job(self.user.pk, file)
+        jobs.SQLiteJobStore(path).add({**job, 'state': jobs.RUNNING, 'transferred': 4})
+
+        runner = self.make_runner(jobs.SQLiteJobStore(path))
+        runner.start()
+        (job,) = self.wait(runner, [job['id']])
+        self.assertEqual((job['state'], job['transferred']), (jobs.DONE, 10))
+        self.assertEqual(jobs.SQLiteJobStore(path).for_user(self.user.pk)[0]['state'], jobs.DONE)
+
+    def test_sqlite_store_claims_each_job_once(self):
+        path = os.path.join(settings.DRIVE_JOBS['SPOOL_DIR'], 'jobs.sqlite3')
+        os.makedirs(settings.DRIVE_JOBS['SPOOL_DIR'], exist_ok=True)
+        job = jobs.download_job(self.user.pk, {'id': 'file-1'})
+        first, second = jobs.SQLiteJobStore(path), jobs.SQLiteJobStore(path)
+        first.add(job)
+        self.assertEqual(first.claim(job['id'], 'a', time.time() + 60)['owner'], 'a')
+        self.assertIsNone(second.claim(job['id'], 'b', time.time() + 60))
+
+    def test_job_leased_by_live_runner_left_alone(self):
+        path = os.path.join(settings.DRIVE_JOBS['SPOOL_DIR'], 'jobs.sqlite3')
+        os.makedirs(settings.DRIVE_JOBS['SPOOL_DIR'], exist_ok=True)
+        file = self.drive.add('notes.txt', content=b'0123456789')
+        job = jobs.download_job(self.user.pk, file)
+        # Running in another process sharing the store
+        elsewhere = jobs.SQLiteJobStore(path)
+        elsewhere.add(job)
+        elsewhere.claim(job['id'], 'elsewhere', time.time() + 60)
+
+        runner = self.make_runner(jobs.SQLiteJobStore(path))
+        runner.start()
+        time.sleep(0.1)
+        self.assertEqual(runner.store.get(job['id'])['state'], jobs.RUNNING)
+        self.assertEqual(self.drive.requests, [])
+
+        # That process stops renewing its lease
+        elsewhere.renew('elsewhere', time.time() - 1)
+        runner.recover()
+        (job,) = self.wait(runner, [job['id']])
+        self.assertEqual((job['state'], job['owner']), (jobs.DONE, runner.worker_id))
+
+    @override_settings(DRIVE_DOWNLOAD_CHUNK_SIZE=4)
+    async def test_progress_pushed_over_websocket(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/files/jobs/')
+        communicator.scope['user'] = self.user
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        self.assertEqual(json.loads(await communicator.receive_from()), {'type': 'jobs', 'jobs': []})
+
+        file = self.drive.add('notes.txt', content=b'0123456789')
+        self.runner.submit(jobs.download_job(self.user.pk, file))
+        events = []
+        while not events or events[-1]['state'] not in (jobs.DONE, jobs.FAILED):
+            events.append(json.loads(await communicator.receive_from(timeout=5))['job'])
+        await communicator.disconnect()
+
+        self.assertEqual(events[0]['state'], jobs.RUNNING)
+        self.assertEqual([event['transferred'] for event in events[1:-1]], [4, 8, 10])
+        self.assertEqual(events[-1]['state'], jobs.DONE)
+
+    async def test_anonymous_socket_rejected(self):
+        communicator = WebsocketCommunicator(URLRouter(websocket_urlpatterns), '/ws/files/jobs/')
+        communicator.scope['user'] = AnonymousUser()
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
@@ -0,0 +1,115 @@
+"""Streaming, resumable uploads to Google Drive.
+
+Uploaded files are read straight from the file Django already spooled them
+to (``TemporaryFileUploadHandler`` writes anything over
+``FILE_UPLOAD_MAX_MEMORY_SIZE`` to disk) and sent to Drive in
+``DRIVE_UPLOAD_CHUNK_SIZE`` pieces of a resumable upload session, so the
+file is never read into memory as a whole.
+
+Batches of files are uploaded concurrently, ``DRIVE_TRANSFER_WORKERS`` at a
+time, so a batch takes about as long as its slowest file.
+"""
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httplib2
+from django.conf import settings
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseUpload
+
+from .utils import clone_drive_service
+
+logger = logging.getLogger(__name__)
+
+# Drive requires resumable upload chunks to be multiples of 256 KiB
+CHUNK_GRANULARITY = 256 * 1024
+
+
+def _resumable(error):
+    """Whether an upload may carry on after ``error``: server errors, rate limits
+    and network failures, but not a request Drive turned down"""
+    if isinstance(error, HttpError):
+        return error.resp.status == 429 or error.resp.status >= 500
+    return isinstance(error, (OSError, httplib2.HttpLib2Error))
+
+
+def upload_chunk_size():
+    size = settings.DRIVE_UPLOAD_CHUNK_SIZE
+    return max(CHUNK_GRANULARITY, size - size % CHUNK_GRANULARITY)
+
+
+def upload_to_drive(service, uploaded_file, fields='id, name, webViewLink', progress=None):
+    """Upload a Django ``UploadedFile`` to Drive and return the created file resource.
+
+    ``progress`` is called with ``(bytes_sent, total_bytes)`` after each chunk.
+    Transient failures resume the session from the last byte Drive
+    acknowledged, up to ``DRIVE_UPLOAD_MAX_RESUMES`` times in a row; other
+    errors are raised at once.
+    """
+    uploaded_file.seek(0)
+    media = MediaIoBaseUpload(
+        uploaded_file.file,
+        mimetype=uploaded_file.content_type or 'application/octet-stream',
+        chunksize=upload_chunk_size(),
+        resumable=True
+    )
+    media_request = service.files().create(
+        body={'name': uploaded_file.name},
+        media_body=media,
+        fields=fields
+    )
+
+    response = None
+    resumes = 0
+    while response is None:
+        try:
+            status, response = media_request.next_chunk(num_retries=settings.DRIVE_NUM_RETRIES)
+        except Exception as error:
+            # next_chunk flags the request so the next call first asks Drive
+            # how much it already has, then carries on from there
+            if (
+                not _resumable(error) or media_request.resumable_uri is None
+                or resumes >= settings.DRIVE_UPLOAD_MAX_RESUMES
+            ):
+                raise
+            resumes += 1
+            logger.warning("Resuming upload of %s after error: %s", uploaded_file.name, error)
+            time.sleep(min(2 ** resumes, 30) * random.uniform(0.5, 1))
+            continue
+
+        resumes = 0
+        if progress:
+            if status:
+                progress(status.resumable_progress, status.total_size)
+            elif response is not None:
+                progress(uploaded_file.size, uploaded_file.size)
+
+    return response
+
+
+def upload_files(service, uploaded_files, fields='id, name, webViewLink'):
+    """Upload several files to Drive concurrently.
+
+    Returns ``(uploaded_file, result)`` pairs in input order, where result is
+    the created file resource or the exception that failed its upload.
+    """
+    def upload(uploaded_file):
+        # Each worker thread needs its own client; transports aren't thread-safe
+        return upload_to_drive(clone_drive_service(service), uploaded_file, fields=fields)
+
+    if len(uploaded_files) == 1:
+        try:
+            return [(uploaded_files[0], upload_to_drive(service, uploaded_files[0], fields=fields))]
+        except Exception as error:
+            return [(uploaded_files[0], error)]
+
+    with ThreadPoolExecutor(max_workers=min(settings.DRIVE_TRANSFER_WORKERS, len(uploaded_files))) as pool:
+        futures = [pool.submit(upload, uploaded_file) for uploaded_file in uploaded_files]
+
+    results = []
+    for uploaded_file, future in zip(uploaded_files, futures):
+        error = future.exception()
+        results.append((uploaded_file, error if error is not None else future.result()))
+    return results
@@ -1,10 +1,24 @@
+from django.conf import settings
 from django.urls import path
-from . import views
-
-urlpatterns = [
-    path('', views.drive_home, name='drive_home'),
-    path('connect/', views.connect_drive, name='connect_drive'),
-    path('upload/', views.upload_file, name='upload_file'),
-    path('list/', views.file_list, name='file_list'),
-    path('download/<str:file_id>/', views.download_file, name='download_file'),
-]
\ No newline at end of file
+from . import async_views, views
+
+
+def drive_urlpatterns(transfer_views):
+    """The files app's routes, with listing, download and upload served by ``transfer_views``"""
+    return [
+        path('', views.drive_home, name='drive_home'),
+        path('connect/', views.connect_drive, name='connect_drive'),
+        path('upload/', transfer_views.upload_file, name='upload_file'),
+        path('list/', views.file_list, name='file_list'),
+        path('list/data/', transfer_views.file_list_data, name='file_list_data'),
+        path('list/stream/', transfer_views.file_list_stream, name='file_list_stream'),
+        path('download/archive/', views.download_archive, name='download_archive'),
+        path('download/<str:file_id>/', transfer_views.download_file, name='download_file'),
+        path('jobs/', views.job_list, name='job_list'),
+        path('jobs/upload/', views.queue_upload, name='queue_upload'),
+        path('jobs/download/<str:file_id>/', views.queue_download, name='queue_download'),
+        path('jobs/<str:job_id>/file/', views.job_file, name='job_file'),
+    ]
+
+
+urlpatterns = drive_urlpatterns(async_views if settings.DRIVE_ASYNC_IO else views)
@@ -1,23 +1,163 @@
+import functools
+import json
+import logging
+import threading
+from collections import OrderedDict
+
+import httplib2
+from accounts.credentials import get_credentials, save_credentials
+from django.conf import settings
 from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
+from google_auth_httplib2 import AuthorizedHttp
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.http import HttpRequest
+from socialconnect.metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+# Resource accessors such as service.files() rebuild every API method (and
+# its docstring) on each call, so they are memoized on cached services
+CACHED_RESOURCES = ('about', 'changes', 'files')
+
+DRIVE_REQUEST_SECONDS = Histogram(
+    'drive_api_request_duration_seconds', 'Time taken by Drive API calls, retries included.', ['operation'],
+)
+
+_discovery_document = None
+_discovery_lock = threading.Lock()
+_local = threading.local()
+
+
+def get_discovery_document():
+    """Parsed Drive v3 discovery document, loaded from the bundled copy once per process"""
+    global _discovery_document
+    if _discovery_document is None:
+        with _discovery_lock:
+            if _discovery_document is None:
+                _discovery_document = json.loads(get_static_doc('drive', 'v3'))
+    return _discovery_document
+
+
+class TimedHttpRequest(HttpRequest):
+    """Drive API request that records how long it takes, by API method"""
+
+    def execute(self, *args, **kwargs):
+        with DRIVE_REQUEST_SECONDS.time(operation=self.methodId):
+            return super().execute(*args, **kwargs)
+
+    def next_chunk(self, *args, **kwargs):
+        # One chunk of a resumable upload
+        with DRIVE_REQUEST_SECONDS.time(operation=self.methodId):
+            return super().next_chunk(*args, **kwargs)
+
+
+def get_http_transport():
+    """This thread's keep-alive HTTP transport.
+
+    httplib2.Http is not thread-safe, so each thread reuses its own instead
+    of opening a new connection to Google for every request.
+    """
+    http = getattr(_local, 'http', None)
+    if http is None:
+        http = _local.http = httplib2.Http(timeout=settings.DRIVE_HTTP_TIMEOUT)
+    return http
+
+
+def private_transport(http):
+    """A copy of an authorized transport with its own connection, for requests
+    that may be executed from other threads (e.g. streamed downloads)"""
+    if isinstance(http, AuthorizedHttp):
+        return AuthorizedHttp(http.credentials, http=httplib2.Http(timeout=settings.DRIVE_HTTP_TIMEOUT))
+    return http
+
+
+def build_drive_service(credentials=None, http=None):
+    """Drive client built from the cached discovery document"""
+    http = http or get_http_transport()
+    if credentials is not None:
+        http = AuthorizedHttp(credentials, http=http)
+
+    service = build_from_document(get_discovery_document(), http=http, requestBuilder=TimedHttpRequest)
+    for name in CACHED_RESOURCES:
+        setattr(service, name, functools.cache(getattr(service, name)))
+    return service
+
+
+def clone_drive_service(service):
+    """A client for the calling thread that authorizes like ``service``.
+
+    Worker threads use this instead of sharing another thread's transport.
+    """
+    if isinstance(service._http, AuthorizedHttp):
+        return build_drive_service(service._http.credentials)
+    return service
+
+
+def get_user_drive_service(user_key, credentials):
+    """This thread's Drive client for one user, built on first use.
+
+    Later calls only rebind the (possibly refreshed) credentials on the
+    client's transport instead of building a new client.
+    """
+    services = getattr(_local, 'services', None)
+    if services is None:
+        services = _local.services = OrderedDict()
+
+    if user_key in services:
+        services.move_to_end(user_key)
+        service, authorized_http = services[user_key]
+        authorized_http.credentials = credentials
+        return service
+
+    authorized_http = AuthorizedHttp(credentials, http=get_http_transport())
+    services[user_key] = (build_drive_service(http=authorized_http), authorized_http)
+    while len(services) > settings.DRIVE_SERVICE_CACHE_SIZE:
+        services.popitem(last=False)
+    return services[user_key][0]
+
+
+def credentials_from_dict(creds_dict):
+    """OAuth credentials from the dict stored at login"""
+    return Credentials(
+        token=creds_dict['token'],
+        refresh_token=creds_dict['refresh_token'],
+        token_uri=creds_dict['token_uri'],
+        client_id=creds_dict['client_id'],
+        client_secret=creds_dict['client_secret'],
+        scopes=creds_dict['scopes']
+    )
+
+
+def credentials_to_dict(credentials):
+    return {
+        'token': credentials.token,
+        'refresh_token': credentials.refresh_token,
+        'token_uri': credentials.token_uri,
+        'client_id': credentials.client_id,
+        'client_secret': credentials.client_secret,
+        'scopes': credentials.scopes,
+    }
+
+
+def get_user_credentials(request):
+    """The signed-in user's shared Google credentials, or None before they connect Google"""
+    credentials = get_credentials(request.user.pk)
+    if credentials is None and request.session.get('google_credentials'):
+        # Signed in while tokens were kept in the session: move them to the store
+        save_credentials(request.user, credentials_from_dict(request.session.pop('google_credentials')))
+        credentials = get_credentials(request.user.pk)
+    return credentials
+
 
 def get_drive_service(request):
     """Get Google Drive service using stored credentials"""
     try:
-        creds_dict = request.session.get('google_credentials')
-        if not creds_dict:
+        credentials = get_user_credentials(request)
+        if not credentials:
             return None
-            
-        credentials = Credentials(
-            token=creds_dict['token'],
-            refresh_token=creds_dict['refresh_token'],
-            token_uri=creds_dict['token_uri'],
-            client_id=creds_dict['client_id'],
-            client_secret=creds_dict['client_secret'],
-            scopes=creds_dict['scopes']
-        )
-        
-        return build('drive', 'v3', credentials=credentials)
+
+        return get_user_drive_service(request.user.pk, credentials)
     except Exception as e:
-        print(f"Error getting Drive service: {str(e)}")
-        return None
\ No newline at end of file
+        logger.error("Error getting Drive service: %s", e)
+        return None
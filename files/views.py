@@ -1,13 +1,24 @@
-from django.http import HttpResponse
+from django.conf import settings
+from django.http import FileResponse, Http404, JsonResponse
 from django.shortcuts import render, redirect
 from django.contrib.auth.decorators import login_required
+from django.views.decorators.http import require_POST
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 from django.contrib import messages
-from .utils import get_drive_service
-from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload, MediaIoBaseUpload
-import io
+from .utils import get_drive_service, get_user_credentials
+from . import metadata
+from .content_cache import content_key, file_response, get_content_cache
+from .downloads import (
+    conditional_response, range_not_satisfiable, requested_range, set_validators,
+    streaming_archive_response, streaming_download_response,
+)
+from .jobs import DONE, DOWNLOAD, download_job, get_job_runner, public_job, upload_job
+from .listing import list_row, streaming_list_response
+from .uploads import upload_files
 import logging
+import os
+import re
 
 logger = logging.getLogger(__name__)
 
@@ -59,18 +70,40 @@ def connect_drive(request):
         return redirect('drive_home')
         
     except Exception as e:
-        logger.error(f"Drive connection error: {str(e)}")
+        logger.error("Drive connection error: %s", e)
         messages.error(request, "Failed to connect to Google Drive. Please try again.")
         return redirect('drive_home')
 
+def _report_uploads(request, uploaded_files, results):
+    """Cache the uploaded files' metadata and flash a message summing up the batch"""
+    uploaded, failed = [], []
+    for uploaded_file, result in results:
+        if isinstance(result, Exception):
+            logger.error("Upload error for %s: %s", uploaded_file.name, result)
+            failed.append(uploaded_file.name)
+        else:
+            metadata.store_file(request.user, result)
+            uploaded.append(result)
+
+    if len(uploaded) == 1:
+        logger.info("File uploaded successfully: %s", uploaded[0].get('name'))
+        messages.success(request, f"File '{uploaded[0].get('name')}' uploaded successfully!")
+    elif uploaded:
+        logger.info("%s files uploaded successfully", len(uploaded))
+        messages.success(request, f"{len(uploaded)} files uploaded successfully!")
+    if len(uploaded_files) == 1 and failed:
+        messages.error(request, "Upload failed. Please try again.")
+    elif failed:
+        messages.error(request, f"Upload failed for {', '.join(failed)}. Please try again.")
+
 @login_required
 def upload_file(request):
-    """Handle file uploads to Google Drive"""
+    """Handle file uploads to Google Drive; several files are uploaded concurrently"""
     logger.info("Starting file upload process")
     if request.method == 'POST' and request.FILES.get('file'):
         try:
-            uploaded_file = request.FILES['file']
-            logger.info(f"Processing upload: {uploaded_file.name}")
+            uploaded_files = request.FILES.getlist('file')
+            logger.info("Processing upload: %s", ', '.join(f.name for f in uploaded_files))
 
             service = get_drive_service(request)
             if not service:
@@ -78,26 +111,11 @@ def upload_file(request):
                 messages.error(request, "Drive service not available. Please reconnect.")
                 return redirect('drive_home')
 
-            file_metadata = {'name': uploaded_file.name}
-            file_content = uploaded_file.read()
-            
-            fh = io.BytesIO(file_content)
-            media = MediaIoBaseUpload(fh, 
-                                    mimetype=uploaded_file.content_type,
-                                    resumable=True)
-
-            file = service.files().create(
-                body=file_metadata,
-                media_body=media,
-                fields='id, name, webViewLink'
-            ).execute()
-
-            logger.info(f"File uploaded successfully: {file.get('name')}")
-            messages.success(request, f"File '{file.get('name')}' uploaded successfully!")
+            _report_uploads(request, uploaded_files, upload_files(service, uploaded_files, fields=metadata.FILE_FIELDS))
             return redirect('drive_home')
 
         except Exception as e:
-            logger.error(f"Upload error: {str(e)}")
+            logger.error("Upload error: %s", e)
             messages.error(request, "Upload failed. Please try again.")
             return redirect('drive_home')
 
@@ -105,7 +123,12 @@ def upload_file(request):
 
 @login_required
 def file_list(request):
-    """List files from Google Drive"""
+    """List files from Google Drive.
+
+    Renders the first page from the metadata cache; drive.js streams the
+    rest from ``file_list_stream``. On a cold cache the page renders empty
+    and the stream fills it as Drive returns each page.
+    """
     logger.info("Fetching file list")
     try:
         service = get_drive_service(request)
@@ -115,26 +138,73 @@ def file_list(request):
             messages.error(request, "Please connect to Google Drive first")
             return redirect('drive_home')
         
-        results = service.files().list(
-            pageSize=10,
-            fields="nextPageToken, files(id, name, mimeType, webViewLink, createdTime, modifiedTime)",
-            orderBy="modifiedTime desc"
-        ).execute()
-        
-        files = results.get('files', [])
-        logger.info(f"Retrieved {len(files)} files")
+        files = []
+        complete = False
+        if metadata.is_synced(request.user):
+            metadata.refresh(service, request.user)
+            cached = metadata.cached_files(request.user)[:settings.DRIVE_LIST_PAGE_SIZE]
+            files = [list_row(file) for file in cached]
+            complete = len(files) < settings.DRIVE_LIST_PAGE_SIZE
+        logger.info("Retrieved %s files", len(files))
 
-        return render(request, 'files/file_list.html', {'files': files})
+        return render(request, 'files/file_list.html', {'files': files, 'complete': complete})
 
     except Exception as e:
-        logger.error(f"Error fetching files: {str(e)}")
+        logger.error("Error fetching files: %s", e)
         messages.error(request, "Failed to fetch files. Please try again.")
         return redirect('drive_home')
 
+def _page_params(request):
+    offset = int(request.GET.get('offset') or 0)
+    limit = int(request.GET.get('limit') or settings.DRIVE_LIST_PAGE_SIZE)
+    if offset < 0 or limit < 1:
+        raise ValueError("offset and limit must be positive")
+    return offset, min(limit, settings.DRIVE_LIST_MAX_PAGE_SIZE)
+
+@login_required
+def file_list_data(request):
+    """Paginated file listing as JSON: ?offset=<next_offset>&limit=<n>"""
+    try:
+        offset, limit = _page_params(request)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid offset or limit'}, status=400)
+
+    service = get_drive_service(request)
+    if not service:
+        return JsonResponse({'error': 'Drive service not available'}, status=401)
+
+    try:
+        metadata.refresh(service, request.user)
+        page = [list_row(file) for file in metadata.cached_files(request.user)[offset:offset + limit + 1]]
+    except Exception as e:
+        logger.error("Error fetching files: %s", e)
+        return JsonResponse({'error': 'Failed to fetch files'}, status=502)
+
+    next_offset = offset + limit if len(page) > limit else None
+    return JsonResponse({'files': page[:limit], 'next_offset': next_offset})
+
+@login_required
+def file_list_stream(request):
+    """Every file after ?offset=<n> as a stream of NDJSON rows"""
+    try:
+        offset, _ = _page_params(request)
+    except ValueError:
+        return JsonResponse({'error': 'Invalid offset'}, status=400)
+
+    service = get_drive_service(request)
+    if not service:
+        return JsonResponse({'error': 'Drive service not available'}, status=401)
+
+    try:
+        return streaming_list_response(request, metadata.iter_files(service, request.user, offset))
+    except Exception as e:
+        logger.error("Error streaming files: %s", e)
+        return JsonResponse({'error': 'Failed to fetch files'}, status=502)
+
 @login_required
 def download_file(request, file_id):
     """Download files from Google Drive"""
-    logger.info(f"Initiating download for file: {file_id}")
+    logger.info("Initiating download for file: %s", file_id)
     
     try:
         service = get_drive_service(request)
@@ -144,34 +214,168 @@ def download_file(request, file_id):
             messages.error(request, "Please connect to Google Drive first")
             return redirect('file_list')
 
-        file_metadata = service.files().get(fileId=file_id).execute()
+        file_metadata = metadata.get_file_metadata(service, request.user, file_id)
         file_name = file_metadata.get('name', 'downloaded_file')
         mime_type = file_metadata.get('mimeType', 'application/octet-stream')
-        
+
+        # The browser may already hold this version, or part of it
+        not_modified = conditional_response(request, file_metadata)
+        if not_modified:
+            return not_modified
         try:
-            request = service.files().get_media(fileId=file_id)
-            file_buffer = io.BytesIO()
-            downloader = MediaIoBaseDownload(file_buffer, request)
-            
-            done = False
-            while not done:
-                status, done = downloader.next_chunk()
-                
-            logger.info("Download completed successfully")
-            file_buffer.seek(0)
-            
-            response = HttpResponse(file_buffer.read(), content_type=mime_type)
-            response['Content-Disposition'] = f'attachment; filename="{file_name}"'
-            response['Content-Length'] = file_buffer.getbuffer().nbytes
-            
+            byte_range = requested_range(request, file_metadata)
+        except ValueError:
+            return range_not_satisfiable(file_metadata)
+
+        cache = get_content_cache()
+        cache_key = content_key(file_metadata) if cache and cache.cacheable(file_metadata) else None
+        if cache_key and (path := cache.get(cache_key)):
+            logger.info("Download served from the content cache")
+            response = file_response(request, path, file_name, mime_type, byte_range)
+            set_validators(response, file_metadata)
+            return response
+
+        try:
+            media_request = service.files().get_media(fileId=file_id)
+            # Only whole files are worth keeping
+            tee = (lambda chunks: cache.tee(cache_key, chunks, file_metadata['size'])) if cache_key and not byte_range else None
+            response = streaming_download_response(
+                request, media_request, file_name, mime_type, size=file_metadata.get('size'),
+                tee=tee, byte_range=byte_range,
+            )
+            set_validators(response, file_metadata)
+            logger.info("Download streaming started")
             return response
 
         except Exception as download_error:
-            logger.error(f"Download error: {str(download_error)}")
+            logger.error("Download error: %s", download_error)
             messages.error(request, "Download failed. Please try again.")
             return redirect('file_list')
 
     except Exception as e:
-        logger.error(f"File access error: {str(e)}")
+        logger.error("File access error: %s", e)
         messages.error(request, "Failed to access file. Please try again.")
-        return redirect('file_list')
\ No newline at end of file
+        return redirect('file_list')
+
+def _archive_name(name):
+    """Flat archive member name: Drive names may hold path separators, drive letters or '..'"""
+    name = re.sub(r'^[A-Za-z]:', '', name)
+    return name.replace('/', '_').replace('\\', '_').lstrip('.')
+
+
+def _archive_entries(files):
+    """(archive name, media request factory) pairs for files that can be downloaded"""
+    entries = []
+    names = set()
+    for file in files:
+        mime_type = file.get('mimeType', '')
+        file_info = get_file_type_info(mime_type)
+        name = _archive_name(file.get('name', '')) or file['id']
+        if 'export_type' in file_info:
+            name += file_info['extension']
+            make_request = lambda service, file_id=file['id'], export_type=file_info['export_type']: (
+                service.files().export_media(fileId=file_id, mimeType=export_type)
+            )
+        elif mime_type.startswith('application/vnd.google-apps.'):
+            # Folders, forms and the like have no content to download
+            continue
+        else:
+            make_request = lambda service, file_id=file['id']: service.files().get_media(fileId=file_id)
+
+        # Keep names unique so no file shadows another when extracted
+        stem, extension = os.path.splitext(name)
+        unique, copy = name, 1
+        while unique in names:
+            unique = f"{stem} ({copy}){extension}"
+            copy += 1
+        names.add(unique)
+        entries.append((unique, make_request))
+    return entries
+
+@login_required
+@require_POST
+def download_archive(request):
+    """Download the selected files as one ZIP archive, built while it streams"""
+    file_ids = request.POST.getlist('file_id')
+    logger.info("Initiating archive download of %s files", len(file_ids))
+    if not file_ids or len(file_ids) > settings.DRIVE_ARCHIVE_MAX_FILES:
+        messages.error(request, f"Select between 1 and {settings.DRIVE_ARCHIVE_MAX_FILES} files to download.")
+        return redirect('file_list')
+
+    try:
+        service = get_drive_service(request)
+
+        if not service:
+            logger.warning("Drive service not available")
+            messages.error(request, "Please connect to Google Drive first")
+            return redirect('file_list')
+
+        entries = _archive_entries(metadata.get_files_metadata(service, request.user, file_ids))
+        if not entries:
+            messages.error(request, "None of the selected files can be downloaded.")
+            return redirect('file_list')
+
+        return streaming_archive_response(request, service, entries, 'drive-files.zip')
+
+    except Exception as e:
+        logger.error("Archive download error: %s", e)
+        messages.error(request, "Download failed. Please try again.")
+        return redirect('file_list')
+
+
+@login_required
+@require_POST
+def queue_upload(request):
+    """Queue uploads as background jobs; progress arrives over the jobs WebSocket"""
+    uploaded_files = request.FILES.getlist('file')
+    if not uploaded_files:
+        return JsonResponse({'error': 'No files uploaded'}, status=400)
+
+    # Jobs look the credentials up when they run; only check the user has some
+    if not get_user_credentials(request):
+        return JsonResponse({'error': 'Drive service not available'}, status=401)
+
+    runner = get_job_runner()
+    queued = [runner.submit(upload_job(request.user.pk, f)) for f in uploaded_files]
+    logger.info("Queued %s upload jobs", len(queued))
+    return JsonResponse({'jobs': [public_job(job) for job in queued]}, status=202)
+
+@login_required
+@require_POST
+def queue_download(request, file_id):
+    """Queue a download as a background job; fetch it from ``job_file`` once done"""
+    service = get_drive_service(request)
+    if not get_user_credentials(request) or not service:
+        return JsonResponse({'error': 'Drive service not available'}, status=401)
+
+    try:
+        file = metadata.get_file_metadata(service, request.user, file_id)
+    except Exception as e:
+        logger.error("File access error: %s", e)
+        return JsonResponse({'error': 'Failed to access file'}, status=502)
+
+    file_info = get_file_type_info(file.get('mimeType', ''))
+    name = (file.get('name') or file_id) + file_info['extension']
+    job = get_job_runner().submit(download_job(
+        request.user.pk, file, name=name, export_type=file_info.get('export_type')
+    ))
+    logger.info("Queued download job for file: %s", file_id)
+    return JsonResponse({'job': public_job(job)}, status=202)
+
+@login_required
+def job_list(request):
+    """The user's background transfer jobs"""
+    user_jobs = get_job_runner().store.for_user(request.user.pk)
+    return JsonResponse({'jobs': [public_job(job) for job in user_jobs]})
+
+@login_required
+def job_file(request, job_id):
+    """The file a finished background download fetched"""
+    job = get_job_runner().store.get(job_id)
+    if not job or job['user_id'] != request.user.pk or job['kind'] != DOWNLOAD or job['state'] != DONE:
+        raise Http404("No finished download with that id")
+    if not job['spool_path'] or not os.path.exists(job['spool_path']):
+        raise Http404("The download has expired")
+
+    mime_type = job['export_type'] or job['mime_type'] or 'application/octet-stream'
+    return FileResponse(open(job['spool_path'], 'rb'), as_attachment=True, filename=job['name'], content_type=mime_type)
@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class SocialConnectConfig(AppConfig):
+    name = 'socialconnect'
+    verbose_name = 'SocialConnect'
+
+    def ready(self):
+        # Connects the SQLite tuning every app's connections get
+        from . import db  # noqa: F401
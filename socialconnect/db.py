@@ -0,0 +1,14 @@
+"""Per-connection database tuning"""
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+
+@receiver(connection_created)
+def apply_sqlite_pragmas(sender, connection, **kwargs):
+    """Apply ``SQLITE_PRAGMAS`` to each new SQLite connection"""
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for name, value in settings.SQLITE_PRAGMAS.items():
+            cursor.execute(f'PRAGMA {name} = {value}')
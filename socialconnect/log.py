@@ -0,0 +1,74 @@
+"""Logging that keeps I/O off the request threads and the event loop.
+
+``QueueHandler`` only puts records on a bounded in-memory queue; a
+``QueueListener`` thread formats them (as one JSON object per line with
+``JsonFormatter``) and writes them out. A burst that fills the queue drops
+records rather than stalling the caller.
+"""
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+from datetime import datetime, timezone
+
+# LogRecord attributes that aren't ``extra=`` fields
+RECORD_ATTRIBUTES = frozenset(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in RECORD_ATTRIBUTES)
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry['stack_info'] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str)
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """Hand records to a background thread that writes them to ``stream``.
+
+    The formatter configured for this handler is used by the writing
+    thread; only the message's own ``%`` arguments are merged by the
+    caller, while they still hold the values being logged.
+    """
+
+    def __init__(self, stream=None, maxsize=10000):
+        super().__init__(queue.Queue(maxsize))
+        self.dropped = 0
+        self.target = logging.StreamHandler(stream or sys.stderr)
+        self.listener = logging.handlers.QueueListener(self.queue, self.target)
+        self.listener.start()
+        self.listening = True
+
+    def setFormatter(self, fmt):
+        super().setFormatter(fmt)
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        # Flushes what is still queued; logging.shutdown() calls this at exit
+        if self.listening:
+            self.listening = False
+            self.listener.stop()
+        self.target.close()
+        super().close()
@@ -0,0 +1,248 @@
+"""In-process metrics, served at ``/metrics`` in the Prometheus text format.
+
+Counters and histograms are plain dicts of numbers behind a lock, so
+recording a value costs a dict lookup and an addition. Every worker process
+keeps its own figures; scrape each one (Prometheus adds up the series).
+
+``metrics_middleware`` times HTTP requests per view, ``MetricsConsumerMixin``
+counts a WebSocket consumer's connections and frames and times its group
+sends, and the Drive clients time their API calls.
+"""
+import bisect
+import threading
+import time
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+from django.utils.decorators import sync_and_async_middleware
+
+# Seconds; Prometheus' client defaults
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _copy(self, value):
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+    def expose(self):
+        """This metric's lines of the text format"""
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self.lock:
+            values = sorted((key, self._copy(value)) for key, value in self.values.items())
+        for key, value in values:
+            lines.extend(self._samples(key, value))
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self._key(labels), 0)
+
+    def _samples(self, key, value):
+        yield f'{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}'
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                # Per-bucket (not yet cumulative) counts, the last one for +Inf; then the sum
+                state = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def time(self, **labels):
+        """Context manager observing how long its body takes"""
+        return _Timer(self, labels)
+
+    def count(self, **labels):
+        state = self.values.get(self._key(labels))
+        return sum(state[0]) if state else 0
+
+    def _copy(self, state):
+        return [state[0][:], state[1]]
+
+    def _samples(self, key, state):
+        counts, total = state
+        cumulative = 0
+        for bound, count in zip((*self.buckets, float('inf')), counts):
+            cumulative += count
+            labels = _format_labels(self.label_names, key, [('le', _format_value(bound))])
+            yield f'{self.name}_bucket{labels} {cumulative}'
+        labels = _format_labels(self.label_names, key)
+        yield f'{self.name}_sum{labels} {_format_value(total)}'
+        yield f'{self.name}_count{labels} {cumulative}'
+
+
+def exposition():
+    """Every registered metric, in the Prometheus text format"""
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.expose())
+    return '\n'.join(lines) + '\n'
+
+
+HTTP_REQUEST_SECONDS = Histogram(
+    'http_request_duration_seconds',
+    'Time until a view returned its response (first byte, for streamed responses).',
+    ['view', 'method', 'status'],
+)
+WEBSOCKET_CONNECTS = Counter('websocket_connects_total', 'WebSocket connections accepted.', ['consumer'])
+WEBSOCKET_DISCONNECTS = Counter('websocket_disconnects_total', 'Accepted WebSocket connections closed.', ['consumer'])
+WEBSOCKET_MESSAGES_RECEIVED = Counter('websocket_messages_received_total', 'WebSocket frames received.', ['consumer'])
+WEBSOCKET_MESSAGES_SENT = Counter('websocket_messages_sent_total', 'WebSocket frames sent.', ['consumer'])
+GROUP_SEND_SECONDS = Histogram(
+    'channels_group_send_duration_seconds', 'Time to hand a message to the channel layer for a group.', ['consumer'],
+)
+
+
+def _observe_request(request, response, started):
+    match = request.resolver_match
+    HTTP_REQUEST_SECONDS.observe(
+        time.perf_counter() - started,
+        view=match.view_name if match else '<unmatched>',
+        method=request.method,
+        status=response.status_code,
+    )
+
+
+@sync_and_async_middleware
+def metrics_middleware(get_response):
+    """Record how long each request takes, by view name, method and status"""
+    if iscoroutinefunction(get_response):
+        async def middleware(request):
+            started = time.perf_counter()
+            response = await get_response(request)
+            _observe_request(request, response, started)
+            return response
+    else:
+        def middleware(request):
+            started = time.perf_counter()
+            response = get_response(request)
+            _observe_request(request, response, started)
+            return response
+    return middleware
+
+
+class MetricsConsumerMixin:
+    """Counts a WebSocket consumer's connections and frames; use ``group_send`` to time broadcasts"""
+
+    metrics_accepted = False
+
+    @property
+    def metrics_label(self):
+        return type(self).__name__
+
+    async def accept(self, subprotocol=None, headers=None):
+        await super().accept(subprotocol, headers)
+        self.metrics_accepted = True
+        WEBSOCKET_CONNECTS.inc(consumer=self.metrics_label)
+
+    async def websocket_disconnect(self, message):
+        if self.metrics_accepted:
+            WEBSOCKET_DISCONNECTS.inc(consumer=self.metrics_label)
+        await super().websocket_disconnect(message)
+
+    async def websocket_receive(self, message):
+        WEBSOCKET_MESSAGES_RECEIVED.inc(consumer=self.metrics_label)
+        await super().websocket_receive(message)
+
+    async def send(self, text_data=None, bytes_data=None, close=False):
+        await super().send(text_data=text_data, bytes_data=bytes_data, close=close)
+        WEBSOCKET_MESSAGES_SENT.inc(consumer=self.metrics_label)
+
+    async def group_send(self, group, message):
+        with GROUP_SEND_SECONDS.time(consumer=self.metrics_label):
+            await self.channel_layer.group_send(group, message)
+
+
+def _authorized(request):
+    if request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        return False
+    if not settings.METRICS_TOKEN:
+        return True
+    scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+    return scheme.lower() == 'bearer' and constant_time_compare(token, settings.METRICS_TOKEN)
+
+
+def metrics_view(request):
+    """Prometheus scrape endpoint, open only to ``METRICS_ALLOWED_IPS`` and,
+    when ``METRICS_TOKEN`` is set, only with it as a bearer token"""
+    if not _authorized(request):
+        return HttpResponseForbidden()
+    return HttpResponse(exposition(), content_type=CONTENT_TYPE)
@@ -0,0 +1,220 @@
+"""Opt-in cProfile capture for views and WebSocket consumers.
+
+With ``PROFILING['ENABLED']`` off, ``ProfilingMiddleware`` takes itself out
+of the middleware chain and ``ProfiledConsumerMixin`` costs one settings
+lookup per event. When on, a request is profiled if a staff user sends the
+``PROFILING['HEADER']`` header, or at random at ``PROFILING['SAMPLE_RATE']``.
+WebSocket events are profiled the same way, the header being read from the
+handshake.
+
+Sync views are profiled in the thread that runs them. Async views and
+consumer handlers are profiled on the event loop thread, so work they hand
+to ``sync_to_async`` shows up as time spent awaiting rather than in detail,
+and the capture also includes whatever else the loop ran meanwhile, such as
+other requests and consumers. cProfile allows one active profiler per
+thread, so only one async capture runs at a time; requests and events
+chosen while one is running are not profiled.
+
+Profiles are written to ``PROFILING['DIR']`` as ``.prof`` files, which
+``pstats``, snakeviz and similar tools read; only the newest
+``PROFILING['MAX_FILES']`` are kept. Staff can browse them at /profiles/.
+"""
+import cProfile
+import io
+import logging
+import os
+import pstats
+import random
+import re
+import time
+import uuid
+from datetime import datetime, timezone
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import FileResponse, Http404, HttpResponse
+from django.shortcuts import render
+from django.urls import resolve
+from django.utils.text import slugify
+
+logger = logging.getLogger(__name__)
+
+PROFILE_SUFFIX = '.prof'
+
+# Names profiles are saved under, and the only ones the browsing view serves
+PROFILE_NAME = re.compile(r'[\w.-]+\.prof')
+
+SORT_KEYS = ('cumulative', 'tottime', 'ncalls')
+
+# Set while an async capture has a profiler enabled on the event loop thread
+_async_capture_active = False
+
+
+def _sampled():
+    rate = settings.PROFILING['SAMPLE_RATE']
+    return rate > 0 and random.random() < rate
+
+
+def _staff(user):
+    return user is not None and user.is_staff
+
+
+def save_profile(profile, kind, label):
+    """Write ``profile`` to the profile directory, dropping the oldest past ``MAX_FILES``"""
+    config = settings.PROFILING
+    os.makedirs(config['DIR'], exist_ok=True)
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{kind}-{slugify(label)[:80]}-{uuid.uuid4().hex[:8]}"
+    path = os.path.join(config['DIR'], name + PROFILE_SUFFIX)
+    profile.dump_stats(path)
+    logger.info("Saved %s profile %s", kind, os.path.basename(path))
+
+    for stale in list_profiles()[config['MAX_FILES']:]:
+        try:
+            os.remove(os.path.join(config['DIR'], stale['name']))
+        except FileNotFoundError:
+            pass
+    return path
+
+
+def list_profiles():
+    """Saved profiles, newest first"""
+    try:
+        entries = list(os.scandir(settings.PROFILING['DIR']))
+    except FileNotFoundError:
+        return []
+    profiles = []
+    for entry in entries:
+        if not PROFILE_NAME.fullmatch(entry.name):
+            continue
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        profiles.append({
+            'name': entry.name,
+            'size': stat.st_size,
+            'modified': datetime.fromtimestamp(stat.st_mtime, timezone.utc),
+        })
+    return sorted(profiles, key=lambda profile: (profile['modified'], profile['name']), reverse=True)
+
+
+def _call_profiled(kind, label, func, *args, **kwargs):
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(func, *args, **kwargs)
+    finally:
+        save_profile(profile, kind, label)
+
+
+async def _await_profiled(kind, label, func, *args, **kwargs):
+    global _async_capture_active
+    if _async_capture_active:
+        # A second profiler would displace the running one (or raise, on 3.12+)
+        return await func(*args, **kwargs)
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # Some other profiler is active on this thread (Python 3.12+)
+        return await func(*args, **kwargs)
+    _async_capture_active = True
+    try:
+        return await func(*args, **kwargs)
+    finally:
+        profile.disable()
+        _async_capture_active = False
+        await sync_to_async(save_profile, thread_sensitive=False)(profile, kind, label)
+
+
+class ProfilingMiddleware:
+    """Profile the view of a request chosen by header or sampling.
+
+    Goes after AuthenticationMiddleware, which the staff check needs.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.PROFILING['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        request.profile_wanted = self.header(request) and _staff(request.user) or _sampled()
+        return self.get_response(request)
+
+    async def __acall__(self, request):
+        # Loading the user may query the database, so only do it when asked to profile
+        wanted = self.header(request) and await sync_to_async(_staff)(request.user) or _sampled()
+        request.profile_wanted = wanted
+        if wanted:
+            match = resolve(request.path_info)
+            if iscoroutinefunction(match.func):
+                # Async views run on this thread, so this is where to profile them
+                request.profile_wanted = False
+                return await _await_profiled('http', match.view_name, self.get_response, request)
+        return await self.get_response(request)
+
+    @staticmethod
+    def header(request):
+        return bool(request.headers.get(settings.PROFILING['HEADER']))
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # Sync views: this runs in the thread the view would have run in
+        if not getattr(request, 'profile_wanted', False) or iscoroutinefunction(view_func):
+            return None
+        label = request.resolver_match.view_name if request.resolver_match else request.path
+        return _call_profiled('http', label, view_func, request, *view_args, **view_kwargs)
+
+
+class ProfiledConsumerMixin:
+    """Profile the handlers of an async consumer chosen by handshake header or sampling"""
+
+    profile_requested = None
+
+    async def dispatch(self, message):
+        if not settings.PROFILING['ENABLED']:
+            return await super().dispatch(message)
+        if self.profile_requested is None:
+            # AuthMiddlewareStack has already loaded the user
+            self.profile_requested = bool(self._profile_header()) and _staff(self.scope.get('user'))
+        if not (self.profile_requested or _sampled()):
+            return await super().dispatch(message)
+        label = f"{type(self).__name__}-{message['type']}"
+        return await _await_profiled('ws', label, super().dispatch, message)
+
+    def _profile_header(self):
+        header = settings.PROFILING['HEADER'].lower().encode()
+        return next((value for name, value in self.scope.get('headers', []) if name.lower() == header), None)
+
+
+@staff_member_required
+def profile_list(request):
+    return render(request, 'profiling/profile_list.html', {
+        'profiles': list_profiles(),
+        'header': settings.PROFILING['HEADER'],
+    })
+
+
+@staff_member_required
+def profile_detail(request, name):
+    """A saved profile as pstats text, or the raw file with ``?download``"""
+    if not PROFILE_NAME.fullmatch(name):
+        raise Http404
+    path = os.path.join(settings.PROFILING['DIR'], name)
+    if not os.path.exists(path):
+        raise Http404
+    if 'download' in request.GET:
+        return FileResponse(open(path, 'rb'), as_attachment=True, filename=name)
+
+    sort = request.GET.get('sort') if request.GET.get('sort') in SORT_KEYS else SORT_KEYS[0]
+    output = io.StringIO()
+    pstats.Stats(path, stream=output).strip_dirs().sort_stats(sort).print_stats(settings.PROFILING['TOP'])
+    return HttpResponse(output.getvalue(), content_type='text/plain; charset=utf-8')
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 import os
+import tempfile
 from pathlib import Path
 
 from dotenv import load_dotenv
@@ -43,6 +44,7 @@ ALLOWED_HOSTS = [
 # Application definition
 
 INSTALLED_APPS = [
+    'socialconnect',  # Project-wide signal receivers, such as the SQLite tuning in db.py
     'accounts',
     'chat',
     'files',
@@ -60,6 +62,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'socialconnect.metrics.metrics_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -67,6 +70,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'socialconnect.profiling.ProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'socialconnect.urls'
@@ -109,11 +113,104 @@ else:
 
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# SQLite by default. DATABASE_BACKEND=postgres switches to PostgreSQL, configured
+# by the POSTGRES_* variables, for deployments running several workers.
+DATABASE_BACKEND = os.getenv('DATABASE_BACKEND', 'sqlite')
+if DATABASE_BACKEND == 'postgres':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.getenv('POSTGRES_DB', 'socialconnect'),
+            'USER': os.getenv('POSTGRES_USER', 'socialconnect'),
+            'PASSWORD': os.getenv('POSTGRES_PASSWORD', ''),
+            'HOST': os.getenv('POSTGRES_HOST', 'localhost'),
+            'PORT': os.getenv('POSTGRES_PORT', '5432'),
+            'CONN_HEALTH_CHECKS': True,
+        }
+    }
+    if os.getenv('POSTGRES_POOL', 'true').lower() == 'true':
+        # psycopg's connection pool, shared by every thread of the process.
+        # Django hands connections back to it at the end of each request.
+        DATABASES['default']['OPTIONS'] = {
+            'pool': {
+                'min_size': int(os.getenv('POSTGRES_POOL_MIN_SIZE', '2')),
+                'max_size': int(os.getenv('POSTGRES_POOL_MAX_SIZE', '20')),
+                'timeout': int(os.getenv('POSTGRES_POOL_TIMEOUT', '10')),
+            },
+        }
+    else:
+        # One persistent connection per thread, kept for CONN_MAX_AGE seconds
+        DATABASES['default']['CONN_MAX_AGE'] = int(os.getenv('POSTGRES_CONN_MAX_AGE', '600'))
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.getenv('SQLITE_PATH', BASE_DIR / 'db.sqlite3'),
+            # Reopening per request would redo the pragmas and, in WAL mode,
+            # checkpoint whenever the last connection closes
+            'CONN_MAX_AGE': int(os.getenv('SQLITE_CONN_MAX_AGE', '600')),
+            # Take the write lock when a transaction starts, so concurrent writers
+            # wait out busy_timeout instead of failing to upgrade a read lock
+            'OPTIONS': {'transaction_mode': 'IMMEDIATE'},
+        }
+    }
+
+# Applied to every new SQLite connection (see socialconnect/db.py). WAL lets
+# readers carry on during a write and, with synchronous=NORMAL, commits skip
+# most fsyncs; a crash can lose the last commits but not corrupt the database.
+if os.getenv('SQLITE_TUNING', 'true').lower() == 'true':
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT', '5000')),  # milliseconds
     }
+else:
+    SQLITE_PRAGMAS = {}
+
+
+# Clients allowed to scrape /metrics (see socialconnect/metrics.py). Behind a reverse
+# proxy on the same host every request comes from 127.0.0.1, so the allow-list alone
+# leaves /metrics public: set METRICS_TOKEN and scrape with that bearer token.
+METRICS_ALLOWED_IPS = [ip.strip() for ip in os.getenv('METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',') if ip.strip()]
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
+# Opt-in cProfile capture (see socialconnect/profiling.py). When enabled, requests
+# and WebSocket connections from staff users sending HEADER are profiled, as are
+# a random SAMPLE_RATE share of all others. Browse the results at /profiles/.
+PROFILING = {
+    'ENABLED': os.getenv('PROFILING', 'false').lower() == 'true',
+    'HEADER': 'X-Profile',
+    'SAMPLE_RATE': float(os.getenv('PROFILING_SAMPLE_RATE', '0')),
+    'DIR': os.getenv('PROFILING_DIR', os.path.join(tempfile.gettempdir(), 'socialconnect-profiles')),
+    'MAX_FILES': int(os.getenv('PROFILING_MAX_FILES', '200')),
+    'TOP': 60,  # Functions listed when a profile is viewed
+}
+
+# Logging: records are queued and written as JSON lines by a background
+# thread (see socialconnect/log.py), so logging never blocks a request or the
+# ASGI event loop on stderr
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {'()': 'socialconnect.log.JsonFormatter'},
+    },
+    'handlers': {
+        'queue': {
+            '()': 'socialconnect.log.QueueHandler',
+            'formatter': 'json',
+            'maxsize': int(os.getenv('LOG_QUEUE_SIZE', '10000')),
+        },
+    },
+    'root': {
+        'handlers': ['queue'],
+        'level': os.getenv('LOG_LEVEL', 'INFO'),
+    },
+    'loggers': {
+        # Replace Django's own console handlers so its records are queued too
+        'django': {'handlers': ['queue'], 'level': os.getenv('LOG_LEVEL', 'INFO'), 'propagate': False},
+        'django.server': {'handlers': ['queue'], 'level': 'INFO', 'propagate': False},
+    },
 }
 
 
@@ -160,7 +257,7 @@ STATICFILES_DIRS = [
 
 # For production
 if not DEBUG:
-    MIDDLEWARE.insert(1, 'whitenoise.middleware.WhiteNoiseMiddleware')
+    MIDDLEWARE.insert(2, 'whitenoise.middleware.WhiteNoiseMiddleware')
     STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
     SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
     SECURE_SSL_REDIRECT = True
@@ -198,6 +295,62 @@ GOOGLE_CONFIG = {
     }
 }
 
+# Google Drive client
+DRIVE_HTTP_TIMEOUT = 60  # Seconds before a Drive HTTP request times out
+DRIVE_SERVICE_CACHE_SIZE = 64  # Per-user Drive clients kept per worker thread
+DRIVE_METADATA_SYNC_INTERVAL = 30  # Seconds cached file metadata is served before asking Drive for changes
+DRIVE_LIST_PAGE_SIZE = 50  # Files rendered with the file list page (and default JSON page size)
+DRIVE_LIST_MAX_PAGE_SIZE = 1000  # Largest page the JSON listing endpoint returns
+
+# Google Drive transfers
+DRIVE_DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024  # Bytes fetched from Drive per request while streaming a download
+DRIVE_UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # Bytes per resumable upload request; rounded down to a multiple of 256 KiB
+DRIVE_UPLOAD_MAX_RESUMES = 5  # Consecutive resumes of an upload session after transient failures
+DRIVE_NUM_RETRIES = 3  # Retries with exponential backoff for transient Drive errors
+DRIVE_TRANSFER_WORKERS = 4  # Files of a batch upload or archive download transferred at once
+DRIVE_ARCHIVE_MAX_FILES = 500  # Most files one ZIP download may contain
+
+# Serve listing, download and upload from async views that talk to Drive with
+# httpx (see files/aio.py). Only worth it under ASGI (Daphne/Uvicorn).
+DRIVE_ASYNC_IO = os.getenv('DRIVE_ASYNC_IO', 'false').lower() == 'true'
+DRIVE_ASYNC_MAX_CONNECTIONS = 100  # Pooled keep-alive connections to Drive per event loop
+
+# Background Drive transfers (see files/jobs.py). The memory store only works with a
+# single server process; with several, use the sqlite store, which they share.
+if os.getenv('DRIVE_JOB_STORE', 'memory') == 'sqlite':
+    # Queued jobs survive a restart
+    DRIVE_JOB_STORE = {
+        'BACKEND': 'files.jobs.SQLiteJobStore',
+        'OPTIONS': {'path': os.getenv('DRIVE_JOB_STORE_PATH', str(BASE_DIR / 'drive_jobs.sqlite3'))},
+    }
+else:
+    DRIVE_JOB_STORE = {'BACKEND': 'files.jobs.MemoryJobStore'}
+
+DRIVE_JOBS = {
+    'STORE': DRIVE_JOB_STORE,
+    'WORKERS': int(os.getenv('DRIVE_JOB_WORKERS', 4)),    # Transfers running at once in this process
+    'PER_USER': int(os.getenv('DRIVE_JOB_PER_USER', 2)),  # Transfers running at once for any one user
+    # Upload data waiting to be sent and finished downloads waiting to be fetched
+    'SPOOL_DIR': os.getenv('DRIVE_JOB_SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'socialconnect-drive-jobs')),
+    'RESULT_TTL': 3600,  # Seconds finished jobs (and their downloads) are kept
+    'LEASE': 60,  # Seconds a running job stays claimed by a process that stopped renewing it
+}
+
+# Downloaded file contents kept on local disk (see files/content_cache.py)
+DRIVE_CONTENT_CACHE = {
+    'DIR': os.getenv('DRIVE_CONTENT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'socialconnect-drive-cache')),
+    'MAX_SIZE': int(os.getenv('DRIVE_CONTENT_CACHE_MAX_SIZE', 1024 ** 3)),  # Bytes kept in all; 0 turns the cache off
+    'MAX_FILE_SIZE': 100 * 1024 * 1024,  # Larger files are always fetched from Drive
+}
+
+# Uploads above this size are spooled to a temporary file, which the Drive
+# upload then streams from (Django's default, stated explicitly)
+FILE_UPLOAD_MAX_MEMORY_SIZE = 2621440
+FILE_UPLOAD_HANDLERS = [
+    'django.core.files.uploadhandler.MemoryFileUploadHandler',
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+]
+
 # Fix the authentication backends order and ensure they're properly configured
 AUTHENTICATION_BACKENDS = [
     'django.contrib.auth.backends.ModelBackend',  # Default Django auth
@@ -211,7 +364,10 @@ LOGIN_URL = 'login'
 LOGOUT_REDIRECT_URL = 'home'     
 
 # Ensure session configuration is correct
-SESSION_ENGINE = 'django.contrib.sessions.backends.db'  # Default, but explicitly set
+# Sessions are read from the 'sessions' cache and written through to the
+# database, so loading one (every request and WebSocket handshake) skips the query
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+SESSION_CACHE_ALIAS = 'sessions'
 SESSION_COOKIE_AGE = 1209600  # 2 weeks in seconds
 SESSION_COOKIE_SECURE = IS_PRODUCTION  # Only use secure cookies in production
 SESSION_COOKIE_HTTPONLY = True  # Prevent JavaScript access to session cookie
@@ -228,8 +384,91 @@ else:
 
 # Add Channels configuration
 ASGI_APPLICATION = 'socialconnect.asgi.application'
-CHANNEL_LAYERS = {
+
+# Redis shared by the channel layer and the chat recent-messages buffer
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+
+# The in-memory layer only reaches sockets in the same process. Set
+# CHANNEL_LAYER=redis to broadcast across worker processes; CHANNEL_REDIS_HOSTS
+# takes a comma-separated list of Redis URLs that channels_redis shards across.
+CHANNEL_LAYER = os.getenv('CHANNEL_LAYER', 'memory')
+if CHANNEL_LAYER == 'redis':
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': [
+                    {
+                        'address': url.strip(),
+                        # Per-host connection pool size, per worker process
+                        'max_connections': int(os.getenv('CHANNEL_REDIS_MAX_CONNECTIONS', '50')),
+                    }
+                    for url in os.getenv('CHANNEL_REDIS_HOSTS', REDIS_URL).split(',')
+                    if url.strip()
+                ],
+                'prefix': os.getenv('CHANNEL_REDIS_PREFIX', 'socialconnect'),
+                'capacity': int(os.getenv('CHANNEL_REDIS_CAPACITY', '1500')),
+                'expiry': 10,
+            },
+        },
+    }
+else:
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        },
+    }
+
+# Per-process session caches would serve stale sessions once several workers
+# run, so the session cache follows the channel layer onto Redis unless
+# SESSION_CACHE_BACKEND says otherwise.
+if os.getenv('SESSION_CACHE_BACKEND', 'redis' if CHANNEL_LAYER == 'redis' else 'local') == 'redis':
+    SESSION_CACHE = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': REDIS_URL,
+        'KEY_PREFIX': 'session',
+    }
+else:
+    SESSION_CACHE = {
+        # Least recently used sessions are dropped past MAX_ENTRIES and reloaded from the database
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'sessions',
+        'OPTIONS': {'MAX_ENTRIES': int(os.getenv('SESSION_CACHE_MAX_ENTRIES', '10000'))},
+    }
+CACHES = {
     'default': {
-        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
     },
-}
\ No newline at end of file
+    'sessions': SESSION_CACHE,
+}
+
+# Room used by /chat/ and ws/chat/ when no room is given
+CHAT_DEFAULT_ROOM = 'lobby'
+
+# Chat history replay on connect
+CHAT_HISTORY_LIMIT = 50
+CHAT_HISTORY_BATCHED = True  # Send the replay on connect as versioned batch frames instead of one frame per message; older pages are always batched
+CHAT_HISTORY_CHUNK_SIZE = 50  # Maximum messages per history frame
+CHAT_HISTORY_MAX_PAGE_SIZE = 200  # Upper bound for client-requested scroll-back pages
+
+# Recent-messages buffer that serves history on connect without hitting the database.
+# Per-process buffers go stale once several workers share a channel layer, so
+# it follows the channel layer onto Redis unless CHAT_RECENT_MESSAGES_BACKEND says otherwise.
+if os.getenv('CHAT_RECENT_MESSAGES_BACKEND', 'redis' if CHANNEL_LAYER == 'redis' else 'local') == 'redis':
+    CHAT_RECENT_MESSAGES = {
+        'BACKEND': 'chat.cache.RedisRecentMessages',
+        'OPTIONS': {'url': REDIS_URL},
+    }
+else:
+    CHAT_RECENT_MESSAGES = {
+        'BACKEND': 'chat.cache.LocalRecentMessages',
+    }
+
+# Write-behind batching of chat message inserts (see chat/persistence.py)
+CHAT_WRITE_BEHIND = {
+    'ENABLED': os.getenv('CHAT_WRITE_BEHIND', 'true').lower() == 'true',
+    'BATCH_SIZE': 100,       # Flush as soon as this many messages are waiting
+    'FLUSH_INTERVAL': 0.25,  # Seconds; the longest a broadcast message may go unsaved
+    'MAX_PENDING': 5000,     # Senders wait for a flush beyond this many queued messages
+    'RETRIES': 3,            # Retries for a failed batch before it is logged and dropped
+}
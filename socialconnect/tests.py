@@ -0,0 +1,210 @@
+import asyncio
+import io
+import json
+import logging
+import os
+import pstats
+import tempfile
+
+from asgiref.sync import sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.backends.sqlite3.base import DatabaseWrapper
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.urls import reverse
+
+from chat.cache import reset_recent_messages
+from chat.models import Room
+from . import metrics, profiling
+from .asgi import application
+from .log import JsonFormatter, QueueHandler
+
+
+def chat_lobby():
+    """The room /ws/chat/ joins, with chat's process-level caches of rooms and messages cleared"""
+    reset_recent_messages()
+    Room.objects.clear_cache()
+    return Room.objects.get_or_create(name='lobby')[0]
+
+
+class SqliteTuningTests(TestCase):
+    def connect(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        wrapper = DatabaseWrapper({**connection.settings_dict, 'NAME': os.path.join(tmpdir.name, 'db.sqlite3')})
+        self.addCleanup(wrapper.close)
+        wrapper.ensure_connection()
+        return wrapper.connection
+
+    def pragmas(self, db):
+        return tuple(db.execute(f'PRAGMA {name}').fetchone()[0] for name in ('journal_mode', 'synchronous', 'busy_timeout'))
+
+    @override_settings(SQLITE_PRAGMAS={'journal_mode': 'WAL', 'synchronous': 'NORMAL', 'busy_timeout': 2500})
+    def test_pragmas_applied_to_new_connections(self):
+        self.assertEqual(self.pragmas(self.connect()), ('wal', 1, 2500))
+
+    @override_settings(SQLITE_PRAGMAS={})
+    def test_tuning_can_be_turned_off(self):
+        self.assertEqual(self.pragmas(self.connect())[:2], ('delete', 2))
+
+
+class QueueLoggingTests(SimpleTestCase):
+    def handler(self, **kwargs):
+        stream = io.StringIO()
+        handler = QueueHandler(stream, **kwargs)
+        handler.setFormatter(JsonFormatter())
+        self.addCleanup(handler.close)
+        logger = logging.getLogger('socialconnect.tests.queue')
+        logger.propagate = False
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        return handler, logger, stream
+
+    def test_records_written_as_json_lines(self):
+        handler, logger, stream = self.handler()
+        values = ['before']
+        logger.warning("Values: %s", values, extra={'room': 'lobby'})
+        values.append('after')  # Arguments are merged when the call is made
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            logger.exception("Failed")
+        handler.close()
+
+        first, second = (json.loads(line) for line in stream.getvalue().splitlines())
+        self.assertEqual(
+            {key: first[key] for key in ('level', 'logger', 'message', 'room')},
+            {'level': 'WARNING', 'logger': 'socialconnect.tests.queue', 'message': "Values: ['before']", 'room': 'lobby'},
+        )
+        self.assertIn('ValueError: boom', second['exc_info'])
+
+    def test_full_queue_drops_records(self):
+        handler, logger, stream = self.handler(maxsize=1)
+        handler.listener.stop()
+        handler.listening = False
+        for i in range(3):
+            logger.warning("Message %s", i)
+        self.assertEqual(handler.dropped, 2)
+
+
+class MetricsTests(TransactionTestCase):
+    def setUp(self):
+        chat_lobby()
+
+    def counts(self):
+        return [
+            metric.get(consumer='ChatConsumer') for metric in (
+                metrics.WEBSOCKET_CONNECTS, metrics.WEBSOCKET_MESSAGES_RECEIVED,
+                metrics.WEBSOCKET_MESSAGES_SENT, metrics.WEBSOCKET_DISCONNECTS,
+            )
+        ] + [metrics.GROUP_SEND_SECONDS.count(consumer='ChatConsumer')]
+
+    async def test_websocket_traffic_counted(self):
+        before = self.counts()
+        communicator = WebsocketCommunicator(application, '/ws/chat/')
+        await communicator.connect()
+        await communicator.receive_from()  # History
+        await communicator.send_to(text_data=json.dumps({'message': 'hello'}))
+        await communicator.receive_from()
+        await communicator.disconnect()
+
+        # connects, frames in, frames out, disconnects, group sends
+        self.assertEqual([b - a for a, b in zip(before, self.counts())], [1, 1, 2, 1, 1])
+
+    def test_requests_timed_and_exposed(self):
+        self.client.get(reverse('home'))
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response['Content-Type'], metrics.CONTENT_TYPE)
+        body = response.content.decode()
+        self.assertIn('# TYPE http_request_duration_seconds histogram', body)
+        self.assertRegex(body, r'http_request_duration_seconds_count\{view="home",method="GET",status="200"\} [1-9]')
+        self.assertIn('http_request_duration_seconds_bucket{view="home",method="GET",status="200",le="+Inf"}', body)
+
+    def test_metrics_only_served_locally(self):
+        self.assertEqual(self.client.get(reverse('metrics'), REMOTE_ADDR='203.0.113.5').status_code, 403)
+
+    @override_settings(METRICS_TOKEN='scrape-token')
+    def test_token_required_when_set(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        response = self.client.get(reverse('metrics'), headers={'Authorization': 'Bearer wrong'})
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get(reverse('metrics'), headers={'Authorization': 'Bearer scrape-token'})
+        self.assertEqual(response.status_code, 200)
+
+
+class ProfilingTests(TransactionTestCase):
+    def setUp(self):
+        chat_lobby()
+        self.staff = User.objects.create_user(username='admin@example.com', email='admin@example.com', is_staff=True)
+        self.user = User.objects.create_user(username='alice@example.com', email='alice@example.com')
+
+        profile_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(profile_dir.cleanup)
+        overridden = override_settings(PROFILING={**settings.PROFILING, 'ENABLED': True, 'DIR': profile_dir.name})
+        overridden.enable()
+        self.addCleanup(overridden.disable)
+
+    def names(self):
+        return [profile['name'] for profile in profiling.list_profiles()]
+
+    def test_staff_request_with_header_profiled(self):
+        self.client.force_login(self.staff)
+        response = self.client.get(reverse('chat_room'), HTTP_X_PROFILE='1')
+        self.assertEqual(response.status_code, 200)
+        [name] = self.names()
+        self.assertIn('-http-chat_room-', name)
+
+        listing = self.client.get(reverse('profile_list'))
+        self.assertContains(listing, name)
+        stats = self.client.get(reverse('profile_detail', args=[name]), {'sort': 'tottime'})
+        self.assertIn('function calls', stats.content.decode())
+
+    def test_header_ignored_for_other_users(self):
+        self.client.force_login(self.user)
+        self.client.get(reverse('chat_room'), HTTP_X_PROFILE='1')
+        self.assertEqual(self.names(), [])
+        self.assertEqual(self.client.get(reverse('profile_list')).status_code, 302)
+
+    async def test_asgi_request_profiled_in_view_thread(self):
+        await sync_to_async(self.async_client.force_login)(self.user)
+        with override_settings(PROFILING={**settings.PROFILING, 'SAMPLE_RATE': 1.0}):
+            response = await self.async_client.get(reverse('chat_room'))
+        self.assertEqual(response.status_code, 200)
+        [name] = await sync_to_async(self.names)()
+        stats = pstats.Stats(os.path.join(settings.PROFILING['DIR'], name))
+        self.assertTrue(any(function == 'chat_room' for _, _, function in stats.stats))
+
+    async def test_sampled_consumer_events_profiled(self):
+        with override_settings(PROFILING={**settings.PROFILING, 'SAMPLE_RATE': 1.0}):
+            communicator = WebsocketCommunicator(application, '/ws/chat/')
+            await communicator.connect()
+            await communicator.receive_from()
+            await communicator.disconnect()
+        names = await sync_to_async(self.names)()
+        self.assertTrue(any('-ws-chatconsumer-websocketconnect-' in name for name in names))
+
+    async def test_nothing_profiled_by_default(self):
+        communicator = WebsocketCommunicator(application, '/ws/chat/', headers=[(b'x-profile', b'1')])
+        await communicator.connect()
+        await communicator.receive_from()
+        await communicator.disconnect()
+        self.assertEqual(await sync_to_async(self.names)(), [])
+
+    async def test_overlapping_async_captures_not_nested(self):
+        async def work(result):
+            await asyncio.sleep(0.01)
+            return result
+
+        results = await asyncio.gather(
+            profiling._await_profiled('ws', 'first', work, 1),
+            profiling._await_profiled('ws', 'second', work, 2),
+        )
+        self.assertEqual(results, [1, 2])
+        [name] = await sync_to_async(self.names)()
+        self.assertIn('-ws-first-', name)
+
+        # Capturing again once the first is over
+        await profiling._await_profiled('ws', 'third', work, 3)
+        self.assertEqual(len(await sync_to_async(self.names)()), 2)
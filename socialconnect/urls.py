@@ -17,6 +17,8 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import path, include
 from django.views.generic import TemplateView  
+from socialconnect.metrics import metrics_view
+from socialconnect.profiling import profile_detail, profile_list
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -24,4 +26,7 @@ urlpatterns = [
     path('accounts/', include('accounts.urls')),
     path('files/', include('files.urls')),
     path('chat/', include('chat.urls')),
+    path('metrics', metrics_view, name='metrics'),
+    path('profiles/', profile_list, name='profile_list'),
+    path('profiles/<str:name>', profile_detail, name='profile_detail'),
 ]
\ No newline at end of file
@@ -1,4 +1,8 @@
 // static/js/chat.js
+
+// Must match chat.consumers.HISTORY_VERSION
+const HISTORY_VERSION = 1;
+
 class ChatManager {
     constructor() {
         this.socket = null;
@@ -8,6 +12,11 @@ class ChatManager {
         this.submitButton = document.querySelector('#chat-message-submit');
         this.statusElement = document.getElementById('connection-status');
         this.messagesContainer = document.querySelector('#chat-messages');
+        this.roomName = document.querySelector('.chat-container').dataset.room;
+        this.nextCursor = null;          // Cursor for the next page of older messages
+        this.loadingOlder = false;
+        this.olderPage = null;           // Frames of the older page being received, shown once it is done
+        this.replaceOnHistory = false;   // Initial replay after (re)connect replaces what is shown
 
         this.initializeEventListeners();
         this.connectWebSocket();
@@ -18,7 +27,7 @@ class ChatManager {
         
         // Get the correct WebSocket URL
         const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-        const wsUrl = `${protocol}//${window.location.host}/ws/chat/`;
+        const wsUrl = `${protocol}//${window.location.host}/ws/chat/${encodeURIComponent(this.roomName)}/`;
         
         console.log(`Connecting to WebSocket at: ${wsUrl}`);
         
@@ -34,6 +43,9 @@ class ChatManager {
         console.log("WebSocket connection established!");
         this.updateStatus('Connected', 'green');
         this.reconnectAttempts = 0; // Reset reconnect attempts on successful connection
+        this.replaceOnHistory = true;
+        this.loadingOlder = false;
+        this.olderPage = null;
     }
 
     handleMessage(event) {
@@ -44,29 +56,82 @@ class ChatManager {
             // Check if there's an error message
             if (data.error) {
                 console.error("Error from server:", data.error);
+                this.loadingOlder = false;
+                return;
+            }
+
+            // Batched history replay sent on connect
+            if (data.type === 'history') {
+                this.renderHistory(data);
                 return;
             }
             
-            const messageElement = document.createElement('div');
-            const currentUserEmail = document.querySelector('.chat-container').dataset.userEmail;
-            
-            // Create message container
-            messageElement.className = `message ${data.user_email === currentUserEmail ? 'sent' : 'received'}`;
-            
-            // Create message content
-            const messageHTML = `
-                <div class="message-header">${data.user_email === currentUserEmail ? 'You' : data.user_email}</div>
-                <div class="message-text">${data.message}</div>
-            `;
-            messageElement.innerHTML = messageHTML;
-            
-            this.messagesContainer.appendChild(messageElement);
+            this.messagesContainer.appendChild(this.createMessageElement(data));
             this.scrollToBottom();
         } catch (error) {
             console.error("Error parsing message:", error);
         }
     }
 
+    renderHistory(data) {
+        if (data.version !== HISTORY_VERSION) {
+            console.warn(`Unexpected history version ${data.version}, rendering anyway`);
+        }
+
+        if (data.before) {
+            // Older page: collect its frames in order, then prepend them together
+            // and keep the viewport anchored on what the user was reading
+            this.olderPage ??= document.createDocumentFragment();
+            data.messages.forEach(message => this.olderPage.appendChild(this.createMessageElement(message)));
+            if (data.done) {
+                const previousHeight = this.messagesContainer.scrollHeight;
+                this.messagesContainer.prepend(this.olderPage);
+                this.messagesContainer.scrollTop += this.messagesContainer.scrollHeight - previousHeight;
+                this.olderPage = null;
+            }
+        } else {
+            // Build the whole batch off-DOM so the browser lays it out once
+            const fragment = document.createDocumentFragment();
+            data.messages.forEach(message => fragment.appendChild(this.createMessageElement(message)));
+
+            if (this.replaceOnHistory) {
+                this.messagesContainer.replaceChildren();
+                this.replaceOnHistory = false;
+            }
+            this.messagesContainer.appendChild(fragment);
+            this.scrollToBottom();
+        }
+
+        if (data.done) {
+            this.nextCursor = data.next_cursor;
+            this.loadingOlder = false;
+        }
+    }
+
+    loadOlderMessages() {
+        if (!this.nextCursor || this.loadingOlder || this.socket?.readyState !== WebSocket.OPEN) {
+            return;
+        }
+        this.loadingOlder = true;
+        this.socket.send(JSON.stringify({ 'type': 'history', 'before': this.nextCursor }));
+    }
+
+    createMessageElement(data) {
+        const messageElement = document.createElement('div');
+        const currentUserEmail = document.querySelector('.chat-container').dataset.userEmail;
+        
+        // Create message container
+        messageElement.className = `message ${data.user_email === currentUserEmail ? 'sent' : 'received'}`;
+        
+        // Create message content
+        const messageHTML = `
+            <div class="message-header">${data.user_email === currentUserEmail ? 'You' : data.user_email}</div>
+            <div class="message-text">${data.message}</div>
+        `;
+        messageElement.innerHTML = messageHTML;
+        return messageElement;
+    }
+
     scrollToBottom() {
         this.messagesContainer.scrollTop = this.messagesContainer.scrollHeight;
     }
@@ -113,6 +178,14 @@ class ChatManager {
         if (this.submitButton) {
             this.submitButton.addEventListener('click', () => this.sendMessage());
         }
+
+        if (this.messagesContainer) {
+            this.messagesContainer.addEventListener('scroll', () => {
+                if (this.messagesContainer.scrollTop === 0) {
+                    this.loadOlderMessages();
+                }
+            });
+        }
     }
 
     sendMessage() {
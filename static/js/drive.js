@@ -1,15 +1,209 @@
+// Rows rendered above and below the visible window of the file list
+const OVERSCAN_ROWS = 10;
+
+class VirtualFileList {
+    // Keeps every listed file in memory as a small object but only renders
+    // the rows currently scrolled into view (plus OVERSCAN_ROWS either side)
+    constructor(container) {
+        this.viewport = container.querySelector('.files-table');
+        this.tbody = this.viewport.querySelector('tbody');
+        this.status = container.querySelector('.file-list-status');
+        this.files = JSON.parse(document.getElementById('drive-files-initial').textContent);
+        // Selection lives here since rows are recreated as they scroll by
+        this.selected = new Set();
+        this.archiveForm = container.querySelector('.archive-form');
+        this.rowHeight = 0;
+        this.range = null;
+        this.renderScheduled = false;
+
+        this.viewport.addEventListener('scroll', () => this.scheduleRender());
+        this.tbody.addEventListener('change', (e) => {
+            if (e.target.classList.contains('select-file')) {
+                this.toggleSelected(e.target.value, e.target.checked);
+            }
+        });
+        this.archiveForm.addEventListener('submit', () => this.addSelectionToForm());
+        window.addEventListener('resize', () => this.scheduleRender());
+        this.render();
+
+        if (container.dataset.complete !== 'true') {
+            this.stream(container.dataset.streamUrl);
+        }
+    }
+
+    async stream(url) {
+        try {
+            const response = await fetch(url);
+            if (!response.ok || !response.body) throw new Error('Listing failed');
+
+            // Rows arrive as NDJSON; a read may end mid-line, so keep the tail
+            const reader = response.body.pipeThrough(new TextDecoderStream()).getReader();
+            let pending = '';
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) break;
+                const lines = (pending + value).split('\n');
+                pending = lines.pop();
+                for (const line of lines) {
+                    if (line) this.files.push(JSON.parse(line));
+                }
+                this.status.textContent = `Loading files... (${this.files.length})`;
+                this.scheduleRender();
+            }
+            this.status.textContent = this.files.length ? '' : 'No files found in your Drive.';
+        } catch (error) {
+            console.error('File listing error:', error);
+            this.status.textContent = 'Failed to load all files. Please refresh the page.';
+        }
+    }
+
+    toggleSelected(fileId, selected) {
+        if (selected) {
+            this.selected.add(fileId);
+        } else {
+            this.selected.delete(fileId);
+        }
+        this.archiveForm.querySelector('.selected-count').textContent = this.selected.size;
+        this.archiveForm.querySelector('button').disabled = this.selected.size === 0;
+    }
+
+    addSelectionToForm() {
+        this.archiveForm.querySelectorAll('input[name="file_id"]').forEach(input => input.remove());
+        for (const fileId of this.selected) {
+            const input = document.createElement('input');
+            input.type = 'hidden';
+            input.name = 'file_id';
+            input.value = fileId;
+            this.archiveForm.appendChild(input);
+        }
+    }
+
+    scheduleRender() {
+        if (this.renderScheduled) return;
+        this.renderScheduled = true;
+        requestAnimationFrame(() => {
+            this.renderScheduled = false;
+            this.render();
+        });
+    }
+
+    render() {
+        const rowHeight = this.rowHeight || 50;
+        const visible = Math.ceil(this.viewport.clientHeight / rowHeight);
+        const first = Math.max(0, Math.floor(this.viewport.scrollTop / rowHeight) - OVERSCAN_ROWS);
+        const last = Math.min(this.files.length, first + visible + 2 * OVERSCAN_ROWS);
+
+        // Re-rendering an unchanged window would reset in-progress downloads
+        const range = `${first}:${last}:${this.files.length}`;
+        if (range === this.range) return;
+        this.range = range;
+
+        const fragment = document.createDocumentFragment();
+        fragment.appendChild(this.createSpacer(first * rowHeight));
+        for (let i = first; i < last; i++) {
+            fragment.appendChild(this.createRow(this.files[i]));
+        }
+        fragment.appendChild(this.createSpacer((this.files.length - last) * rowHeight));
+        this.tbody.replaceChildren(fragment);
+
+        if (!this.rowHeight && last > first) {
+            this.rowHeight = this.tbody.children[1].getBoundingClientRect().height || rowHeight;
+            this.range = null;
+            this.scheduleRender();
+        }
+    }
+
+    createSpacer(height) {
+        const row = document.createElement('tr');
+        row.className = 'spacer';
+        const cell = document.createElement('td');
+        cell.colSpan = 5;
+        cell.style.height = `${height}px`;
+        row.appendChild(cell);
+        return row;
+    }
+
+    createRow(file) {
+        const row = document.createElement('tr');
+
+        const selectCell = document.createElement('td');
+        const checkbox = document.createElement('input');
+        checkbox.type = 'checkbox';
+        checkbox.className = 'select-file';
+        checkbox.value = file.id;
+        checkbox.checked = this.selected.has(file.id);
+        selectCell.appendChild(checkbox);
+
+        const typeCell = document.createElement('td');
+        const type = document.createElement('span');
+        type.className = 'file-type';
+        type.textContent = this.fileTypeLabel(file.mimeType || '');
+        typeCell.appendChild(type);
+
+        const nameCell = document.createElement('td');
+        nameCell.textContent = file.name;
+
+        const modifiedCell = document.createElement('td');
+        modifiedCell.textContent = (file.modifiedTime || '').slice(0, 10);
+
+        const actions = document.createElement('td');
+        actions.className = 'actions';
+        if ((file.mimeType || '').includes('google-apps') && file.webViewLink) {
+            const preview = document.createElement('a');
+            preview.href = file.webViewLink;
+            preview.target = '_blank';
+            preview.className = 'btn btn-sm btn-primary';
+            preview.textContent = 'Preview';
+            actions.appendChild(preview);
+            actions.appendChild(document.createTextNode(' '));
+        }
+        const button = document.createElement('button');
+        button.className = 'btn btn-sm btn-success download-btn';
+        button.dataset.fileId = file.id;
+        button.dataset.filename = file.name;
+        button.textContent = 'Download';
+        actions.appendChild(button);
+        actions.insertAdjacentHTML('beforeend',
+            '<div class="progress-container" style="display: none;">' +
+            '<div class="progress-bar"><div class="progress"></div></div>' +
+            '<div class="progress-text">0%</div></div>');
+        const queueButton = document.createElement('button');
+        queueButton.className = 'btn btn-sm queue-download-btn';
+        queueButton.dataset.fileId = file.id;
+        queueButton.textContent = 'Queue';
+        actions.appendChild(queueButton);
+
+        row.append(selectCell, typeCell, nameCell, modifiedCell, actions);
+        return row;
+    }
+
+    fileTypeLabel(mimeType) {
+        if (mimeType.includes('image')) return 'Image';
+        if (mimeType.includes('pdf')) return 'PDF';
+        if (mimeType.includes('spreadsheet')) return 'Spreadsheet';
+        if (mimeType.includes('document')) return 'Document';
+        if (mimeType.includes('presentation')) return 'Presentation';
+        return 'File';
+    }
+}
+
 class DriveManager {
     constructor() {
         this.initializeDownloadButtons();
+
+        const container = document.querySelector('.file-list-container[data-stream-url]');
+        if (container && container.querySelector('.files-table')) {
+            this.fileList = new VirtualFileList(container);
+        }
     }
 
     initializeDownloadButtons() {
-        const downloadButtons = document.querySelectorAll('.download-btn');
-        
-        downloadButtons.forEach(button => {
-            button.addEventListener('click', async (e) => {
-                await this.handleDownload(e.target);
-            });
+        // Delegated, since virtual scrolling replaces rows as they scroll by
+        document.addEventListener('click', async (e) => {
+            const button = e.target.closest('.download-btn');
+            if (button) {
+                await this.handleDownload(button);
+            }
         });
     }
 
@@ -30,8 +224,8 @@ class DriveManager {
             
             if (!response.ok) throw new Error('Download failed');
 
-            // Create blob and download
-            const blob = await response.blob();
+            // Read the body as it streams in so progress reflects bytes received
+            const blob = await this.readWithProgress(response, progressBar, progressText);
             this.downloadBlob(blob, fileName);
 
             // Show success
@@ -52,6 +246,25 @@ class DriveManager {
         }
     }
 
+    async readWithProgress(response, progressBar, progressText) {
+        const total = Number(response.headers.get('Content-Length')) || 0;
+        if (!total || !response.body) {
+            return response.blob();
+        }
+
+        const reader = response.body.getReader();
+        const chunks = [];
+        let received = 0;
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            chunks.push(value);
+            received += value.length;
+            this.updateProgress(progressBar, progressText, Math.round(received / total * 100));
+        }
+        return new Blob(chunks, { type: response.headers.get('Content-Type') || '' });
+    }
+
     downloadBlob(blob, fileName) {
         const url = window.URL.createObjectURL(blob);
         const a = document.createElement('a');
@@ -69,9 +282,113 @@ class DriveManager {
     }
 }
 
+class DriveJobs {
+    // Live list of background transfers, fed by the jobs WebSocket
+    constructor(panel) {
+        this.panel = panel;
+        this.list = panel.querySelector('.job-list');
+        this.items = new Map();
+        this.connect();
+    }
+
+    connect() {
+        const protocol = window.location.protocol === 'https:' ? 'wss' : 'ws';
+        this.socket = new WebSocket(`${protocol}://${window.location.host}${this.panel.dataset.wsPath}`);
+        this.socket.onmessage = (e) => {
+            const data = JSON.parse(e.data);
+            if (data.type === 'jobs') {
+                data.jobs.forEach(job => this.render(job));
+            } else if (data.type === 'job') {
+                this.render(data.job);
+            }
+        };
+        this.socket.onclose = () => setTimeout(() => this.connect(), 2000);
+    }
+
+    async submit(url, body) {
+        const response = await fetch(url, {
+            method: 'POST',
+            body: body,
+            headers: { 'X-CSRFToken': this.csrfToken() },
+        });
+        if (!response.ok) throw new Error('Could not queue the transfer');
+        const data = await response.json();
+        (data.jobs || [data.job]).forEach(job => this.render(job));
+    }
+
+    csrfToken() {
+        const input = document.querySelector('[name=csrfmiddlewaretoken]');
+        if (input) return input.value;
+        const cookie = document.cookie.split('; ').find(c => c.startsWith('csrftoken='));
+        return cookie ? cookie.split('=')[1] : '';
+    }
+
+    render(job) {
+        let item = this.items.get(job.id);
+        if (!item) {
+            item = document.createElement('li');
+            item.innerHTML = '<span class="job-name"></span>' +
+                '<div class="progress-bar" style="width: 150px;"><div class="progress"></div></div>' +
+                '<span class="job-status"></span>';
+            this.items.set(job.id, item);
+            this.list.prepend(item);
+            this.panel.style.display = 'block';
+        }
+
+        const percentage = job.size ? Math.round(job.transferred / job.size * 100) : 0;
+        item.querySelector('.job-name').textContent = `${job.kind === 'upload' ? '↑' : '↓'} ${job.name}`;
+        item.querySelector('.progress').style.width = `${job.state === 'done' ? 100 : percentage}%`;
+
+        const status = item.querySelector('.job-status');
+        status.className = 'job-status';
+        if (job.state === 'done' && job.kind === 'download') {
+            status.innerHTML = '';
+            const link = document.createElement('a');
+            link.href = `/files/jobs/${job.id}/file/`;
+            link.textContent = 'Save';
+            status.appendChild(link);
+        } else if (job.state === 'failed') {
+            status.classList.add('job-failed');
+            status.textContent = 'Failed';
+        } else {
+            status.textContent = job.state === 'running' ? `${percentage}%` : job.state;
+        }
+    }
+}
+
 // Initialize drive features when DOM is loaded
 document.addEventListener('DOMContentLoaded', () => {
+    const panel = document.querySelector('.drive-jobs');
+    const jobs = panel ? new DriveJobs(panel) : null;
+
     if (document.querySelector('.file-list-container')) {
         new DriveManager();
     }
+    if (!jobs) return;
+
+    document.addEventListener('click', async (e) => {
+        const button = e.target.closest('.queue-download-btn');
+        if (!button) return;
+        try {
+            await jobs.submit(`/files/jobs/download/${button.dataset.fileId}/`);
+        } catch (error) {
+            console.error('Queue error:', error);
+            alert('Could not queue the download. Please try again.');
+        }
+    });
+
+    const background = document.querySelector('input[name="background"]');
+    if (background) {
+        background.form.addEventListener('submit', async (e) => {
+            if (!background.checked) return;
+            e.preventDefault();
+            try {
+                await jobs.submit(background.dataset.queueUrl, new FormData(background.form));
+                background.form.reset();
+            } catch (error) {
+                console.error('Queue error:', error);
+                alert('Could not queue the upload. Please try again.');
+            }
+        });
+    }
 });
\ No newline at end of file